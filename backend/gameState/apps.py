@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class GameStateConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'gameState'
+
+    def ready(self):
+        # connecting the signal receivers
+        from . import signals  # noqa: F401
@@ -0,0 +1,119 @@
+import threading
+
+from .metrics import CATALOG_LOOKUPS
+
+
+class ItemCatalog:
+    """
+    In-process cache of the Item table, keyed by name and by id.
+
+    The catalog is tiny and almost never changes, so it is loaded as a whole
+    and kept until an Item is saved or deleted, which invalidates it through
+    the signals in signals.py. The next lookup then reloads it.
+
+    Attributes:
+        hits (int): Lookups served from memory.
+        misses (int): Lookups that had to load the catalog from the database.
+    """
+
+    def __init__(self):
+        self.by_name = None
+        self.by_id = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def warm(self):
+        """
+        Load every item from the database into memory.
+
+        Returns:
+            dict: The items by id under "by_id" and by name under "by_name", as loaded, even if the
+            catalog was invalidated since.
+        """
+        from .models import Item
+
+        with self.lock:
+            items = list(Item.objects.all())
+            self.by_id = {item.id: item for item in items}
+            self.by_name = {item.name: item for item in items}
+            return {"by_id": self.by_id, "by_name": self.by_name}
+
+    def invalidate(self):
+        """
+        Drop the cached items so the next lookup reloads them.
+        """
+        with self.lock:
+            self.by_name = None
+            self.by_id = None
+
+    def _items(self, key):
+        items = getattr(self, key)
+        if items is None:
+            self.misses += 1
+            CATALOG_LOOKUPS.labels("miss").inc()
+            # the items just loaded, an invalidation from another thread may have dropped them already
+            items = self.warm()[key]
+        else:
+            self.hits += 1
+            CATALOG_LOOKUPS.labels("hit").inc()
+        return items
+
+    def get(self, name):
+        """
+        Get an item by name.
+
+        Args:
+            name (str): The name of the item.
+
+        Returns:
+            Item: The item.
+
+        Raises:
+            Item.DoesNotExist: If the item with the given name does not exist.
+        """
+        from .models import Item
+
+        try:
+            return self._items("by_name")[name]
+        except KeyError:
+            raise Item.DoesNotExist("Item with name {} does not exist".format(name))
+
+    def get_by_id(self, item_id):
+        """
+        Get an item by id.
+
+        Args:
+            item_id (int): The id of the item.
+
+        Returns:
+            Item: The item.
+
+        Raises:
+            Item.DoesNotExist: If the item with the given id does not exist.
+        """
+        from .models import Item
+
+        try:
+            return self._items("by_id")[item_id]
+        except KeyError:
+            raise Item.DoesNotExist("Item with id {} does not exist".format(item_id))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_item_catalog = None
+
+
+def get_item_catalog():
+    """
+    Get the process-wide item catalog, creating it on first use.
+
+    Returns:
+        ItemCatalog: The shared catalog.
+    """
+    global _item_catalog
+    if _item_catalog is None:
+        _item_catalog = ItemCatalog()
+    return _item_catalog
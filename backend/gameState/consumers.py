@@ -1,132 +1,383 @@
 # consumers.py
-import asyncio
-from .loon_logic import LoonType, LoonWave
+from collections import deque
+from urllib.parse import parse_qs
+from .loon_logic import LoonType, LoonWave, VectorLoonWave, get_wave_engine
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
+from django.conf import settings
 import random
+import time
+from .metrics import FRAME_BYTES, OPEN_SOCKETS, RATE_LIMITED, RECEIVE_SECONDS, SEND_SECONDS, STALLED_DISCONNECTS
+from .offload import SharedVectorLoonWave
+from .outbound import OutboundQueue
+from .profiling import get_profiler
+from .protocol import negotiate_protocol
+from .ratelimit import connection_bucket, get_admission, get_rate_limiter
+from .replay import ReplayRecorder, state_digest
+from .scheduler import get_scheduler
 from .services import PlayerService
+from .sessions import get_session_registry
+from .sync import DeltaSync
 
 
 class LoonConsumer(AsyncWebsocketConsumer):
     """
     WebSocket consumer for handling Loon updates.
 
+    The game state has a single writer: the scheduler's tick, through
+    simulate(). Frames received from the client never touch the wave directly,
+    pops are queued and applied at the start of the next tick, so no locks
+    are needed.
+
+    simulate() runs one fixed simulation step and frame() only reads the state
+    it left, so the scheduler can send frames at a lower rate than it
+    simulates without changing how the game plays out.
+
+    Every random draw of the game comes from its own stream seeded with
+    ``seed``, so given the seed, the waves and the pops applied at every step
+    (what the replay log records) a game can be re-run exactly.
+
     Attributes:
-        lock (asyncio.Lock): A lock to ensure thread safety.
+        pending_pops (deque): Loon IDs popped by the client, applied at the next tick.
+        seed (int): The seed of the game's random stream.
+        rng (random.Random): The game's random stream.
+        steps (int): The number of simulation steps run.
+        time_step (float): Simulated seconds per step.
+        recorder (ReplayRecorder): Writes the game's replay log, None when not recording.
+        loon_batch (list): The loons shown to the client after the last simulation step.
         is_game_over (bool): Flag indicating if the game is over.
+        wave_engine (type): The LoonWave class this game's waves run on.
+        protocol (JsonProtocol): The wire protocol negotiated with the client.
+        sync (DeltaSync): Builds delta-compressed frames when the client asked for them, else None.
+        player_service (PlayerService): Persists the player's score, coins and status.
+        profiler (Profiler): Times the phases of the game loop while a profiling window runs.
+        outbound (OutboundQueue): Messages waiting to be sent to the client, None to send directly.
+        sessions (SessionRegistry): Owns the game's tasks while its session is open.
+        receive_bucket (TokenBucket): Limits the frames this connection may send, None for no limit.
+        receive_limiter (RateLimiter): Limits the frames all connections of the player may send, None for no limit.
     """
 
+    # close code sent to clients disconnected for not reading their frames
+    STALLED_CLOSE_CODE = 4008
+    # close code sent to clients connecting while the server runs LOON_MAX_GAMES games, "try again later"
+    BUSY_CLOSE_CODE = 1013
+
     def __init__(self):
         super().__init__()
-        self.lock = asyncio.Lock()
+        self.pending_pops = deque()
         self.is_game_over = False
+        self.player_id = None
+        self.loon_wave = None
+        self.loon_batch = []
+        self.sync = None
+        self.player_service = PlayerService()
+        # task running a wave change or the game over, the scheduler skips the game meanwhile
+        self.transition = None
+        self.socket_open = False
+        self.profiler = get_profiler()
+        self.outbound = None
+        self.steps = 0
+        self.time_step = settings.LOON_TICK_INTERVAL
+        self.recorder = None
+        self.sessions = get_session_registry()
+        self.receive_bucket = connection_bucket()
+        self.receive_limiter = get_rate_limiter("receive")
+        # whether the client was told it hit the rate limit since its last accepted frame
+        self.rate_limited = False
+        self.seed_game(random.getrandbits(64))
+
+    def seed_game(self, seed):
+        """
+        Seed the game's random stream, before the game is set up.
+
+        Args:
+            seed (int): The seed.
+        """
+        self.seed = seed
+        self.rng = random.Random(seed)
 
     async def connect(self):
         """
         Called when the WebSocket is handshaking as part of the connection process.
         """
-        await self.accept()
-        self.player_id = self.scope["url_route"]["kwargs"]["player_id"]
+        # the wire protocol is negotiated with a subprotocol or ?protocol=<name>, JSON by default
+        subprotocols = self.scope.get("subprotocols", [])
+        self.protocol = negotiate_protocol(subprotocols, self.query_param("protocol"))
+        if self.protocol.subprotocol in subprotocols:
+            await self.accept(self.protocol.subprotocol)
+        else:
+            await self.accept()
+        # games started through game/start/ claim the place they reserved, others need a free one
+        if not get_admission().admit(self.scope["url_route"]["kwargs"]["player_id"]):
+            RATE_LIMITED.labels("admission").inc()
+            await self.close(code=self.BUSY_CLOSE_CODE)
+            return
+        self.socket_open = True
+        OPEN_SOCKETS.inc()
+        # frames go through a bounded queue so a slow client never holds up the game loop
+        self.outbound = OutboundQueue(
+            self.send_message, settings.LOON_OUTBOUND_QUEUE_SIZE, settings.LOON_STALL_TIMEOUT
+        )
+        # the wave engine can be picked per game with ?engine=<name>, falling back to the setting
+        # ?sync=delta sends keyframes plus deltas instead of the full state every tick
+        await self.start_game(
+            self.scope["url_route"]["kwargs"]["player_id"],
+            self.query_param("engine", settings.LOON_WAVE_ENGINE),
+            self.query_param("sync") == "delta",
+        )
+
+    async def start_game(self, player_id, engine, delta_sync=False):
+        """
+        Sets up the game of a player and starts sending it to the client.
+
+        Args:
+            player_id (str): The ID of the player.
+            engine (str): The name of the wave engine, the LOON_WAVE_ENGINE setting is used if unknown.
+            delta_sync (bool): Whether to send keyframes plus deltas instead of full frames.
+        """
+        self.player_id = player_id
+        try:
+            self.wave_engine = get_wave_engine(engine)
+        except ValueError:
+            self.wave_engine = get_wave_engine(settings.LOON_WAVE_ENGINE)
+        # waves past the offload threshold step in the process pool, on buffers shared with it
+        if settings.LOON_OFFLOAD_THRESHOLD and self.wave_engine is VectorLoonWave:
+            self.wave_engine = SharedVectorLoonWave
+        if delta_sync:
+            self.sync = DeltaSync(settings.LOON_KEYFRAME_INTERVAL)
+        if settings.LOON_REPLAY_DIR:
+            self.recorder = ReplayRecorder.open(
+                settings.LOON_REPLAY_DIR, self.player_id, self.seed, self.wave_engine.name, self.time_step
+            )
 
         # Start the update loop
-        asyncio.get_event_loop().create_task(self.send_loon_updates())
+        await self.send_loon_updates()
 
     async def disconnect(self, close_code):
         """
         Called when the WebSocket closes for any reason.
         """
-        # Handle disconnection
-        pass
+        # cancels a wave change or game over still running
+        self.sessions.close(self)
+        get_scheduler().unregister(self)
+        if self.outbound is not None:
+            self.outbound.close()
+        if self.recorder is not None and self.loon_wave is not None:
+            self.recorder.end(self.steps, self.wave, "disconnected", state_digest(self))
+        if self.socket_open:
+            self.socket_open = False
+            OPEN_SOCKETS.dec()
+        if self.player_id is not None:
+            await self.player_service.flush_player_state(self.player_id)
 
     async def send_loon_updates(self):
         """
-        Sends Loon updates to the connected WebSocket client.
+        Sets up the game, opens its session and registers it with the shared
+        scheduler, which then sends Loon updates to the connected WebSocket
+        client every tick.
+        """
+        await self.setup_game()
+        self.sessions.open(self)
+        get_scheduler().register(self)
+
+    async def expire(self, code):
+        """
+        Closes the connection of a session the server ends, idle or shutting down, and cleans the game up.
+
+        Args:
+            code (int): The WebSocket close code.
         """
-        num_loons = 15
-        base_start_point = (800, 500)  # replace with your actual base start point
-        start_point_range = 60
-        end_point = (0, 0)
-        # sending infinite waves till a balloon goes out of
+        if self.socket_open:
+            try:
+                await self.close(code=code)
+            except Exception as e:
+                print(f"An error occurred while closing the websocket connection: {e}")
+        await self.disconnect(code)
+
+    async def setup_game(self):
+        """
+        Sets the difficulty back to its initial values and creates the first wave.
+        """
+        self.wave = 1
+        self.num_loons = 15
+        self.base_start_point = (800, 500)  # replace with your actual base start point
+        self.start_point_range = 60
+        self.end_point = (0, 0)
+        # LOON_DELTA stores the increase in coordinates essentially the speed of the loons
+        # every wave starts over at the base speed
+        self.loon_delta = LoonWave.loon_delta
+        await self.initialize_wave(
+            self.num_loons, self.base_start_point, self.start_point_range, self.end_point
+        )
+
+    async def simulate(self):
+        """
+        Advances the game by one simulation step. Called by the scheduler.
+        """
+        if self.is_game_over or self.transition is not None:
+            return
+
+        self.steps += 1
+        started = self.profiler.clock()
+        self.apply_pops()
+        if self.offloaded():
+            succesful = await self.loon_wave.update_loons_offloaded(self.batch_size)
+        else:
+            succesful = self.loon_wave.update_loons(self.batch_size)
+
+        # a loon went out of bounds
+        if not succesful:
+            self.is_game_over = True
+            self.transition = self.sessions.spawn(self, self.end_game())
+            return
+
+        # the loons the client gets to see, sent by the next frame
+        self.loon_batch = self.loon_wave.active_loons(self.batch_size)
+        self.profiler.record("simulate", started, self.player_id)
+
+        # current wave is over
+        if len(self.loon_batch) == 0:
+            self.transition = self.sessions.spawn(self, self.next_wave())
+            return
+
+        if self.batch_size <= self.num_loons:
+            self.batch_size += self.rng.randint(0, 4)
+
+    def offloaded(self):
+        """
+        Whether the next simulation step runs in the offload process pool. Called by the scheduler.
+
+        Returns:
+            bool: True if the wave is shared with the pool and big enough to be offloaded.
+        """
+        return (
+            isinstance(self.loon_wave, SharedVectorLoonWave)
+            and not self.is_game_over
+            and self.transition is None
+            and self.loon_wave.offloads(self.batch_size)
+        )
+
+    def frame(self):
+        """
+        Builds the frame showing the state of the last simulation step. Called by the scheduler.
+
+        Returns:
+            dict: The loon state to send to the client, or None if there is nothing to send.
+        """
+        if self.is_game_over or self.transition is not None or not self.loon_batch:
+            return None
+
+        started = self.profiler.clock()
+        if self.sync is not None:
+            data = self.sync.frame(self.loon_batch)
+        else:
+            data = self.protocol.loon_state(self.loon_batch)
+        self.profiler.record("serialize", started, self.player_id)
+        return data
+
+    def apply_pops(self):
+        """
+        Removes the loons popped since the last tick from the wave.
+        """
+        if self.recorder is not None and self.pending_pops:
+            self.recorder.pops(self.steps, self.pending_pops)
+        while self.pending_pops:
+            self.loon_wave.remove_loon(self.pending_pops.popleft())
+
+    async def publish(self, data, control=False):
+        """
+        Queues data for the client, disconnecting it if it stopped reading.
+
+        Position frames replace the one still waiting in the queue, if any.
+        Control messages are always delivered, in order.
+
+        Args:
+            data (dict): The data to send.
+            control (bool): True for messages that must not be dropped, False for position frames.
+
+        Returns:
+            bool: True if the data was queued or sent, False if the client is gone.
+        """
+        if self.outbound is None:
+            return await self.send_message(data)
+        if self.outbound.stalled():
+            self.drop_stalled_client()
+            return False
+        return self.outbound.put(data, control)
+
+    def drop_stalled_client(self):
+        """
+        Disconnects a client that stayed behind for longer than the stall timeout.
+        """
+        print(f"Disconnecting stalled client {self.player_id}: {self.outbound.stats()}")
+        STALLED_DISCONNECTS.inc()
+        get_scheduler().unregister(self)
+        self.outbound.close()
+        # closing in the background, the close frame may have to wait behind the stalled ones
+        self.sessions.spawn(self, self.close(code=self.STALLED_CLOSE_CODE))
+
+    async def send_message(self, data):
+        """
+        Sends data to the client, leaving the scheduler if the connection is gone.
+
+        Args:
+            data (dict): The data to send.
+
+        Returns:
+            bool: True if the data was sent, False otherwise.
+        """
+        started = self.profiler.clock()
+        message = self.protocol.encode(data)
+        self.profiler.record("serialize", started, self.player_id)
+        # characters for text frames, which are ASCII JSON
+        FRAME_BYTES.observe(len(message.get("text_data") or message.get("bytes_data")))
+        started = time.perf_counter()
         try:
-            while True:
-                if self.is_game_over:
-                    break
+            await self.send(**message)
+            return True
+        except RuntimeError as e:
+            print(f"An error occurred while sending data, websocket connection closed {e}")
+            get_scheduler().unregister(self)
+            return False
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started)
+            self.profiler.record("send", started, self.player_id)
 
-                await self.initialize_wave(
-                    num_loons, base_start_point, start_point_range, end_point
-                )
-                batch_size = 3
-                while True:
-                    async with self.lock:
-                        succesful = await self.loon_wave.update_loons(batch_size)
-
-                        if not succesful:
-                            self.is_game_over = True
-                            player_service = PlayerService()
-                            player = await player_service.game_over(self.player_id)
-                            data = {"msg": "Game Over", "score": player.score, "coins": player.coins}
-                            try:
-                                await self.send(json.dumps(data))
-                            except RuntimeError as e:
-                                print(f"An error occurred while sending data, websocet connection closed {e}")
-                                break
-
-                        # Prepare data for sending
-                        loon_batch = [
-                            loon for loon in self.loon_wave.loons.values() if loon.active
-                        ][:batch_size]
-
-                        # current wave is over
-                        if len(loon_batch) == 0:
-                            break
-
-                        data = {
-                            "loonState": [
-                                {
-                                    "id": loon.loon_id,
-                                    "type": loon.loon_type.name,
-                                    "position_x": loon.current_pos[0],
-                                    "position_y": loon.current_pos[1],
-                                }
-                                for loon in loon_batch
-                                if loon.active
-                                and loon in (await self.loon_wave.get_loons()).values()
-                            ]
-                        }
-
-                        try:
-                            await self.send(json.dumps(data))
-                        except RuntimeError as e:
-                            print(f"An error occurred while sending data: {e}")
-                            raise WebSocketConnectionClosed()
-
-                        if batch_size <= num_loons:
-                            batch_size += random.randint(0, 4)
-                        # it is crucial to keep this low otherwise state data gets shared. Should be lower than shooting freq
-                        await asyncio.sleep(0.05)  # Update frequency
-
-                # adding 1 score every time a wave is completed
-                # there are multiple ways of increasing coins but for now adding 500 coins after every 10 waves
-                player_service = PlayerService()
-                player_score = await player_service.increase_score(self.player_id, 1)
-                data = {"update": {"score": player_score}}
-                if player_score % 10 == 0:
-                    coins = await player_service.add_coins(self.player_id, 500)
-                    data["update"]["coins"] = str(coins)
-                try:
-                    await self.send(json.dumps(data))
-                except RuntimeError as e:
-                    print(f"An error occurred while sending data: {e}")
-                    raise WebSocketConnectionClosed()
-
-                # increasing difficulty
-                start_point_range += 10
-                num_loons += 5
-                # this essentially increases the movement of the loons
-                self.loon_wave.loon_delta += 1
-        except WebSocketConnectionClosed:
+    async def end_game(self):
+        """
+        Ends the game after a loon escaped and tells the client the final score.
+        """
+        get_scheduler().unregister(self)
+        if self.recorder is not None:
+            self.recorder.end(self.steps, self.wave, "game_over", state_digest(self))
+        self.profiler.event(self.player_id, "game_over", wave=self.wave)
+        player = await self.player_service.game_over(self.player_id)
+        data = {"msg": "Game Over", "score": player.score, "coins": player.coins}
+        await self.publish(data, control=True)
+
+    async def next_wave(self):
+        """
+        Rewards the player for the completed wave and starts a harder one.
+        """
+        # adding 1 score every time a wave is completed
+        # there are multiple ways of increasing coins but for now adding 500 coins after every 10 waves
+        player_score = await self.player_service.increase_score(self.player_id, 1)
+        data = {"update": {"score": player_score}}
+        if player_score % 10 == 0:
+            coins = await self.player_service.add_coins(self.player_id, 500)
+            data["update"]["coins"] = str(coins)
+        if not await self.publish(data, control=True):
             print("Client disconnected")
-            pass
+            return
+
+        # increasing difficulty
+        self.wave += 1
+        self.start_point_range += 10
+        self.num_loons += 5
+        self.profiler.event(self.player_id, "wave", wave=self.wave, loons=self.num_loons)
+        await self.initialize_wave(
+            self.num_loons, self.base_start_point, self.start_point_range, self.end_point
+        )
+        self.transition = None
 
     async def initialize_wave(
         self, num_loons, base_start_point, start_point_range, end_point
@@ -134,70 +385,167 @@ class LoonConsumer(AsyncWebsocketConsumer):
         """
         Initializes a new wave of Loons.
         """
-        self.loon_wave = LoonWave()
+        # the game's wave is reused from one wave to the next so its loons get recycled
+        if self.loon_wave is None:
+            self.loon_wave = self.wave_engine.seeded(self.rng.getrandbits(64))
+        else:
+            self.loon_wave.reset()
+        self.loon_wave.loon_delta = self.loon_delta
+        # loon speeds are scaled to the length of a simulation step
+        self.loon_wave.time_step = self.time_step
+        self.loon_batch = []
+        self.batch_size = 3
+        # pops of the previous wave refer to its loon ids, which the new wave reuses
+        self.pending_pops.clear()
+        # loon ids start over every wave so the client has to start from a keyframe
+        if self.sync is not None:
+            self.sync.reset()
+        if self.recorder is not None:
+            self.recorder.wave(
+                self.steps, self.wave, num_loons, base_start_point, start_point_range, end_point, self.loon_delta
+            )
 
         for i in range(num_loons):
             start_point = [
                 base_start_point[0]
-                + random.uniform(-start_point_range, start_point_range),
+                + self.rng.uniform(-start_point_range, start_point_range),
                 base_start_point[1]
-                + random.uniform(-start_point_range, start_point_range),
+                + self.rng.uniform(-start_point_range, start_point_range),
             ]
             # chosen to use the random way of doing this, which does not guarantee 10% but is more extensible for later
             #instead of just doing 1/10 of num_loons for AdvancedLoons
-            loon_type = random.choices(
+            loon_type = self.rng.choices(
                 [LoonType.BasicLoon, LoonType.AdvancedLoon], weights=[0.9, 0.1], k=1
             )[0]
-            await self.loon_wave.add_loon(start_point, end_point, loon_type.value)
+            self.loon_wave.add_loon(start_point, end_point, loon_type.value)
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Called when a WebSocket frame is received from the client.
 
         Args:
             text_data (str): The received text data.
+            bytes_data (bytes): The received binary data.
         """
-        async with self.lock:
-            try:
-                json_data = json.loads(text_data)
-
-                action = json_data["action"]
-                if action != "popLoon":
-                    return
-
-                loon_id = json_data["loonId"]
-
-                if not self.is_loon_present(loon_id):
-                    await self.send(
-                        text_data=json.dumps(
-                            {"error": "Invalid action: No such loon"}
-                        )
-                    )
-                    return
-
-                if (
-                    "loonLevel" in json_data
-                    and "itemLevel" in json_data
-                    and int(json_data["bulletLevel"])
-                    < int(json_data["bulletLevel"])
-                ):
-                    await self.send(
-                        text_data=json.dumps(
-                            {"error": "Invalid action: Level is not enough"}
-                        )
-                    )
-                    return
-
-                await self.loon_wave.remove_loon(loon_id)
-            except Exception as e:
-                print(f"An error occurred while processing the received data: {e}")
+        # a flooding client is turned away before its frame is even decoded
+        if (self.receive_bucket is not None and not self.receive_bucket.take()) or (
+            self.receive_limiter is not None and not self.receive_limiter.allow(self.player_id)
+        ):
+            await self.reject_rate_limited()
+            return
+        self.rate_limited = False
+
+        started = time.perf_counter()
+        self.sessions.touch(self)
+        try:
+            json_data = self.protocol.decode(text_data, bytes_data)
+
+            action = json_data["action"]
+            if action == "ack" and self.sync is not None:
+                self.sync.ack(int(json_data["seq"]))
+                return
+            if action == "resync" and self.sync is not None:
+                self.sync.resync()
+                return
+            if action == "popLoons":
+                await self.pop_loons(json_data["loonIds"])
+                return
+            if action != "popLoon":
+                return
+
+            loon_id = json_data["loonId"]
+
+            if not self.is_loon_id(loon_id) or not self.is_loon_present(loon_id):
+                await self.publish(
+                    {"error": "Invalid action: No such loon"}, control=True
+                )
+                return
+
+            if (
+                "loonLevel" in json_data
+                and "itemLevel" in json_data
+                and int(json_data["bulletLevel"])
+                < int(json_data["bulletLevel"])
+            ):
+                await self.publish(
+                    {"error": "Invalid action: Level is not enough"}, control=True
+                )
+                return
+
+            # applied by the game loop at the start of the next tick
+            self.pending_pops.append(loon_id)
+        except Exception as e:
+            print(f"An error occurred while processing the received data: {e}")
+        finally:
+            RECEIVE_SECONDS.observe(time.perf_counter() - started)
+            self.profiler.record("receive", started, self.player_id)
+
+    async def reject_rate_limited(self):
+        """
+        Drops a frame over the rate limit, telling the client once per run of dropped frames.
+        """
+        RATE_LIMITED.labels("receive").inc()
+        if not self.rate_limited:
+            self.rate_limited = True
+            await self.publish({"error": "Rate limit exceeded"}, control=True)
+
+    async def pop_loons(self, loon_ids):
+        """
+        Handles a popLoons action, popping several loons with one message.
+
+        Every id is checked against the wave in one pass. The valid ones are
+        queued like single pops, and one message tells the client which ids
+        were accepted and which were rejected.
+
+        A message may carry at most as many ids as the wave has loons, so a
+        client cannot make the server walk an arbitrarily long list.
+
+        Args:
+            loon_ids (list): The IDs of the loons to pop.
+        """
+        if not isinstance(loon_ids, list):
+            await self.publish({"error": "Invalid action: loonIds must be a list"}, control=True)
+            return
+        if len(loon_ids) > self.num_loons:
+            await self.publish({"error": "Invalid action: Too many loonIds"}, control=True)
+            return
+
+        accepted = []
+        rejected = []
+        seen = set()
+        for loon_id in loon_ids:
+            if self.is_loon_id(loon_id) and loon_id not in seen and self.is_loon_present(loon_id):
+                seen.add(loon_id)
+                accepted.append(loon_id)
+            else:
+                rejected.append(loon_id)
+
+        # applied by the game loop at the start of the next tick
+        self.pending_pops.extend(accepted)
+        await self.publish(
+            {"popResult": {"accepted": accepted, "rejected": rejected}}, control=True
+        )
+
+    def query_param(self, name, default=None):
+        """
+        Get a query string parameter of the WebSocket handshake.
+
+        Args:
+            name (str): The name of the parameter.
+            default: The value returned when the parameter is missing.
+        """
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        values = query.get(name)
+        return values[0] if values else default
+
+    def is_loon_id(self, loon_id):
+        """
+        Check if a value sent by the client is a loon ID, an int but not a bool.
+        """
+        return isinstance(loon_id, int) and not isinstance(loon_id, bool)
 
     def is_loon_present(self, loon_id):
         """
         Check if a loon with the given ID is present.
         """
         return self.loon_wave.is_loon_present(loon_id)
-
-
-class WebSocketConnectionClosed(Exception):
-    pass
\ No newline at end of file
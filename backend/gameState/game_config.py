@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+
+from django.conf import settings
+
+
+class GameConfig:
+    """
+    One parsed version of the game config file.
+
+    Attributes:
+        config (dict): The decoded config.
+        serialized (str): The config serialized as compact JSON, ready to embed in responses.
+        etag (str): A quoted ETag identifying this version of the config.
+    """
+
+    def __init__(self, config, serialized, etag):
+        self.config = config
+        self.serialized = serialized
+        self.etag = etag
+
+
+class GameConfigLoader:
+    """
+    Loads the game config file once and reloads it only when its mtime changes.
+
+    Attributes:
+        path (Path): The path of the config file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.current = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the current game config, re-reading the file if it changed on disk.
+
+        Returns:
+            GameConfig: The current config.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.current = self._load()
+                    self.mtime = mtime
+        return self.current
+
+    def _load(self):
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        config = json.loads(raw)
+        serialized = json.dumps(config, separators=(",", ":"))
+        etag = '"{}"'.format(hashlib.sha1(serialized.encode()).hexdigest())
+        return GameConfig(config, serialized, etag)
+
+
+_game_config_loader = None
+
+
+def get_game_config_loader():
+    """
+    Get the process-wide game config loader, creating it on first use.
+
+    Returns:
+        GameConfigLoader: The shared loader.
+    """
+    global _game_config_loader
+    if _game_config_loader is None:
+        _game_config_loader = GameConfigLoader(
+            settings.BASE_DIR / "gameState/config/game_config.json"
+        )
+    return _game_config_loader
@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+
+
+class Leaderboard:
+    """
+    In-memory top-K of player scores, kept up to date by the game loop.
+
+    The board is rebuilt from the database at startup, with one query per
+    status that walks the (status, score) index, and then follows every
+    score increase and game over incrementally, so reads never touch the
+    database. Scores only ever grow, so an update keeps the highest score
+    seen for a player.
+
+    Every change bumps ``version``. The serialized board is cached per
+    version, and its ETag combines the version with the time the board was
+    built, so ETags from before a restart never match.
+
+    Attributes:
+        size (int): The number of players kept on the board.
+        entries (list): (-score, player ID) pairs in rank order.
+        scores (dict): Score and status by player ID, for the players on the board.
+        version (int): Incremented on every change of the board.
+        loaded (bool): Whether the board was built from the database.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = []
+        self.scores = {}
+        self.version = 0
+        self.epoch = int(time.time())
+        self.loaded = False
+        self.cached = None
+        self.lock = threading.Lock()
+
+    def rebuild(self):
+        """
+        Load the top players of every status from the database and merge them into the board.
+        """
+        from .models import Player
+        from .services import Game_States
+
+        for state in Game_States:
+            rows = (
+                Player.objects.filter(status=state.name)
+                .order_by("-score")
+                .values_list("id", "score")[: self.size]
+            )
+            for player_id, score in rows:
+                self.update(player_id, score, state.name)
+        self.loaded = True
+
+    def update(self, player_id, score, status):
+        """
+        Record the score and status of a player.
+
+        Args:
+            player_id (str): The ID of the player.
+            score (int): The player's current score.
+            status (str): The player's game status.
+        """
+        player_id = str(player_id)
+        with self.lock:
+            current = self.scores.get(player_id)
+            if current is not None:
+                if current == (score, status) or current[0] > score:
+                    if current[1] != status:
+                        self.scores[player_id] = (current[0], status)
+                        self.version += 1
+                    return
+                del self.entries[bisect_left(self.entries, (-current[0], player_id))]
+            elif len(self.entries) >= self.size and (-score, player_id) >= self.entries[-1]:
+                return
+
+            insort(self.entries, (-score, player_id))
+            self.scores[player_id] = (score, status)
+            if len(self.entries) > self.size:
+                _, dropped = self.entries.pop()
+                del self.scores[dropped]
+            self.version += 1
+
+    def top(self):
+        """
+        Get the board in rank order.
+
+        Returns:
+            list: One dict per player with its rank, ID, score and status.
+        """
+        with self.lock:
+            return [
+                {
+                    "rank": rank,
+                    "player_id": player_id,
+                    "score": -negative_score,
+                    "status": self.scores[player_id][1],
+                }
+                for rank, (negative_score, player_id) in enumerate(self.entries, 1)
+            ]
+
+    def serialized(self):
+        """
+        Get the board serialized as JSON with its ETag, building it at most once per version.
+
+        Returns:
+            tuple: The JSON body and the quoted ETag.
+        """
+        if not self.loaded:
+            self.rebuild()
+        cached = self.cached
+        if cached is None or cached[0] != self.version:
+            version = self.version
+            body = json.dumps({"version": version, "leaderboard": self.top()}, separators=(",", ":"))
+            cached = self.cached = (version, body, '"{}-{}"'.format(self.epoch, version))
+        return cached[1], cached[2]
+
+
+_leaderboard = None
+
+
+def get_leaderboard():
+    """
+    Get the process-wide leaderboard, creating it on first use.
+
+    Returns:
+        Leaderboard: The shared leaderboard.
+    """
+    global _leaderboard
+    if _leaderboard is None:
+        _leaderboard = Leaderboard(settings.LOON_LEADERBOARD_SIZE)
+    return _leaderboard
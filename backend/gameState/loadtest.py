@@ -0,0 +1,270 @@
+import asyncio
+import json
+import random
+import time
+
+import msgpack
+import numpy as np
+from channels.layers import get_channel_layer
+from channels.worker import Worker
+from django.test import AsyncClient
+
+from .scheduler import get_scheduler
+from .sharding import shard_channel, shard_for
+from .simulation import percentile
+
+
+class LoadSession:
+    """
+    One simulated client playing against the ASGI application in process.
+
+    A session starts a game through StartGameView, opens the loon WebSocket
+    and pops loons it sees with probability ``hit_rate``. When its game ends
+    it starts a new one, until the deadline.
+
+    Attributes:
+        frame_intervals (list): Seconds between two consecutive loon frames.
+        send_latencies (list): Seconds between the server sending a frame and the client receiving it.
+        frames (int): The number of loon frames received.
+        pops (int): The number of popLoon messages sent.
+        games (int): The number of games started.
+        player_ids (list): The player IDs of the games started.
+        errors (int): The number of failed game starts or connections.
+    """
+
+    def __init__(self, application, client, protocol, engine, hit_rate, timeout=5.0):
+        self.application = application
+        self.client = client
+        self.protocol = protocol
+        self.engine = engine
+        self.hit_rate = hit_rate
+        self.timeout = timeout
+        self.frame_intervals = []
+        self.send_latencies = []
+        self.frames = 0
+        self.pops = 0
+        self.games = 0
+        self.player_ids = []
+        self.errors = 0
+
+    async def run(self, deadline):
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            response = await self.client.get("/game/start/")
+            if response.status_code != 200:
+                self.errors += 1
+                await asyncio.sleep(self.timeout)
+                continue
+            self.games += 1
+            player_id = response.json()["player_id"]
+            self.player_ids.append(player_id)
+            await self.play(player_id, deadline)
+
+    async def play(self, player_id, deadline):
+        """
+        Play one game over the WebSocket until it ends or the deadline passes.
+
+        Args:
+            player_id (str): The ID of the player whose game to play.
+            deadline (float): Event loop time at which the session stops.
+        """
+        loop = asyncio.get_running_loop()
+        inputs = asyncio.Queue()
+        outputs = asyncio.Queue()
+
+        async def send(message):
+            # stamping messages so the client can measure how long they waited
+            await outputs.put((time.perf_counter(), message))
+
+        path = "/ws/loonsLocation/{}/".format(player_id)
+        scope = {
+            "type": "websocket",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": "protocol={}&engine={}".format(self.protocol, self.engine).encode(),
+            "headers": [],
+            "subprotocols": [],
+            "client": ("127.0.0.1", 0),
+            "server": ("testserver", 80),
+        }
+        application = asyncio.get_running_loop().create_task(
+            self.application(scope, inputs.get, send)
+        )
+        await inputs.put({"type": "websocket.connect"})
+
+        last_frame = None
+        try:
+            _, message = await asyncio.wait_for(outputs.get(), self.timeout)
+            if message["type"] != "websocket.accept":
+                self.errors += 1
+                return
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return
+                try:
+                    sent_at, message = await asyncio.wait_for(outputs.get(), remaining)
+                except asyncio.TimeoutError:
+                    return
+                received_at = time.perf_counter()
+                if message["type"] == "websocket.close":
+                    return
+                self.send_latencies.append(received_at - sent_at)
+
+                data = self.decode(message)
+                if "msg" in data:
+                    # game over
+                    return
+                if "loonState" not in data:
+                    continue
+
+                self.frames += 1
+                if last_frame is not None:
+                    self.frame_intervals.append(received_at - last_frame)
+                last_frame = received_at
+
+                for loon_id in self.loon_ids(data["loonState"]):
+                    if random.random() < self.hit_rate:
+                        self.pops += 1
+                        await inputs.put(
+                            {
+                                "type": "websocket.receive",
+                                "text": json.dumps({"action": "popLoon", "loonId": loon_id}),
+                            }
+                        )
+        except asyncio.TimeoutError:
+            self.errors += 1
+        finally:
+            await inputs.put({"type": "websocket.disconnect", "code": 1000})
+            try:
+                await asyncio.wait_for(application, self.timeout)
+            except Exception:
+                application.cancel()
+
+    def decode(self, message):
+        if message.get("bytes") is not None:
+            return msgpack.unpackb(message["bytes"])
+        return json.loads(message["text"])
+
+    def loon_ids(self, loon_state):
+        if isinstance(loon_state, dict):
+            return [int(loon_id) for loon_id in np.frombuffer(loon_state["ids"], dtype="<u4")]
+        return [loon["id"] for loon in loon_state]
+
+
+async def stop_games(worker_task, timeout=5.0):
+    """
+    Tear the games of a load test down, so none is left registered with the scheduler.
+
+    The shards get up to ``timeout`` seconds to handle the game.stop the
+    sessions sent when they disconnected before their worker is stopped.
+    Games still registered after that are disconnected here.
+
+    Args:
+        worker_task (asyncio.Task): The task running the shard workers, None when not sharded.
+        timeout (float): Most seconds to wait for the shards.
+    """
+    loop = asyncio.get_running_loop()
+    if worker_task is not None:
+        deadline = loop.time() + timeout
+        while get_scheduler().games and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        worker_task.cancel()
+    for game in list(get_scheduler().games):
+        try:
+            await game.disconnect(1000)
+        except Exception as e:
+            print(f"An error occurred while stopping the game of {game.player_id}: {e}")
+            get_scheduler().unregister(game)
+
+
+async def run_load_test(
+    application, sessions, duration, ramp_up=5.0, protocol="json", engine="python", hit_rate=0.1, shards=0
+):
+    """
+    Run concurrent game sessions against the ASGI application and measure them.
+
+    Args:
+        application: The ASGI application, loonsTd.asgi.application.
+        sessions (int): The number of concurrent sessions.
+        duration (float): Seconds to keep the sessions running after the ramp up.
+        ramp_up (float): Seconds over which the session starts are spread.
+        protocol (str): The wire protocol the sessions negotiate.
+        engine (str): The wave engine the sessions ask for.
+        hit_rate (float): Probability that a session pops a loon it sees.
+        shards (int): The number of shards, whose workers run in this event loop, 0 when not sharded.
+
+    Returns:
+        dict: The load test report.
+    """
+    loop = asyncio.get_running_loop()
+    client = AsyncClient()
+    load_sessions = [
+        LoadSession(application, client, protocol, engine, hit_rate) for _ in range(sessions)
+    ]
+    deadline = loop.time() + ramp_up + duration
+    worker_task = None
+    if shards:
+        # stand-in for the runshard processes, listening on the in-memory channel layer
+        worker = Worker(application, [shard_channel(shard) for shard in range(shards)], get_channel_layer())
+        worker_task = loop.create_task(worker.arun())
+
+    async def start(session, delay):
+        await asyncio.sleep(delay)
+        await session.run(deadline)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            start(session, ramp_up * number / sessions)
+            for number, session in enumerate(load_sessions)
+        )
+    )
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    await stop_games(worker_task)
+    # games started per shard, showing how evenly new games were placed
+    shard_games = [0] * shards
+    if shards:
+        for session in load_sessions:
+            for player_id in session.player_ids:
+                shard_games[shard_for(player_id, shards)] += 1
+
+    # frames go out every send interval, which only goes up when the server cannot keep up
+    send_interval = get_scheduler().base_send_interval
+    intervals = sorted(
+        interval for session in load_sessions for interval in session.frame_intervals
+    )
+    jitter = sorted(abs(interval - send_interval) for interval in intervals)
+    latencies = sorted(
+        latency for session in load_sessions for latency in session.send_latencies
+    )
+    return {
+        "sessions": sessions,
+        "duration": duration,
+        "protocol": protocol,
+        "engine": engine,
+        "hit_rate": hit_rate,
+        "shards": shards,
+        "elapsed": elapsed,
+        "games": sum(session.games for session in load_sessions),
+        "errors": sum(session.errors for session in load_sessions),
+        "frames": sum(session.frames for session in load_sessions),
+        "frames_per_second": sum(session.frames for session in load_sessions) / elapsed,
+        "pops": sum(session.pops for session in load_sessions),
+        "frame_interval_p50": percentile(intervals, 0.5),
+        "frame_interval_p99": percentile(intervals, 0.99),
+        "jitter_p50": percentile(jitter, 0.5),
+        "jitter_p99": percentile(jitter, 0.99),
+        "jitter_max": jitter[-1] if jitter else 0.0,
+        "send_latency_p50": percentile(latencies, 0.5),
+        "send_latency_p99": percentile(latencies, 0.99),
+        "send_latency_max": latencies[-1] if latencies else 0.0,
+        # the clients run in the same process, so this is an upper bound of the server's share
+        "cpu_seconds": cpu,
+        "cpu_utilization": cpu / elapsed,
+        "scheduler": get_scheduler().status(),
+        "shard_games": shard_games,
+    }
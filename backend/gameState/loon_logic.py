@@ -1,8 +1,14 @@
 import random
-import asyncio
+import sys
 from enum import Enum
+from itertools import islice
+
+import numpy as np
 
 class Loon:
+    # loons are created by the hundred every wave, slots keep them small and free of a __dict__
+    __slots__ = ("loon_id", "current_pos", "end_pos", "active", "loon_level")
+
     def __init__(self, loon_id, start_pos, end_pos, loon_type_value):
         """
         Initialize a Loon object.
@@ -11,41 +17,50 @@ class Loon:
             loon_id (int): The ID of the loon.
             start_pos (tuple): The starting position of the loon (x, y).
             end_pos (tuple): The ending position of the loon (x, y).
+            loon_type_value (int): The LoonType value of the loon.
+        """
+        self.reset(loon_id, start_pos, end_pos, loon_type_value)
+
+    def reset(self, loon_id, start_pos, end_pos, loon_type_value):
+        """
+        Reinitialize the loon, so a pooled Loon object can be reused for a new loon.
         """
         self.loon_id = loon_id
         self.current_pos = start_pos
         self.end_pos = end_pos
         self.active = True
-        self.lock = asyncio.Lock()
-        self.loon_type = LoonType(loon_type_value)
+        # the type is kept as its small int value, loon_type maps it back to the enum
         self.loon_level = loon_type_value
 
-    async def move(self, delta_x, delta_y):
+    @property
+    def loon_type(self):
+        return LOON_TYPES[self.loon_level]
+
+    def move(self, delta_x, delta_y):
         """
         Move the loon by the specified deltas.
 
         Args:
-            delta_x (int): The change in x-coordinate.
-            delta_y (int): The change in y-coordinate.
+            delta_x (float): The change in x-coordinate.
+            delta_y (float): The change in y-coordinate.
 
         Returns:
             bool: True if the loon is still active after moving, False otherwise.
         """
-        async with self.lock:
-            self.current_pos = (
-                self.current_pos[0] - delta_x,
-                self.current_pos[1] - delta_y,
-            )
-            # marking inactive if out of bounds
-            if (
-                self.current_pos[0] < self.end_pos[0]
-                or self.current_pos[1] < self.end_pos[1]
-            ):
-                self.active = False
-                return False
-            else:
-                return True
-        
+        self.current_pos = (
+            self.current_pos[0] - delta_x,
+            self.current_pos[1] - delta_y,
+        )
+        # marking inactive if out of bounds
+        if (
+            self.current_pos[0] < self.end_pos[0]
+            or self.current_pos[1] < self.end_pos[1]
+        ):
+            self.active = False
+            return False
+        else:
+            return True
+
     def __repr__(self):
         return f"Loon(id={self.loon_id}, active={self.active})\n"
 
@@ -53,24 +68,73 @@ class LoonType(Enum):
     BasicLoon = 1
     AdvancedLoon = 2
 
-import asyncio
-import copy
-import random
+
+# LoonType by value, faster than calling LoonType(value)
+LOON_TYPES = {loon_type.value: loon_type for loon_type in LoonType}
+
 
 class LoonWave:
+    """
+    A wave of loons.
+
+    A wave has a single writer, the game loop of the game it belongs to, and
+    is only ever touched from the event loop, so it takes no locks.
+
+    A game keeps one LoonWave and calls reset() between waves. Removed loons
+    go back to a pool and are reused by later add_loon calls instead of
+    allocating new Loon objects every wave.
+
+    ``loons`` is the index of live loons: a dict keeps them in spawn order,
+    removes them by id in O(1), and batch() walks only its first entries, so
+    a tick costs O(batch) whatever the size of the wave.
+
+    Movement is scaled by ``time_step``, the simulated seconds one
+    update_loons call stands for, so loons cover the same distance per
+    second whatever the length of the simulation step.
+
+    Movement is drawn from the wave's own ``rng``, so a wave built with
+    seeded() moves the same way every time.
+    """
+
+    name = "python"
+
     # LOON_DELTA stores the increase in coordinates essentially the speed of the loons
+    # it is the most a loon moves per coordinate in REFERENCE_STEP seconds
     loon_delta = 2
+    REFERENCE_STEP = 0.05
+    time_step = REFERENCE_STEP
 
-    def __init__(self):
+    def __init__(self, rng=None):
         self.loons = {}
         self.next_loon_id = 0
-        self.lock = asyncio.Lock()
+        self.pool = []
+        self.rng = rng if rng is not None else random.Random()
 
-    async def get_loons(self):
-        async with self.lock:
-            return self.loons
+    @classmethod
+    def seeded(cls, seed):
+        """
+        Create a wave whose movement is drawn from a random stream seeded with ``seed``.
 
-    async def add_loon(self, start_pos, end_pos, loon_type_value):
+        Args:
+            seed (int): The seed of the wave's random stream.
+
+        Returns:
+            LoonWave: The new wave.
+        """
+        return cls(random.Random(seed))
+
+    def reset(self):
+        """
+        Empty the wave for the next one, recycling all its loons.
+        """
+        self.pool.extend(self.loons.values())
+        self.loons.clear()
+        self.next_loon_id = 0
+
+    def get_loons(self):
+        return self.loons
+
+    def add_loon(self, start_pos, end_pos, loon_type_value):
         """
         Add a new loon to the wave.
 
@@ -78,53 +142,76 @@ class LoonWave:
             start_pos (tuple): The starting position of the loon.
             end_pos (tuple): The ending position of the loon.
         """
-        async with self.lock:
+        if self.pool:
+            loon = self.pool.pop()
+            loon.reset(self.next_loon_id, start_pos, end_pos, loon_type_value)
+        else:
             loon = Loon(self.next_loon_id, start_pos, end_pos, loon_type_value)
-            self.loons[self.next_loon_id] = loon
-            self.next_loon_id += 1
+        self.loons[self.next_loon_id] = loon
+        self.next_loon_id += 1
 
-    async def size(self):
+    def size(self):
         """
         Get the number of loons in the wave.
 
         Returns:
             int: The number of loons.
         """
-        async with self.lock:
-            return len(self.loons)
+        return len(self.loons)
 
-    async def remove_loon(self, loon_id):
+    def remove_loon(self, loon_id):
         """
         Remove a loon from the wave.
 
         Args:
             loon_id (int): The ID of the loon to remove.
         """
-        async with self.lock:
-            if loon_id in self.loons:
-                self.loons[loon_id].active = False
-                del self.loons[loon_id]
+        loon = self.loons.pop(loon_id, None)
+        if loon is not None:
+            loon.active = False
+            self.pool.append(loon)
+
+    def batch(self, batch_size):
+        """
+        Get the first loons of the wave in spawn order.
+
+        Args:
+            batch_size (int): The number of loons to get.
+
+        Returns:
+            list: Up to batch_size loons.
+        """
+        return list(islice(self.loons.values(), batch_size))
+
+    def active_loons(self, batch_size):
+        """
+        Get the active loons among the first batch_size loons of the wave.
 
-    async def update_loons(self, batch_size):
+        Args:
+            batch_size (int): The number of loons to look at.
+
+        Returns:
+            list: The active loons.
+        """
+        return [loon for loon in islice(self.loons.values(), batch_size) if loon.active]
+
+    def update_loons(self, batch_size):
         """
         Update the positions of the loons in the wave.
 
         Args:
             batch_size (int): The number of loons to update in each batch.
         """
-        loons_batch = list(self.loons.keys())[:batch_size]
-        # print(" current batch " + str(loons_batch))
-        for loon_id in loons_batch:
-            # locking here so that we are sure we are only showing a loon that is active
-            async with self.lock:
-                if not self.loons[loon_id].active:
-                    continue
-                delta_x, delta_y = random.randint(0, self.loon_delta), random.randint(
-                    0, self.loon_delta
-                )
-                # returns false if any loon goes out of bounds
-                if not await self.loons[loon_id].move(delta_x, delta_y):
-                    return False
+        scale = self.time_step / self.REFERENCE_STEP
+        for loon in self.batch(batch_size):
+            if not loon.active:
+                continue
+            delta_x, delta_y = self.rng.randint(0, self.loon_delta), self.rng.randint(
+                0, self.loon_delta
+            )
+            # returns false if any loon goes out of bounds
+            if not loon.move(delta_x * scale, delta_y * scale):
+                return False
 
         return True
 
@@ -132,4 +219,287 @@ class LoonWave:
         """
         Check if a loon with the given ID is present.
         """
-        return loon_id in self.loons
\ No newline at end of file
+        return loon_id in self.loons
+
+    def memory_usage(self):
+        """
+        Estimate the memory held by the wave, pooled loons included.
+
+        Returns:
+            int: The estimated size in bytes.
+        """
+        return (
+            sys.getsizeof(self.loons)
+            + sys.getsizeof(self.pool)
+            + (len(self.loons) + len(self.pool)) * LOON_BYTES
+        )
+
+
+# a Loon with its position tuple and the two floats in it, the end position is shared by the wave
+LOON_BYTES = (
+    sys.getsizeof(Loon(0, (0.0, 0.0), (0.0, 0.0), 1)) + sys.getsizeof((0.0, 0.0)) + 2 * sys.getsizeof(0.0)
+)
+
+
+class VectorLoon:
+    """
+    Read-only view of a single loon stored in a VectorLoonWave.
+
+    Exposes the same attributes as Loon so callers building frames do not
+    need to know which engine the wave is running on.
+    """
+
+    __slots__ = ("wave", "slot", "loon_id")
+
+    def __init__(self, wave, slot, loon_id):
+        self.wave = wave
+        self.slot = slot
+        self.loon_id = loon_id
+
+    @property
+    def current_pos(self):
+        x, y = self.wave.positions[self.slot]
+        return (float(x), float(y))
+
+    @property
+    def end_pos(self):
+        x, y = self.wave.end_positions[self.slot]
+        return (float(x), float(y))
+
+    @property
+    def active(self):
+        return bool(self.wave.active[self.slot])
+
+    @property
+    def loon_level(self):
+        return int(self.wave.loon_types[self.slot])
+
+    @property
+    def loon_type(self):
+        return LOON_TYPES[self.loon_level]
+
+    def __repr__(self):
+        return f"VectorLoon(id={self.loon_id}, active={self.active})\n"
+
+
+class VectorLoonWave:
+    """
+    LoonWave engine backed by struct-of-arrays NumPy buffers.
+
+    Positions, loon types and the active/present flags live in flat arrays
+    indexed by slot, so a tick draws all deltas in one RNG call and does the
+    escape check as a single vectorized comparison. The public API matches
+    LoonWave, and ``loons`` still maps loon ids to loon views. Like LoonWave it
+    has a single writer and takes no locks.
+    """
+
+    name = "vector"
+
+    # LOON_DELTA stores the increase in coordinates essentially the speed of the loons
+    loon_delta = 2
+    REFERENCE_STEP = LoonWave.REFERENCE_STEP
+    time_step = REFERENCE_STEP
+    initial_capacity = 32
+
+    def __init__(self, rng=None):
+        self.loons = {}
+        self.next_loon_id = 0
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.count = 0
+        # loon views by slot, kept across waves like the buffers
+        self.views = []
+        self._allocate(self.initial_capacity)
+
+    @classmethod
+    def seeded(cls, seed):
+        """
+        Create a wave whose movement is drawn from a random stream seeded with ``seed``.
+
+        Args:
+            seed (int): The seed of the wave's random stream.
+
+        Returns:
+            VectorLoonWave: The new wave.
+        """
+        return cls(np.random.default_rng(seed))
+
+    def reset(self):
+        """
+        Empty the wave for the next one, keeping the buffers and loon views for reuse.
+        """
+        self.active[: self.count] = False
+        self.present[: self.count] = False
+        self.loons.clear()
+        self.count = 0
+        self.next_loon_id = 0
+
+    def _allocate(self, capacity):
+        """
+        Allocate (or grow) the slot buffers to the given capacity.
+        """
+        positions = np.zeros((capacity, 2), dtype=np.float64)
+        end_positions = np.zeros((capacity, 2), dtype=np.float64)
+        loon_types = np.zeros(capacity, dtype=np.int8)
+        active = np.zeros(capacity, dtype=bool)
+        present = np.zeros(capacity, dtype=bool)
+        if self.count:
+            positions[: self.count] = self.positions[: self.count]
+            end_positions[: self.count] = self.end_positions[: self.count]
+            loon_types[: self.count] = self.loon_types[: self.count]
+            active[: self.count] = self.active[: self.count]
+            present[: self.count] = self.present[: self.count]
+        self.positions = positions
+        self.end_positions = end_positions
+        self.loon_types = loon_types
+        self.active = active
+        self.present = present
+
+    def get_loons(self):
+        return self.loons
+
+    def add_loon(self, start_pos, end_pos, loon_type_value):
+        """
+        Add a new loon to the wave.
+
+        Args:
+            start_pos (tuple): The starting position of the loon.
+            end_pos (tuple): The ending position of the loon.
+            loon_type_value (int): The LoonType value of the loon.
+        """
+        if self.count == len(self.present):
+            self._allocate(2 * len(self.present))
+        slot = self.count
+        self.positions[slot] = start_pos
+        self.end_positions[slot] = end_pos
+        self.loon_types[slot] = LOON_TYPES[loon_type_value].value
+        self.active[slot] = True
+        self.present[slot] = True
+        if slot < len(self.views):
+            view = self.views[slot]
+            view.loon_id = self.next_loon_id
+        else:
+            view = VectorLoon(self, slot, self.next_loon_id)
+            self.views.append(view)
+        self.loons[self.next_loon_id] = view
+        self.count += 1
+        self.next_loon_id += 1
+
+    def size(self):
+        """
+        Get the number of loons in the wave.
+
+        Returns:
+            int: The number of loons.
+        """
+        return len(self.loons)
+
+    def remove_loon(self, loon_id):
+        """
+        Remove a loon from the wave.
+
+        Args:
+            loon_id (int): The ID of the loon to remove.
+        """
+        loon = self.loons.pop(loon_id, None)
+        if loon is not None:
+            self.active[loon.slot] = False
+            self.present[loon.slot] = False
+
+    def batch(self, batch_size):
+        """
+        Get the first loons of the wave in spawn order.
+
+        Args:
+            batch_size (int): The number of loons to get.
+
+        Returns:
+            list: Up to batch_size loon views.
+        """
+        return list(islice(self.loons.values(), batch_size))
+
+    def active_loons(self, batch_size):
+        """
+        Get the active loons among the first batch_size loons of the wave.
+
+        Args:
+            batch_size (int): The number of loons to look at.
+
+        Returns:
+            list: The active loon views.
+        """
+        active = self.active
+        return [loon for loon in islice(self.loons.values(), batch_size) if active[loon.slot]]
+
+    def update_loons(self, batch_size):
+        """
+        Update the positions of the first batch_size loons in the wave.
+
+        Args:
+            batch_size (int): The number of loons to update in each batch.
+
+        Returns:
+            bool: False if any loon in the batch went out of bounds, True otherwise.
+        """
+        batch = np.fromiter(
+            (loon.slot for loon in islice(self.loons.values(), batch_size)),
+            dtype=np.intp,
+        )
+        batch = batch[self.active[batch]]
+        if len(batch) == 0:
+            return True
+
+        deltas = self.rng.integers(0, self.loon_delta, size=(len(batch), 2), endpoint=True)
+        self.positions[batch] -= deltas * (self.time_step / self.REFERENCE_STEP)
+
+        # marking inactive if out of bounds
+        escaped = (self.positions[batch] < self.end_positions[batch]).any(axis=1)
+        if escaped.any():
+            self.active[batch[escaped]] = False
+            return False
+        return True
+
+    def is_loon_present(self, loon_id):
+        """
+        Check if a loon with the given ID is present.
+        """
+        return loon_id in self.loons
+
+    def memory_usage(self):
+        """
+        Estimate the memory held by the wave, its buffers and loon views included.
+
+        Returns:
+            int: The estimated size in bytes.
+        """
+        buffers = (self.positions, self.end_positions, self.loon_types, self.active, self.present)
+        return (
+            sys.getsizeof(self.loons)
+            + sum(buffer.nbytes for buffer in buffers)
+            + sum(map(sys.getsizeof, self.views))
+        )
+
+
+# engines a game can run its waves on, selected per game by name
+WAVE_ENGINES = {
+    "python": LoonWave,
+    "vector": VectorLoonWave,
+}
+
+
+def get_wave_engine(name):
+    """
+    Look up a wave engine class by name.
+
+    Args:
+        name (str): The engine name, one of WAVE_ENGINES.
+
+    Returns:
+        type: The LoonWave compatible class for the engine.
+
+    Raises:
+        ValueError: If no engine with the given name exists.
+    """
+    try:
+        return WAVE_ENGINES[name]
+    except KeyError:
+        raise ValueError("Wave engine {} does not exist".format(name))
@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from gameState.simulation import bench_offload
+
+
+class Command(BaseCommand):
+    help = ("Time vector wave steps run in process against steps offloaded to the process pool, "
+            "to find the LOON_OFFLOAD_THRESHOLD where offloading pays off.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 10000, 50000, 100000])
+        parser.add_argument("--games", type=int, default=4, help="Number of waves stepped per tick.")
+        parser.add_argument("--ticks", type=int, default=200)
+        parser.add_argument("--workers", type=int, default=None, help="Processes in the pool, LOON_OFFLOAD_WORKERS by default.")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options["workers"]:
+            overrides["LOON_OFFLOAD_WORKERS"] = options["workers"]
+        with override_settings(**overrides):
+            results = asyncio.run(bench_offload(options["sizes"], options["games"], options["ticks"]))
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write("{:>10} {:>20} {:>20} {:>22}".format(
+            "size", "in process (us)", "offloaded (us)", "offloaded loop (us)"))
+        for result in results:
+            self.stdout.write("{:>10} {:>20.1f} {:>20.1f} {:>22.1f}".format(
+                result["size"], 1e6 * result["in_process_tick"], 1e6 * result["offloaded_tick"],
+                1e6 * result["offloaded_loop_cpu"]))
+        crossover = next(
+            (result["size"] for result in results if result["offloaded_loop_cpu"] < result["in_process_tick"]),
+            None,
+        )
+        if crossover is None:
+            self.stdout.write("Offloading did not pay off at any of these sizes")
+        else:
+            self.stdout.write("Offloading frees the event loop from {} loons per game".format(crossover))
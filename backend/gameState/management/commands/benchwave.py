@@ -0,0 +1,29 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from gameState.loon_logic import WAVE_ENGINES
+from gameState.simulation import bench_wave_sizes
+
+
+class Command(BaseCommand):
+    help = "Show how the per-tick cost of a wave scales with the number of loons in it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--engine", choices=sorted(WAVE_ENGINES), default="python")
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+        parser.add_argument("--batch-size", type=int, default=20)
+        parser.add_argument("--ticks", type=int, default=1000)
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        results = bench_wave_sizes(
+            options["engine"], options["sizes"], options["batch_size"], options["ticks"]
+        )
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        self.stdout.write("{:>10} {:>18} {:>22}".format("size", "indexed tick (us)", "full scan frame (us)"))
+        for result in results:
+            self.stdout.write("{:>10} {:>18.2f} {:>22.2f}".format(
+                result["size"], 1e6 * result["indexed_tick"], 1e6 * result["full_scan_frame"]))
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from gameState.loadtest import run_load_test
+from gameState.loon_logic import WAVE_ENGINES
+from gameState.protocol import PROTOCOLS
+
+
+class Command(BaseCommand):
+    help = ("Open concurrent game sessions against the ASGI application in process, "
+            "using the in-memory channel layer, and report frame jitter, send latency and CPU.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=100, help="Number of concurrent sessions.")
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run after the ramp up.")
+        parser.add_argument("--ramp-up", type=float, default=5.0, help="Seconds over which sessions start.")
+        parser.add_argument("--hit-rate", type=float, default=0.1,
+                            help="Probability that a session pops a loon it sees.")
+        parser.add_argument("--engine", choices=sorted(WAVE_ENGINES), default="python")
+        parser.add_argument("--protocol", choices=sorted(PROTOCOLS), default="json")
+        parser.add_argument("--shards", type=int, default=0,
+                            help="Run games on this many shards, with their workers in process.")
+        parser.add_argument("--output", help="Append the report as a JSON line to this file.")
+        parser.add_argument("--keep-players", action="store_true",
+                            help="Create the players in the configured database instead of a throwaway one.")
+
+    def handle(self, *args, **options):
+        # the load test's players go to a throwaway test database, dropped when it ends
+        database_name = None
+        if not options["keep_players"]:
+            database_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        channel_layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+        try:
+            with override_settings(
+                CHANNEL_LAYERS=channel_layers,
+                ALLOWED_HOSTS=["testserver"],
+                LOON_SHARDS=options["shards"],
+                # thousands of short games would flood the replay directory
+                LOON_REPLAY_DIR=None,
+            ):
+                from loonsTd.asgi import application
+
+                report = asyncio.run(
+                    run_load_test(
+                        application,
+                        options["sessions"],
+                        options["duration"],
+                        ramp_up=options["ramp_up"],
+                        protocol=options["protocol"],
+                        engine=options["engine"],
+                        hit_rate=options["hit_rate"],
+                        shards=options["shards"],
+                    )
+                )
+        finally:
+            if database_name is not None:
+                connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        if options["output"]:
+            with open(options["output"], "a") as f:
+                f.write(json.dumps({"timestamp": time.time(), **report}) + "\n")
+        for key, value in report.items():
+            if isinstance(value, float):
+                value = "{:.6g}".format(value)
+            self.stdout.write("{:<24} {}".format(key, value))
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gameState.replay import ReplayError, ReplayLog, find_logs, replay_game
+
+
+class Command(BaseCommand):
+    help = "Re-run recorded games from their replay logs at full speed and check they end in the recorded state."
+
+    def add_arguments(self, parser):
+        parser.add_argument("logs", nargs="+", help="Replay log files (.loonreplay), or directories holding them.")
+        parser.add_argument("--json", action="store_true", help="Print one JSON report per log.")
+
+    def handle(self, *args, **options):
+        logs = find_logs(options["logs"])
+        if not logs:
+            raise CommandError("No replay logs found in {}".format(", ".join(options["logs"])))
+        mismatches = 0
+        for path in logs:
+            try:
+                report = asyncio.run(replay_game(ReplayLog.read(path)))
+            except (OSError, ReplayError) as e:
+                report = {"matched": False, "error": str(e)}
+            report = {"log": path, **report}
+            if not report["matched"]:
+                mismatches += 1
+
+            if options["json"]:
+                self.stdout.write(json.dumps(report))
+                continue
+            for key, value in report.items():
+                if isinstance(value, float):
+                    value = "{:.6g}".format(value)
+                self.stdout.write("{:<30} {}".format(key, value))
+            self.stdout.write("")
+
+        if mismatches:
+            raise CommandError("{} of {} replays did not match".format(mismatches, len(logs)))
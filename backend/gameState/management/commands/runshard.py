@@ -0,0 +1,9 @@
+from channels.management.commands import runworker
+
+from gameState.sharding import ShardWorker
+
+
+class Command(runworker.Command):
+    help = ("Run shard workers on the given channels (loon-shard-<n>), draining their games on SIGINT or SIGTERM "
+            "so every client is closed and every player's state is written back.")
+    worker_class = ShardWorker
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+
+from gameState.loon_logic import WAVE_ENGINES
+from gameState.protocol import PROTOCOLS
+from gameState.simulation import run_simulation
+
+
+class Command(BaseCommand):
+    help = "Play games headless through the LoonConsumer game loop and report ticks/sec and tick latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=100, help="Number of games to play.")
+        parser.add_argument("--waves", type=int, default=None, help="Stop each game after this many waves.")
+        parser.add_argument("--start-wave", type=int, default=1, help="Start every game at this wave.")
+        parser.add_argument("--hit-rate", type=float, default=0.1,
+                            help="Probability that a visible loon gets popped on a tick.")
+        parser.add_argument("--engine", choices=sorted(WAVE_ENGINES), default="python")
+        parser.add_argument("--protocol", choices=sorted(PROTOCOLS), default="json")
+        parser.add_argument("--send-every", type=int, default=1,
+                            help="Send a frame every this many ticks, the game plays out the same at any rate.")
+        parser.add_argument("--seed", type=int, default=None, help="Seed for comparable runs.")
+        parser.add_argument("--record", metavar="DIR", default=None,
+                            help="Write the replay log of every game to this directory.")
+        parser.add_argument("--trace-malloc", action="store_true", help="Also report peak traced memory.")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        report = asyncio.run(
+            run_simulation(
+                options["games"],
+                engine=options["engine"],
+                protocol=options["protocol"],
+                hit_rate=options["hit_rate"],
+                max_waves=options["waves"],
+                seed=options["seed"],
+                trace_malloc=options["trace_malloc"],
+                start_wave=options["start_wave"],
+                send_every=options["send_every"],
+                replay_dir=options["record"],
+            )
+        )
+        if options["json"]:
+            self.stdout.write(json.dumps(report))
+            return
+        for key, value in report.items():
+            if isinstance(value, float):
+                value = "{:.6g}".format(value)
+            self.stdout.write("{:<30} {}".format(key, value))
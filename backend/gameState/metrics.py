@@ -0,0 +1,355 @@
+import abc
+import functools
+import threading
+import time
+from bisect import bisect_left
+
+from asgiref.sync import sync_to_async
+
+from .profiling import get_profiler
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BYTES_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in pairs) + "}"
+
+
+class Metric(abc.ABC):
+    """
+    Base class of the metrics, with optional labels.
+
+    Updates are plain arithmetic under a lock that is only ever held for a
+    few instructions. They never await, so they are safe to call from the
+    event loop, and the lock covers the DB timings made in worker threads.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        labelnames (tuple): The label names, empty for an unlabelled metric.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        """
+        Get the child metric for the given label values, creating it on first use.
+        """
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, self._child())
+        return child
+
+    @abc.abstractmethod
+    def _child(self):
+        """
+        Create an unlabelled metric of the same type, for one set of label values.
+        """
+
+    @abc.abstractmethod
+    def _render(self, name, labelnames, labelvalues):
+        """
+        Render the sample lines of this metric under the given labels.
+        """
+
+    def _samples(self):
+        if self.labelnames:
+            return list(self.children.items())
+        return [((), self)]
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for labelvalues, child in self._samples():
+            lines.extend(child._render(self.name, self.labelnames, labelvalues))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+
+    def _child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def _render(self, name, labelnames, labelvalues):
+        return ["{}{} {}".format(name, _format_labels(labelnames, labelvalues), self.value)]
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. A gauge built with a function is computed
+    when the metrics are scraped instead of being updated on the hot path.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0
+        self.function = function
+
+    def _child(self):
+        return Gauge(self.name, self.documentation)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def _render(self, name, labelnames, labelvalues):
+        value = self.function() if self.function is not None else self.value
+        return ["{}{} {}".format(name, _format_labels(labelnames, labelvalues), value)]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def _render(self, name, labelnames, labelvalues):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            labels = _format_labels(labelnames, labelvalues, [("le", bound)])
+            lines.append("{}_bucket{} {}".format(name, labels, cumulative))
+        labels = _format_labels(labelnames, labelvalues)
+        lines.append("{}_sum{} {}".format(name, labels, self.sum))
+        lines.append("{}_count{} {}".format(name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """
+    The metrics exposed by this process.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+TICK_SECONDS = registry.register(
+    Histogram("loons_tick_duration_seconds", "Time to simulate one tick of one game.")
+)
+SCHEDULER_TICK_SECONDS = registry.register(
+    Histogram("loons_scheduler_tick_duration_seconds", "Time to run one scheduler tick over all games.")
+)
+SEND_SECONDS = registry.register(
+    Histogram("loons_send_duration_seconds", "Time spent in LoonConsumer.send.")
+)
+FRAME_BYTES = registry.register(
+    Histogram("loons_frame_bytes", "Size of the frames sent to clients.", buckets=BYTES_BUCKETS)
+)
+RECEIVE_SECONDS = registry.register(
+    Histogram("loons_receive_duration_seconds", "Time to handle one frame received from a client.")
+)
+DB_SECONDS = registry.register(
+    Histogram("loons_db_call_duration_seconds", "Time spent in PlayerService database calls.", ["method"])
+)
+SYNC_TO_ASYNC_WAIT_SECONDS = registry.register(
+    Histogram("loons_sync_to_async_wait_seconds", "Time a sync_to_async call waits before its thread runs it.")
+)
+OPEN_SOCKETS = registry.register(
+    Gauge("loons_open_sockets", "Open loon WebSocket connections.")
+)
+SEND_LAG_SECONDS = registry.register(
+    Histogram("loons_send_lag_seconds", "Time a message waited in its connection's outbound queue before it was sent.")
+)
+FRAMES_COALESCED = registry.register(
+    Counter("loons_frames_coalesced_total", "Stale position frames replaced by a newer one before they were sent.")
+)
+PUBLISH_ERRORS = registry.register(
+    Counter("loons_publish_errors_total", "Frames the scheduler failed to publish, dropping their game.")
+)
+STALLED_DISCONNECTS = registry.register(
+    Counter("loons_stalled_disconnects_total", "Clients disconnected for not reading their frames.")
+)
+RATE_LIMITED = registry.register(
+    Counter("loons_rate_limited_total", "Frames and requests rejected by the rate limits and the admission cap.",
+            ["scope"])
+)
+FLUSH_SECONDS = registry.register(
+    Histogram("loons_player_flush_duration_seconds",
+              "Time to write back the pending score and coins of the player cache.")
+)
+FLUSH_PLAYERS = registry.register(
+    Histogram("loons_player_flush_players", "Player rows written by one player cache flush.",
+              buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+)
+CATALOG_LOOKUPS = registry.register(
+    Counter("loons_item_catalog_lookups_total", "Item lookups served from the in-process catalog or loading it.",
+            ["result"])
+)
+OFFLOAD_SECONDS = registry.register(
+    Histogram("loons_offload_duration_seconds", "Time for a wave step run in the process pool, round trip included.")
+)
+
+
+def _active_games():
+    from .scheduler import get_scheduler
+
+    return len(get_scheduler().games)
+
+
+def _active_loons():
+    from .scheduler import get_scheduler
+
+    return sum(game.loon_wave.size() for game in list(get_scheduler().games) if game.loon_wave is not None)
+
+
+def _max_send_lag():
+    from .scheduler import get_scheduler
+
+    lags = [game.outbound.lag() for game in list(get_scheduler().games) if game.outbound is not None]
+    return max(lags, default=0.0)
+
+
+def _live_sessions():
+    from .sessions import get_session_registry
+
+    return len(get_session_registry().sessions)
+
+
+def _cancelled_tasks():
+    from .sessions import get_session_registry
+
+    return len(get_session_registry().cancelled)
+
+
+def _unreleased_games():
+    from .sessions import get_session_registry
+
+    return len(get_session_registry().closed_games)
+
+
+# computed when scraped, so the game loop pays nothing for them
+ACTIVE_GAMES = registry.register(
+    Gauge("loons_active_games", "Games advanced by the scheduler.", function=_active_games)
+)
+ACTIVE_LOONS = registry.register(
+    Gauge("loons_active_loons", "Loons left in the waves of the active games.", function=_active_loons)
+)
+MAX_SEND_LAG = registry.register(
+    Gauge("loons_max_send_lag_seconds", "Highest current outbound lag among the connections.", function=_max_send_lag)
+)
+LIVE_SESSIONS = registry.register(
+    Gauge("loons_live_sessions", "Games with an open session.", function=_live_sessions)
+)
+CANCELLED_TASKS = registry.register(
+    Gauge("loons_cancelled_tasks", "Tasks of closed sessions that were cancelled and did not finish yet.",
+          function=_cancelled_tasks)
+)
+UNRELEASED_GAMES = registry.register(
+    Gauge("loons_unreleased_games", "Games whose session closed that were not garbage collected yet.",
+          function=_unreleased_games)
+)
+
+
+def observe_db(method):
+    """
+    Decorator timing a synchronous database call into the DB histogram.
+
+    Args:
+        method (str): The label value identifying the call.
+    """
+    histogram = DB_SECONDS.labels(method)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+                get_profiler().record("db", started)
+
+        return wrapper
+
+    return decorator
+
+
+async def run_db(method, function, *args, **kwargs):
+    """
+    Run a synchronous database call through sync_to_async, timing both how
+    long it waited for the thread and how long it ran.
+
+    Args:
+        method (str): The label value identifying the call.
+        function (callable): The synchronous function to run.
+
+    Returns:
+        The return value of the function.
+    """
+    submitted = time.perf_counter()
+    histogram = DB_SECONDS.labels(method)
+
+    def call():
+        started = time.perf_counter()
+        SYNC_TO_ASYNC_WAIT_SECONDS.observe(started - submitted)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+            get_profiler().record("db", started)
+
+    return await sync_to_async(call)()
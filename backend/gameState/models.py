@@ -11,6 +11,10 @@ class Player(models.Model):
     status = models.CharField(max_length=20)
     inventory = models.ManyToManyField('Item', through='Inventory')
 
+    class Meta:
+        # the leaderboard is rebuilt from the top scores of every status
+        indexes = [models.Index(fields=['status', 'score'], name='player_status_score_idx')]
+
 class Item(models.Model):
     """
     Represents an item in the game.
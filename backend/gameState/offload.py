@@ -0,0 +1,218 @@
+import asyncio
+import multiprocessing
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+from django.conf import settings
+
+from .loon_logic import VectorLoonWave
+from .metrics import OFFLOAD_SECONDS
+
+# bytes per loon slot in a shared wave buffer: position and end position (2 float64 each), active and present flags
+SLOT_BYTES = 34
+
+
+def buffer_views(buffer, capacity):
+    """
+    Map the arrays of a wave onto a shared buffer.
+
+    Args:
+        buffer (memoryview): The shared memory of the wave.
+        capacity (int): The number of loon slots in the buffer.
+
+    Returns:
+        tuple: The positions, end positions, active and present arrays.
+    """
+    positions = np.ndarray((capacity, 2), dtype=np.float64, buffer=buffer)
+    end_positions = np.ndarray((capacity, 2), dtype=np.float64, buffer=buffer, offset=16 * capacity)
+    active = np.ndarray(capacity, dtype=bool, buffer=buffer, offset=32 * capacity)
+    present = np.ndarray(capacity, dtype=bool, buffer=buffer, offset=33 * capacity)
+    return positions, end_positions, active, present
+
+
+def release(shm):
+    """
+    Free the shared memory of a wave that was dropped or outgrew it.
+    """
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:
+        # loon views still point into it, the mapping goes away with them
+        pass
+
+
+class SharedVectorLoonWave(VectorLoonWave):
+    """
+    VectorLoonWave whose position buffers live in shared memory, so its
+    steps can run in the offload process pool.
+
+    Once the loons stepped in a tick reach ``offload_threshold``, the step
+    runs in a pool worker, which maps the same buffers and moves the loons
+    in place. The event loop only sends the buffer's name and the state of
+    the wave's random stream, and gets the new state back, so a step plays
+    out exactly as it would have in process and replays stay valid. Smaller
+    steps run in process like a VectorLoonWave.
+
+    Loon types are only read in process and stay in a private buffer.
+
+    Attributes:
+        shm (SharedMemory): The shared memory holding the positions and flags.
+        capacity (int): The number of loon slots in the shared memory.
+        offload_threshold (int): Fewest loons stepped in the process pool, 0 to never offload.
+    """
+
+    def __init__(self, rng=None):
+        self.offload_threshold = settings.LOON_OFFLOAD_THRESHOLD
+        super().__init__(rng)
+
+    def _allocate(self, capacity):
+        """
+        Allocate (or grow) the slot buffers to the given capacity, in a new shared memory block.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=capacity * SLOT_BYTES)
+        positions, end_positions, active, present = buffer_views(shm.buf, capacity)
+        loon_types = np.zeros(capacity, dtype=np.int8)
+        if self.count:
+            positions[: self.count] = self.positions[: self.count]
+            end_positions[: self.count] = self.end_positions[: self.count]
+            loon_types[: self.count] = self.loon_types[: self.count]
+            active[: self.count] = self.active[: self.count]
+            present[: self.count] = self.present[: self.count]
+        previous = getattr(self, "finalizer", None)
+        self.shm = shm
+        self.capacity = capacity
+        self.positions = positions
+        self.end_positions = end_positions
+        self.loon_types = loon_types
+        self.active = active
+        self.present = present
+        self.finalizer = weakref.finalize(self, release, shm)
+        if previous is not None:
+            previous()
+
+    def offloads(self, batch_size):
+        """
+        Whether a step of batch_size loons runs in the process pool.
+        """
+        return 0 < self.offload_threshold <= min(batch_size, len(self.loons))
+
+    async def update_loons_offloaded(self, batch_size):
+        """
+        Update the positions of the first batch_size loons in a pool worker.
+
+        Args:
+            batch_size (int): The number of loons to update in each batch.
+
+        Returns:
+            bool: False if any loon in the batch went out of bounds, True otherwise.
+        """
+        started = time.perf_counter()
+        try:
+            succesful, state = await asyncio.get_running_loop().run_in_executor(
+                get_offload_pool(),
+                step_shared_wave,
+                self.shm.name,
+                self.capacity,
+                self.count,
+                batch_size,
+                self.loon_delta,
+                self.time_step / self.REFERENCE_STEP,
+                self.rng.bit_generator.state,
+            )
+        except BrokenProcessPool as e:
+            print(f"An error occurred in the offload process pool, stepping the wave in process: {e}")
+            reset_offload_pool()
+            return self.update_loons(batch_size)
+        self.rng.bit_generator.state = state
+        OFFLOAD_SECONDS.observe(time.perf_counter() - started)
+        return succesful
+
+
+# shared memory blocks mapped by this pool worker, most recently used last
+_attached = OrderedDict()
+# most blocks a worker keeps mapped, the blocks of finished or grown waves get evicted
+ATTACHED_SIZE = 64
+
+
+def attach(name, capacity):
+    """
+    Map the buffers of a shared wave in a pool worker, reusing the mapping of earlier steps.
+    """
+    entry = _attached.get(name)
+    if entry is not None:
+        _attached.move_to_end(name)
+        return entry[1]
+    shm = shared_memory.SharedMemory(name=name)
+    views = buffer_views(shm.buf, capacity)
+    _attached[name] = (shm, views)
+    if len(_attached) > ATTACHED_SIZE:
+        _, (evicted, evicted_views) = _attached.popitem(last=False)
+        del evicted_views
+        evicted.close()
+    return views
+
+
+def step_shared_wave(name, capacity, count, batch_size, loon_delta, scale, rng_state):
+    """
+    Run one step of a shared wave, in a pool worker.
+
+    Does what VectorLoonWave.update_loons does: slots are handed out in spawn
+    order and never reused within a wave, so the first batch_size present
+    slots are the first batch_size loons of the wave.
+
+    Returns:
+        tuple: False if a loon went out of bounds, True otherwise, and the new state of the random stream.
+    """
+    positions, end_positions, active, present = attach(name, capacity)
+    slots = np.flatnonzero(present[:count])[:batch_size]
+    batch = slots[active[slots]]
+    if len(batch) == 0:
+        return True, rng_state
+
+    rng = np.random.Generator(np.random.PCG64())
+    rng.bit_generator.state = rng_state
+    deltas = rng.integers(0, loon_delta, size=(len(batch), 2), endpoint=True)
+    positions[batch] -= deltas * scale
+
+    escaped = (positions[batch] < end_positions[batch]).any(axis=1)
+    if escaped.any():
+        active[batch[escaped]] = False
+        return False, rng.bit_generator.state
+    return True, rng.bit_generator.state
+
+
+_pool = None
+
+
+def get_offload_pool():
+    """
+    Get the process pool wave steps are offloaded to, creating it on first use.
+
+    Workers are spawned rather than forked, the server process runs an event
+    loop and threads a fork would copy mid-flight.
+
+    Returns:
+        ProcessPoolExecutor: The shared pool of LOON_OFFLOAD_WORKERS processes.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            settings.LOON_OFFLOAD_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pool
+
+
+def reset_offload_pool():
+    """
+    Drop a broken pool, the next offloaded step starts a new one.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
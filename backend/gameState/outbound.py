@@ -0,0 +1,140 @@
+import asyncio
+import time
+from collections import deque
+
+from .metrics import FRAMES_COALESCED, SEND_LAG_SECONDS
+
+
+class OutboundQueue:
+    """
+    Bounded queue of the messages waiting to be sent to one client.
+
+    A writer task drains the queue through ``send``, so a client that reads
+    slowly only holds up its own queue, never the game loop. Position frames
+    are coalesced: at most one frame waits in the queue and a newer frame
+    replaces it, so a client that falls behind skips stale frames and gets
+    the latest state. Control messages (score updates, errors, "Game Over")
+    are never dropped and keep their order.
+
+    The lag of a connection is the age of the oldest message not yet
+    delivered, counted from when it was first queued. A client is stalled
+    when its lag exceeds ``stall_timeout`` or more than ``max_size`` messages
+    are waiting.
+
+    Attributes:
+        max_size (int): Most messages that may wait before the client is considered stalled.
+        stall_timeout (float): Most seconds a message may wait before the client is considered stalled.
+        messages (deque): The waiting messages as (queued at, data, control) entries.
+        closed (bool): Whether the queue stopped sending.
+        sent (int): The number of messages sent.
+        coalesced (int): The number of stale frames replaced by a newer one.
+        max_lag (float): The highest lag of a sent message in seconds.
+        last_lag (float): The lag of the last sent message in seconds.
+    """
+
+    def __init__(self, send, max_size, stall_timeout):
+        self.send = send
+        self.max_size = max_size
+        self.stall_timeout = stall_timeout
+        self.messages = deque()
+        self.frame = None
+        self.sending_since = None
+        self.closed = False
+        self.sent = 0
+        self.coalesced = 0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, data, control=False):
+        """
+        Queue a message for the client.
+
+        Args:
+            data (dict): The message to send.
+            control (bool): True for messages that must not be dropped, False for position frames.
+
+        Returns:
+            bool: True if the message was queued, False if the queue is closed.
+        """
+        if self.closed:
+            return False
+        queued_at = time.perf_counter()
+        if not control and self.frame is not None:
+            # the waiting frame is stale, the new one takes its place at the back
+            self.messages.remove(self.frame)
+            queued_at = self.frame[0]
+            self.coalesced += 1
+            FRAMES_COALESCED.inc()
+        entry = (queued_at, data, control)
+        self.messages.append(entry)
+        if not control:
+            self.frame = entry
+        self.ready.set()
+        return True
+
+    def lag(self):
+        """
+        Get the age of the oldest message not delivered yet.
+
+        Returns:
+            float: The lag in seconds, 0 when everything was delivered.
+        """
+        oldest = self.sending_since
+        if oldest is None and self.messages:
+            oldest = self.messages[0][0]
+        return time.perf_counter() - oldest if oldest is not None else 0.0
+
+    def stalled(self):
+        return len(self.messages) > self.max_size or self.lag() > self.stall_timeout
+
+    async def run(self):
+        """
+        Send the queued messages one at a time until the queue is closed.
+        """
+        try:
+            while not self.closed:
+                if not self.messages:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                entry = self.messages.popleft()
+                if entry is self.frame:
+                    self.frame = None
+                self.sending_since = entry[0]
+                if not await self.send(entry[1]):
+                    self.closed = True
+                self.sending_since = None
+                self.sent += 1
+                self.last_lag = time.perf_counter() - entry[0]
+                self.max_lag = max(self.max_lag, self.last_lag)
+                SEND_LAG_SECONDS.observe(self.last_lag)
+        except Exception as e:
+            print(f"An error occurred while sending queued messages: {e}")
+            self.closed = True
+
+    def close(self):
+        """
+        Stop sending and drop the waiting messages.
+        """
+        self.closed = True
+        self.messages.clear()
+        self.frame = None
+        self.task.cancel()
+
+    def stats(self):
+        """
+        Get the lag statistics of the connection.
+
+        Returns:
+            dict: The queue length, current and highest lag, and message counts.
+        """
+        return {
+            "queued": len(self.messages),
+            "lag": self.lag(),
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,261 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .metrics import FLUSH_PLAYERS, FLUSH_SECONDS, run_db
+
+
+class FlushStats:
+    """
+    Running statistics about write-behind flushes.
+
+    Attributes:
+        flushes (int): The number of flushes that wrote to the database.
+        failures (int): The number of flushes that failed and were retried later.
+        players_written (int): The number of player rows written in total.
+        last_latency (float): The duration of the most recent flush in seconds.
+        max_latency (float): The longest flush duration in seconds.
+        total_latency (float): The sum of all flush durations in seconds.
+    """
+
+    def __init__(self):
+        self.flushes = 0
+        self.failures = 0
+        self.players_written = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def record(self, latency, players):
+        FLUSH_SECONDS.observe(latency)
+        FLUSH_PLAYERS.observe(players)
+        self.flushes += 1
+        self.players_written += players
+        self.last_latency = latency
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self):
+        return {
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "players_written": self.players_written,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "mean_latency": self.total_latency / self.flushes if self.flushes else 0.0,
+        }
+
+
+class CachedPlayer:
+    """
+    Score and coins of a player as known to the game loop.
+
+    Attributes:
+        score (int): The player's score including unflushed changes.
+        coins (int): The player's coins including unflushed changes.
+    """
+
+    def __init__(self, score, coins):
+        self.score = score
+        self.coins = coins
+
+
+class PlayerStateCache:
+    """
+    In-memory score and coin state per player, written back to the database lazily.
+
+    Score and coin changes are applied to the cached values right away and
+    accumulated as pending deltas. Pending deltas of all players are coalesced
+    and written in one bulk UPDATE every ``flush_interval`` seconds, and
+    immediately for a player whose game ends or whose socket disconnects.
+
+    Durability: a change is in the database at most ``flush_interval``
+    seconds after it was made, always before "Game Over" is reported to
+    the client and before a server that shuts down exits. Only a crash of
+    the process can lose changes, at most those of the last
+    ``flush_interval`` seconds. Deltas are written with F-expressions, so
+    coins spent through the REST API in the meantime are not overwritten.
+
+    Purchases are written to the database by the REST API directly and
+    applied to the cached coins with spend_coins(). In sharded mode the
+    front process forwards them to the shard running the player's game,
+    whose cache holds the player.
+
+    Attributes:
+        flush_interval (float): Seconds between two background flushes.
+        players (dict): The cached players by player ID.
+        pending (dict): Unflushed (score, coins) deltas by player ID.
+        stats (FlushStats): Flush latency statistics.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.players = {}
+        self.pending = {}
+        self.stats = FlushStats()
+        self.task = None
+        # purchases update the cached coins from the request threads
+        self.lock = threading.Lock()
+
+    async def get(self, player_id):
+        """
+        Get the cached state of a player, loading it from the database on a miss.
+
+        Args:
+            player_id (str): The ID of the player.
+
+        Returns:
+            CachedPlayer: The cached player state.
+
+        Raises:
+            Player.DoesNotExist: If the player does not exist.
+        """
+        player_id = str(player_id)
+        cached = self.players.get(player_id)
+        if cached is None:
+            score, coins = await run_db("load_player", self._load, player_id)
+            # another coroutine may have loaded it while we were waiting
+            cached = self.players.setdefault(player_id, CachedPlayer(score, coins))
+        return cached
+
+    def _load(self, player_id):
+        from .models import Player
+
+        return Player.objects.values_list("score", "coins").get(id=player_id)
+
+    async def increase_score(self, player_id, amount):
+        """
+        Increase the cached score of a player.
+
+        Args:
+            player_id (str): The ID of the player.
+            amount (int): The amount to increase the score by.
+
+        Returns:
+            int: The new score.
+        """
+        cached = await self.get(player_id)
+        cached.score += amount
+        self._add_pending(str(player_id), amount, 0)
+        return cached.score
+
+    async def add_coins(self, player_id, coins):
+        """
+        Add coins to the cached state of a player.
+
+        Args:
+            player_id (str): The ID of the player.
+            coins (int): The number of coins to add.
+
+        Returns:
+            int: The new number of coins.
+        """
+        cached = await self.get(player_id)
+        with self.lock:
+            cached.coins += coins
+            new_coins = cached.coins
+        self._add_pending(str(player_id), 0, coins)
+        return new_coins
+
+    def spend_coins(self, player_id, coins):
+        """
+        Apply coins spent through the REST API to the cached state of a player, if it is cached.
+
+        The purchase is already in the database, so nothing is left to flush.
+        Safe to call from the request threads.
+
+        Args:
+            player_id (str): The ID of the player.
+            coins (int): The number of coins spent.
+        """
+        cached = self.players.get(str(player_id))
+        if cached is not None:
+            with self.lock:
+                cached.coins -= coins
+
+    def _add_pending(self, player_id, score, coins):
+        pending_score, pending_coins = self.pending.get(player_id, (0, 0))
+        self.pending[player_id] = (pending_score + score, pending_coins + coins)
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        """
+        Flush pending changes on a timer for as long as there are any.
+        """
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                # the deltas are pending again and get retried on the next round
+                pass
+
+    async def flush(self, player_id=None):
+        """
+        Write pending changes to the database in one bulk update.
+
+        Args:
+            player_id (str, optional): Only flush this player. Flushes everyone by default.
+        """
+        if player_id is None:
+            pending, self.pending = self.pending, {}
+        else:
+            player_id = str(player_id)
+            pending = {}
+            if player_id in self.pending:
+                pending[player_id] = self.pending.pop(player_id)
+        if not pending:
+            return
+
+        started = time.perf_counter()
+        try:
+            await run_db("flush_players", self._write, pending)
+        except Exception as e:
+            print(f"An error occurred while flushing player state, retrying later: {e}")
+            self.stats.failures += 1
+            for failed_id, (score, coins) in pending.items():
+                self._add_pending(failed_id, score, coins)
+            raise
+        self.stats.record(time.perf_counter() - started, len(pending))
+
+    def _write(self, pending):
+        from .models import Player
+
+        players = [
+            Player(id=player_id, score=F("score") + score, coins=F("coins") + coins)
+            for player_id, (score, coins) in pending.items()
+        ]
+        with transaction.atomic():
+            Player.objects.bulk_update(players, ["score", "coins"])
+
+    async def evict(self, player_id):
+        """
+        Flush a player's pending changes and drop it from the cache.
+
+        Args:
+            player_id (str): The ID of the player.
+        """
+        await self.flush(player_id)
+        self.players.pop(str(player_id), None)
+
+
+_player_cache = None
+
+
+def get_player_cache():
+    """
+    Get the process-wide player state cache, creating it on first use.
+
+    Returns:
+        PlayerStateCache: The shared cache.
+    """
+    global _player_cache
+    if _player_cache is None:
+        _player_cache = PlayerStateCache(settings.LOON_PLAYER_FLUSH_INTERVAL)
+    return _player_cache
@@ -0,0 +1,231 @@
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+
+
+class PhaseStats:
+    """
+    Time spent in one phase of the game loop during a profiling window.
+
+    Attributes:
+        count (int): The number of times the phase ran.
+        total (float): The total time spent in the phase in seconds.
+        max (float): The longest run of the phase in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class Profiler:
+    """
+    On-demand profiler for the game loop, off unless a profiling window is running.
+
+    While a window runs, a sampler thread records the stack of every other
+    thread every ``interval`` seconds, collapsed to one line per distinct
+    stack (the input format of flamegraph.pl and speedscope), and the game
+    loop reports how long it spends in each phase: simulate, serialize, send,
+    receive and db. With a ``player_id`` the phases and events of that
+    player's game are also kept as a trace.
+
+    When no window runs the hooks only read ``active`` and return.
+
+    The samples are counted under ``lock``, which readers take too, and a
+    window only starts once the sampler of the previous one has exited, so
+    there is never more than one sampler thread.
+
+    Attributes:
+        active (bool): Whether a profiling window is running.
+        player_id (str): The player whose game is traced, if any.
+        stacks (Counter): Samples per collapsed stack.
+        phases (dict): PhaseStats by phase name.
+        trace (deque): The traced events, oldest dropped first.
+    """
+
+    # most events kept in the trace of one window
+    TRACE_SIZE = 10000
+
+    def __init__(self):
+        self.active = False
+        self.player_id = None
+        self.started = None
+        self.duration = 0.0
+        self.interval = 0.0
+        self.samples = 0
+        self.stacks = Counter()
+        self.phases = {}
+        self.trace = deque(maxlen=self.TRACE_SIZE)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.wake = threading.Event()
+
+    def start(self, duration, interval=0.005, player_id=None):
+        """
+        Start a profiling window, discarding the results of the previous one.
+
+        Args:
+            duration (float): Length of the window in seconds, capped by LOON_PROFILE_MAX_SECONDS.
+            interval (float): Seconds between two stack samples.
+            player_id (str, optional): The player whose game to trace.
+
+        Raises:
+            ProfilerBusyError: If a window is already running, or its sampler is still exiting.
+        """
+        with self.lock:
+            if self.active or (self.thread is not None and self.thread.is_alive()):
+                raise ProfilerBusyError("A profiling window is already running")
+            self.duration = min(duration, settings.LOON_PROFILE_MAX_SECONDS)
+            self.interval = interval
+            self.player_id = str(player_id) if player_id is not None else None
+            self.started = time.time()
+            self.samples = 0
+            self.stacks = Counter()
+            self.phases = {}
+            self.trace.clear()
+            self.active = True
+            self.wake = threading.Event()
+            self.thread = threading.Thread(
+                target=self.sample, args=(self.wake,), name="loons-profiler", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """
+        End the running profiling window early, waiting for its sampler to exit.
+        """
+        self.active = False
+        self.wake.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def sample(self, wake):
+        deadline = time.perf_counter() + self.duration
+        own_id = threading.get_ident()
+        while self.active and time.perf_counter() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            # stacks are collapsed outside the lock, only the counting holds it
+            stacks = [
+                self.collapse(names.get(thread_id, thread_id), frame)
+                for thread_id, frame in sys._current_frames().items()
+                if thread_id != own_id
+            ]
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+            # woken up by stop() instead of sleeping out the interval
+            wake.wait(self.interval)
+        self.active = False
+
+    def collapse(self, thread_name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}".format(code.co_filename.rsplit("/", 1)[-1], code.co_name))
+            frame = frame.f_back
+        stack.append(str(thread_name))
+        return ";".join(reversed(stack))
+
+    def clock(self):
+        """
+        Get the start time of a phase, or None when not profiling.
+        """
+        return time.perf_counter() if self.active else None
+
+    def record(self, phase, started, player_id=None):
+        """
+        Record a phase that began at ``started``, a value from clock().
+
+        Args:
+            phase (str): The name of the phase.
+            started (float): When the phase started, None if it started outside a window.
+            player_id (str, optional): The player whose game ran the phase.
+        """
+        if not self.active or started is None:
+            return
+        duration = time.perf_counter() - started
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats is None:
+                stats = self.phases[phase] = PhaseStats()
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+        if player_id is not None and str(player_id) == self.player_id:
+            self.trace.append({"time": time.time(), "event": phase, "duration": duration})
+
+    def event(self, player_id, event, **data):
+        """
+        Add an event of the traced player's game to the trace.
+
+        Args:
+            player_id (str): The player whose game the event belongs to.
+            event (str): The name of the event.
+            data: Details of the event.
+        """
+        if self.active and player_id is not None and str(player_id) == self.player_id:
+            self.trace.append({"time": time.time(), "event": event, **data})
+
+    def collapsed(self):
+        """
+        Get the stack samples in the collapsed format, one "stack count" line per stack.
+
+        Returns:
+            str: The collapsed stacks.
+        """
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return "".join("{} {}\n".format(stack, count) for stack, count in stacks)
+
+    def report(self):
+        """
+        Get the state of the profiler and the results of the last window.
+
+        Returns:
+            dict: The window parameters, the per-phase timings and the trace.
+        """
+        return {
+            "active": self.active,
+            "started": self.started,
+            "duration": self.duration,
+            "interval": self.interval,
+            "player_id": self.player_id,
+            "samples": self.samples,
+            "phases": {phase: stats.as_dict() for phase, stats in list(self.phases.items())},
+            "trace": list(self.trace),
+        }
+
+
+_profiler = None
+
+
+def get_profiler():
+    """
+    Get the process-wide profiler, creating it on first use.
+
+    Returns:
+        Profiler: The shared profiler.
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profiling window is started while another one is running."""
+
+    pass
@@ -0,0 +1,140 @@
+import json
+
+import msgpack
+import numpy as np
+
+
+class JsonProtocol:
+    """
+    Default text protocol, every message is sent as a JSON text frame.
+    """
+
+    name = "json"
+    subprotocol = None
+
+    def loon_state(self, loons):
+        """
+        Build the loonState message for a batch of loons.
+
+        Args:
+            loons (list): The loons to send.
+
+        Returns:
+            dict: The loonState message.
+        """
+        return {
+            "loonState": [
+                {
+                    "id": loon.loon_id,
+                    "type": loon.loon_type.name,
+                    "position_x": loon.current_pos[0],
+                    "position_y": loon.current_pos[1],
+                }
+                for loon in loons
+            ]
+        }
+
+    def encode(self, data):
+        """
+        Encode a message into the keyword arguments of AsyncWebsocketConsumer.send.
+
+        Args:
+            data (dict): The message to encode.
+
+        Returns:
+            dict: Either text_data or bytes_data for send.
+        """
+        return {"text_data": json.dumps(data)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Decode a frame received from the client.
+
+        Args:
+            text_data (str): The received text data.
+            bytes_data (bytes): The received binary data.
+
+        Returns:
+            dict: The decoded message.
+        """
+        if text_data is None:
+            return json.loads(bytes_data)
+        return json.loads(text_data)
+
+
+class MsgpackProtocol(JsonProtocol):
+    """
+    Binary protocol, every message is sent as a msgpack binary frame.
+
+    loonState is sent as packed little-endian arrays instead of a list of objects:
+    ``ids`` (uint32), ``types`` (uint8 LoonType values) and ``positions``
+    (int16 x, y pairs multiplied by ``scale``), so clients divide the positions
+    by ``scale`` to get coordinates back.
+    """
+
+    name = "msgpack"
+    subprotocol = "loons.msgpack"
+    # positions are quantized to 1/POSITION_SCALE of a coordinate unit
+    POSITION_SCALE = 4
+    POSITION_LIMIT = np.iinfo(np.int16).max
+
+    def loon_state(self, loons):
+        count = len(loons)
+        ids = np.fromiter((loon.loon_id for loon in loons), dtype="<u4", count=count)
+        types = np.fromiter((loon.loon_level for loon in loons), dtype="u1", count=count)
+        positions = np.fromiter(
+            (coordinate for loon in loons for coordinate in loon.current_pos),
+            dtype=np.float64,
+            count=2 * count,
+        )
+        positions = np.clip(
+            np.rint(positions * self.POSITION_SCALE),
+            -self.POSITION_LIMIT,
+            self.POSITION_LIMIT,
+        ).astype("<i2")
+        return {
+            "loonState": {
+                "ids": ids.tobytes(),
+                "types": types.tobytes(),
+                "positions": positions.tobytes(),
+                "scale": self.POSITION_SCALE,
+            }
+        }
+
+    def encode(self, data):
+        return {"bytes_data": msgpack.packb(data)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return json.loads(text_data)
+        return msgpack.unpackb(bytes_data)
+
+
+PROTOCOLS = {
+    JsonProtocol.name: JsonProtocol,
+    MsgpackProtocol.name: MsgpackProtocol,
+}
+
+
+def negotiate_protocol(subprotocols, requested=None):
+    """
+    Pick the wire protocol of a connection.
+
+    A protocol requested by name (query parameter) wins, then the first
+    WebSocket subprotocol offered by the client that we support. JSON is
+    used when neither matches.
+
+    Args:
+        subprotocols (list): The subprotocols offered in the handshake.
+        requested (str, optional): The protocol name requested by the client.
+
+    Returns:
+        JsonProtocol: An instance of the negotiated protocol.
+    """
+    if requested in PROTOCOLS:
+        return PROTOCOLS[requested]()
+    for subprotocol in subprotocols:
+        for protocol in PROTOCOLS.values():
+            if protocol.subprotocol == subprotocol:
+                return protocol()
+    return JsonProtocol()
@@ -0,0 +1,309 @@
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from .metrics import RATE_LIMITED
+
+
+class TokenBucket:
+    """
+    Token bucket allowing ``rate`` actions per second on average, in bursts of up to ``burst``.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        burst (float): Most tokens the bucket holds.
+        tokens (float): Tokens left at the last update.
+        updated (float): When the tokens were last counted, in monotonic seconds.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now=None):
+        """
+        Take a token if there is one.
+
+        Args:
+            now (float, optional): The current monotonic time, read when not given.
+
+        Returns:
+            bool: True if the action is allowed, False if the bucket is empty.
+        """
+        if now is None:
+            now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+    def wait(self):
+        """
+        Get the seconds until the next token.
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Token buckets by key, such as a player ID, shared by every connection and request of the process.
+
+    Buckets that refilled are dropped now and then, since a full bucket
+    allows the same as no bucket at all, so the limiter only holds the keys
+    that were active in the last few seconds.
+
+    Attributes:
+        rate (float): Actions per second allowed per key, 0 for no limit.
+        burst (float): Most actions allowed at once per key.
+        buckets (dict): The TokenBucket of every recently active key.
+
+    Raises:
+        ValueError: If the rate is negative.
+    """
+
+    def __init__(self, rate, burst):
+        if rate < 0:
+            raise ValueError("The rate must be 0 or more, got {}".format(rate))
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+        # a bucket is full again this many seconds after its last action
+        self.refill_time = burst / rate if rate else 0.0
+        self.swept = time.monotonic()
+
+    def bucket(self, key):
+        """
+        Get the bucket of a key, dropping refilled buckets every refill time.
+        """
+        now = time.monotonic()
+        if now - self.swept > self.refill_time:
+            self.swept = now
+            self.buckets = {
+                key: bucket for key, bucket in self.buckets.items() if now - bucket.updated < self.refill_time
+            }
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def allow(self, key):
+        """
+        Take a token from the bucket of a key.
+
+        Args:
+            key (str): The key, such as a player ID.
+
+        Returns:
+            bool: True if the action is allowed, False if the key is over its rate.
+        """
+        if not self.rate:
+            return True
+        with self.lock:
+            return self.bucket(key).take()
+
+    def wait(self, key):
+        """
+        Get the seconds until the key may act again.
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            return self.bucket(key).wait()
+
+
+def connection_bucket():
+    """
+    Create the bucket limiting the frames one WebSocket connection may send.
+
+    Returns:
+        TokenBucket: The bucket, None when LOON_RECEIVE_RATE is 0.
+    """
+    if not settings.LOON_RECEIVE_RATE:
+        return None
+    return TokenBucket(settings.LOON_RECEIVE_RATE, settings.LOON_RECEIVE_BURST)
+
+
+_rate_limiters = {}
+
+
+def get_rate_limiter(scope):
+    """
+    Get the process-wide rate limiter of a scope, creating it on first use.
+
+    Args:
+        scope (str): "receive" for the frames of all connections of a player, "api" for the buy and use calls.
+
+    Returns:
+        RateLimiter: The shared rate limiter.
+    """
+    limiter = _rate_limiters.get(scope)
+    if limiter is None:
+        if scope == "receive":
+            limiter = RateLimiter(settings.LOON_PLAYER_RECEIVE_RATE, settings.LOON_PLAYER_RECEIVE_BURST)
+        else:
+            limiter = RateLimiter(settings.LOON_API_RATE, settings.LOON_API_BURST)
+        limiter = _rate_limiters.setdefault(scope, limiter)
+    return limiter
+
+
+def request_player_id(request):
+    """
+    Get the player a buy or use call is for.
+
+    The playerId query parameter is read first, so those calls can be
+    throttled without parsing their JSON body. Clients that only send it in
+    the body are still served.
+
+    Args:
+        request (Request): The DRF request.
+
+    Returns:
+        str: The player ID, None if the request has none.
+    """
+    return request.query_params.get('playerId') or request.data.get('playerId')
+
+
+class PlayerRateThrottle(BaseThrottle):
+    """
+    DRF throttle limiting each player to LOON_API_RATE calls per second, in bursts of LOON_API_BURST.
+
+    Requests are keyed by their player, see request_player_id(), requests
+    without one are left to the view to reject. Throttled requests get a 429
+    with Retry-After.
+    """
+
+    def allow_request(self, request, view):
+        self.player_id = request_player_id(request)
+        if not self.player_id:
+            return True
+        if get_rate_limiter("api").allow(str(self.player_id)):
+            return True
+        RATE_LIMITED.labels("api").inc()
+        return False
+
+    def wait(self):
+        return get_rate_limiter("api").wait(str(self.player_id))
+
+
+class Admission:
+    """
+    Admission cap on the games running at once, LOON_MAX_GAMES.
+
+    A game counts from the moment game/start/ hands out its player ID, not
+    only once its client connects. Started games hold a reservation for up
+    to ``reservation_ttl`` seconds, which their client claims by connecting,
+    so a burst of starts cannot admit more games than the cap before any
+    socket connects. Clients connecting without a reservation, with an
+    expired one or a reused player ID, are only let in while there is room.
+
+    Attributes:
+        max_games (int): Most games running at once, 0 for no limit.
+        reservation_ttl (float): Seconds a started game holds its place until its client connects.
+        reserved (dict): When each reservation expires, in monotonic seconds, by player ID.
+    """
+
+    def __init__(self, max_games, reservation_ttl):
+        self.max_games = max_games
+        self.reservation_ttl = reservation_ttl
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def live_games(self, refresh=True):
+        """
+        Count the games running, in this process or in all shards in sharded mode.
+
+        Args:
+            refresh (bool): Fetch the loads of the shards if the cached ones are too old, False on the event loop.
+        """
+        if settings.LOON_SHARDS:
+            from .sharding import get_shard_directory
+
+            directory = get_shard_directory()
+            loads = directory.get_loads() if refresh else directory.loads
+            return sum(load["games"] for load in list(loads.values()))
+        from .sessions import get_session_registry
+
+        return len(get_session_registry().sessions)
+
+    def _expire(self, now):
+        expired = [player_id for player_id, expires in self.reserved.items() if expires <= now]
+        for player_id in expired:
+            del self.reserved[player_id]
+
+    def reserve(self, player_ids):
+        """
+        Reserve a place for each game about to be started, if they all fit under the cap.
+
+        Args:
+            player_ids (list): The IDs of the players whose games start.
+
+        Returns:
+            bool: True if the games were admitted, False if the server is full.
+        """
+        if not self.max_games:
+            return True
+        live_games = self.live_games()
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+            if live_games + len(self.reserved) + len(player_ids) > self.max_games:
+                return False
+            for player_id in player_ids:
+                self.reserved[str(player_id)] = now + self.reservation_ttl
+            return True
+
+    def release(self, player_ids):
+        """
+        Give back the places of games that could not be started after all.
+
+        Args:
+            player_ids (list): The IDs of the players whose games did not start.
+        """
+        with self.lock:
+            for player_id in player_ids:
+                self.reserved.pop(str(player_id), None)
+
+    def admit(self, player_id):
+        """
+        Let the client of a game connect, claiming its reservation if it has one.
+
+        Args:
+            player_id (str): The ID of the player connecting.
+
+        Returns:
+            bool: True if the game may run, False if the server is full.
+        """
+        if not self.max_games:
+            return True
+        live_games = self.live_games(refresh=False)
+        with self.lock:
+            self._expire(time.monotonic())
+            if self.reserved.pop(str(player_id), None) is not None:
+                return True
+            return live_games + len(self.reserved) < self.max_games
+
+
+_admission = None
+
+
+def get_admission():
+    """
+    Get the process-wide admission cap, creating it on first use.
+
+    Returns:
+        Admission: The shared admission cap.
+    """
+    global _admission
+    if _admission is None:
+        _admission = Admission(settings.LOON_MAX_GAMES, settings.LOON_ADMISSION_TTL)
+    return _admission
@@ -0,0 +1,394 @@
+import hashlib
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"LOON"
+VERSION = 1
+
+# record tags
+WAVE = 1
+POPS = 2
+END = 3
+
+# how a recorded game ended
+OUTCOMES = ("game_over", "disconnected")
+
+
+def write_varint(buffer, value):
+    """
+    Append an unsigned LEB128 varint to the buffer.
+    """
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, offset):
+    """
+    Read an unsigned LEB128 varint.
+
+    Returns:
+        tuple: The value and the offset right after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def state_digest(consumer):
+    """
+    Hash the simulation state of a game: its wave, step count, batch size and every loon.
+
+    Args:
+        consumer (LoonConsumer): The game.
+
+    Returns:
+        bytes: An 8 byte digest.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(struct.pack("<III", consumer.wave, consumer.steps, consumer.batch_size))
+    for loon in consumer.loon_wave.loons.values():
+        x, y = loon.current_pos
+        digest.update(struct.pack("<IBdd?", loon.loon_id, loon.loon_level, x, y, loon.active))
+    return digest.digest()
+
+
+class ReplayRecorder:
+    """
+    Writes the replay log of one game, everything needed to re-run it exactly.
+
+    The log starts with a header holding the game's seed, wave engine and
+    simulation step, followed by records, all tagged and varint encoded:
+    WAVE when a wave starts (step, wave parameters), POPS with the loon ids
+    applied at a step, and END with the final step, wave, outcome and a digest
+    of the final state. Steps are counted from the start of the game, only
+    steps that changed something are recorded.
+
+    Records are buffered in memory and appended to the file when a wave
+    starts and when the game ends, so a typical game costs a few hundred
+    bytes. The appends run on the replay writer thread, never on the event
+    loop.
+
+    Attributes:
+        path (str): The log file, or None to only keep the log in memory.
+        buffer (bytearray): Records not written to the file yet.
+        ended (bool): Whether the END record was written.
+        written (bool): Whether records were handed to the replay writer yet.
+    """
+
+    def __init__(self, path, seed, engine, time_step):
+        self.path = path
+        self.buffer = bytearray(MAGIC)
+        self.buffer.append(VERSION)
+        self.buffer += struct.pack("<Qd", seed, time_step)
+        encoded_engine = engine.encode()
+        write_varint(self.buffer, len(encoded_engine))
+        self.buffer += encoded_engine
+        self.ended = False
+        self.written = False
+
+    @classmethod
+    def open(cls, directory, player_id, seed, engine, time_step):
+        """
+        Create the recorder of a game, logging to <directory>/<player_id>-<start time in ns>.loonreplay.
+
+        Every game gets its own log, so a player reconnecting, or a shard
+        restarting a game, starts a new log instead of appending to the last one.
+        """
+        name = "{}-{}.loonreplay".format(player_id, time.time_ns())
+        return cls(os.path.join(directory, name), seed, engine, time_step)
+
+    def wave(self, step, wave, num_loons, base_start_point, start_point_range, end_point, loon_delta):
+        self.buffer.append(WAVE)
+        for value in (step, wave, num_loons, start_point_range, loon_delta):
+            write_varint(self.buffer, value)
+        self.buffer += struct.pack("<dddd", *base_start_point, *end_point)
+        self.flush()
+
+    def pops(self, step, loon_ids):
+        self.buffer.append(POPS)
+        write_varint(self.buffer, step)
+        write_varint(self.buffer, len(loon_ids))
+        for loon_id in loon_ids:
+            write_varint(self.buffer, loon_id)
+
+    def end(self, step, wave, outcome, digest):
+        if self.ended:
+            return
+        self.ended = True
+        self.buffer.append(END)
+        write_varint(self.buffer, step)
+        write_varint(self.buffer, wave)
+        self.buffer.append(OUTCOMES.index(outcome))
+        self.buffer += digest
+        self.flush()
+
+    def flush(self):
+        """
+        Hand the buffered records to the replay writer, which appends them to the log file.
+
+        Returns:
+            Future: Done once the records are written, None if there was nothing to write.
+        """
+        if self.path is None or not self.buffer:
+            return None
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        # the first write holds the header and replaces whatever was left at the path
+        truncate = not self.written
+        self.written = True
+        return get_replay_writer().submit(append_log, self.path, data, truncate)
+
+
+def append_log(path, data, truncate=False):
+    """
+    Append records to a replay log file, creating its directory if needed.
+
+    Args:
+        path (str): The log file.
+        data (bytes): The records.
+        truncate (bool): Empty the file first, for the first records of a log.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb" if truncate else "ab") as f:
+            f.write(data)
+    except OSError as e:
+        print(f"An error occurred while writing the replay log {path}: {e}")
+
+
+_replay_writer = None
+
+
+def get_replay_writer():
+    """
+    Get the thread replay logs are written from, creating it on first use.
+
+    A single thread appends the records of every game in the order they
+    were flushed, so the log of a game is never written out of order.
+
+    Returns:
+        ThreadPoolExecutor: The shared single-thread executor.
+    """
+    global _replay_writer
+    if _replay_writer is None:
+        _replay_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="replay")
+    return _replay_writer
+
+
+def find_logs(paths):
+    """
+    Expand directories into the replay logs they hold.
+
+    Args:
+        paths (list): Replay log files and directories.
+
+    Returns:
+        list: The log files, those of each directory sorted by name.
+    """
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            logs.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".loonreplay")
+            )
+        else:
+            logs.append(path)
+    return logs
+
+
+class ReplayLog:
+    """
+    A replay log read back into memory.
+
+    Attributes:
+        seed (int): The game's seed.
+        time_step (float): The simulation step the game ran with.
+        engine (str): The wave engine the game ran on.
+        records (list): (tag, values) tuples in log order.
+        size (int): The size of the log in bytes.
+    """
+
+    def __init__(self, seed, time_step, engine, records, size):
+        self.seed = seed
+        self.time_step = time_step
+        self.engine = engine
+        self.records = records
+        self.size = size
+
+    @classmethod
+    def read(cls, path):
+        """
+        Parse a replay log file.
+
+        Args:
+            path (str): The log file.
+
+        Returns:
+            ReplayLog: The parsed log.
+
+        Raises:
+            ReplayError: If the file is not a replay log or is cut short.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:4] != MAGIC or data[4] != VERSION:
+            raise ReplayError("{} is not a version {} replay log".format(path, VERSION))
+
+        try:
+            seed, time_step = struct.unpack_from("<Qd", data, 5)
+            length, offset = read_varint(data, 21)
+            engine = data[offset:offset + length].decode()
+            offset += length
+
+            records = []
+            while offset < len(data):
+                tag = data[offset]
+                offset += 1
+                if tag == WAVE:
+                    values = []
+                    for _ in range(5):
+                        value, offset = read_varint(data, offset)
+                        values.append(value)
+                    start_x, start_y, end_x, end_y = struct.unpack_from("<dddd", data, offset)
+                    offset += 32
+                    step, wave, num_loons, start_point_range, loon_delta = values
+                    records.append((WAVE, (
+                        step, wave, num_loons, (start_x, start_y), start_point_range, (end_x, end_y), loon_delta
+                    )))
+                elif tag == POPS:
+                    step, offset = read_varint(data, offset)
+                    count, offset = read_varint(data, offset)
+                    loon_ids = []
+                    for _ in range(count):
+                        loon_id, offset = read_varint(data, offset)
+                        loon_ids.append(loon_id)
+                    records.append((POPS, (step, loon_ids)))
+                elif tag == END:
+                    step, offset = read_varint(data, offset)
+                    wave, offset = read_varint(data, offset)
+                    outcome = OUTCOMES[data[offset]]
+                    digest = bytes(data[offset + 1:offset + 9])
+                    offset += 9
+                    records.append((END, (step, wave, outcome, digest)))
+                else:
+                    raise ReplayError("Unknown record tag {} at byte {}".format(tag, offset - 1))
+        except (IndexError, struct.error):
+            raise ReplayError("{} is truncated".format(path))
+        return cls(seed, time_step, engine, records, len(data))
+
+
+async def replay_game(log):
+    """
+    Re-run a recorded game at full speed and check that it ends in the recorded state.
+
+    The game is rebuilt from the seed, its waves and pops are fed back at the
+    recorded steps, and every wave's parameters and the final state digest
+    are compared with the log.
+
+    Args:
+        log (ReplayLog): The game to replay.
+
+    Returns:
+        dict: The replay report, with matched set to whether the game played out the same.
+
+    Raises:
+        ReplayError: If the replay diverges from the log.
+    """
+    from .consumers import LoonConsumer
+    from .loon_logic import get_wave_engine
+    from .protocol import JsonProtocol
+    from .simulation import HeadlessPlayerService
+
+    consumer = LoonConsumer()
+    consumer.player_id = "replay"
+    consumer.wave_engine = get_wave_engine(log.engine)
+    consumer.protocol = JsonProtocol()
+    consumer.player_service = HeadlessPlayerService(0)
+    consumer.time_step = log.time_step
+    consumer.seed_game(log.seed)
+
+    async def send(text_data=None, bytes_data=None, close=False):
+        pass
+
+    consumer.send = send
+
+    async def run_until(step):
+        while consumer.steps < step:
+            before = consumer.steps
+            await consumer.simulate()
+            if consumer.steps == before:
+                raise ReplayError("The game stopped at step {}, the log goes on to step {}".format(before, step))
+
+    started = time.perf_counter()
+    waves = 0
+    pops = 0
+    matched = False
+    end = None
+    try:
+        for tag, values in log.records:
+            if tag == WAVE:
+                step, wave, num_loons, base_start_point, start_point_range, end_point, loon_delta = values
+                await run_until(step)
+                if consumer.transition is not None:
+                    await consumer.transition
+                else:
+                    # the first wave, or a wave the game was started at
+                    consumer.wave = wave
+                    consumer.num_loons = num_loons
+                    consumer.base_start_point = base_start_point
+                    consumer.start_point_range = start_point_range
+                    consumer.end_point = end_point
+                    consumer.loon_delta = loon_delta
+                    await consumer.initialize_wave(num_loons, base_start_point, start_point_range, end_point)
+                replayed = (
+                    consumer.wave, consumer.num_loons, tuple(consumer.base_start_point),
+                    consumer.start_point_range, tuple(consumer.end_point), consumer.loon_delta,
+                )
+                if replayed != (wave, num_loons, base_start_point, start_point_range, end_point, loon_delta):
+                    raise ReplayError("Wave {} diverged at step {}: {}".format(wave, step, replayed))
+                waves += 1
+            elif tag == POPS:
+                step, loon_ids = values
+                # pops are applied at the start of the step they were recorded at
+                await run_until(step - 1)
+                consumer.pending_pops.extend(loon_ids)
+                pops += len(loon_ids)
+            else:
+                step, wave, outcome, digest = values
+                await run_until(step)
+                end = {"step": step, "wave": wave, "outcome": outcome}
+                matched = consumer.wave == wave and state_digest(consumer) == digest
+                break
+    finally:
+        if consumer.transition is not None and not consumer.transition.done():
+            consumer.transition.cancel()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "engine": log.engine,
+        "seed": log.seed,
+        "log_bytes": log.size,
+        "steps": consumer.steps,
+        "waves": waves,
+        "pops": pops,
+        "end": end,
+        "matched": matched,
+        "elapsed": elapsed,
+        "steps_per_second": consumer.steps / elapsed if elapsed else 0.0,
+    }
+
+
+class ReplayError(Exception):
+    """Raised when a replay log is invalid or a replayed game diverges from it."""
+
+    pass
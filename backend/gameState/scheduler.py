@@ -0,0 +1,267 @@
+import asyncio
+import time
+
+from django.conf import settings
+
+from .metrics import PUBLISH_ERRORS, SCHEDULER_TICK_SECONDS, TICK_SECONDS
+
+
+class TickStats:
+    """
+    Running statistics about the scheduler's ticks.
+
+    Attributes:
+        ticks (int): The number of ticks run.
+        overruns (int): The number of ticks that took longer than the tick interval.
+        skipped_ticks (int): The number of simulation steps dropped for being more than a backlog behind.
+        max_duration (float): The longest tick duration in seconds.
+        total_duration (float): The sum of all tick durations in seconds.
+        last_duration (float): The duration of the most recent tick in seconds.
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_duration = 0.0
+
+    def record(self, duration, tick_interval):
+        """
+        Record the duration of a tick.
+
+        Args:
+            duration (float): How long the tick took in seconds.
+            tick_interval (float): The scheduler's tick interval in seconds.
+        """
+        self.ticks += 1
+        self.last_duration = duration
+        self.total_duration += duration
+        self.max_duration = max(self.max_duration, duration)
+        if duration > tick_interval:
+            self.overruns += 1
+
+    def as_dict(self):
+        return {
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped_ticks": self.skipped_ticks,
+            "max_duration": self.max_duration,
+            "mean_duration": self.total_duration / self.ticks if self.ticks else 0.0,
+            "last_duration": self.last_duration,
+        }
+
+
+class GameScheduler:
+    """
+    Process-wide clock that advances every active game on one fixed timestep.
+
+    Games register themselves and must provide ``simulate()``, a coroutine
+    advancing the game by one step of ``tick_interval`` simulated seconds,
+    ``frame()``, which builds the data to send from the current state (or
+    None), the coroutine ``publish(data)``, which sends it, and
+    ``offloaded()``, telling whether the next step runs in the offload
+    process pool. Offloaded steps of all games run concurrently.
+
+    The simulation and the network run at separate rates. Every step that is
+    due is simulated, catching up after a slow tick so game time keeps pace
+    with wall time, while frames go out every ``send_interval`` seconds. A
+    tick runs at most ``max_catch_up_steps`` steps, the others are deferred
+    to the next ticks. Only steps beyond ``max_backlog_steps`` deferred ones
+    are dropped, the games then fall behind wall time: every game still runs
+    the same sequence of steps, only later. The
+    send interval doubles while ticks overrun, up to ``max_send_interval``,
+    and comes back down once they are fast again; clients interpolate between
+    frames. Since frames are only read from the game state, a game plays out
+    the same at any send rate.
+
+    Attributes:
+        tick_interval (float): Seconds between two simulation steps.
+        base_send_interval (float): Seconds between two frames when the server keeps up.
+        max_send_interval (float): The longest the send interval gets under load.
+        send_interval (float): The current seconds between two frames.
+        max_catch_up_steps (int): Most steps run in one tick, the rest are deferred to the next ticks.
+        max_backlog_steps (int): Most steps deferred, a second's worth by default, the rest are dropped.
+        backlog (int): The steps that are due and were not run yet.
+        games (dict): The registered games, used as an insertion-ordered set.
+        stats (TickStats): Tick duration and overrun statistics.
+    """
+
+    def __init__(
+        self, tick_interval, send_interval=None, max_send_interval=None, max_catch_up_steps=5, max_backlog_steps=None
+    ):
+        self.tick_interval = tick_interval
+        self.base_send_interval = send_interval if send_interval is not None else tick_interval
+        self.max_send_interval = max(max_send_interval or self.base_send_interval, self.base_send_interval)
+        self.send_interval = self.base_send_interval
+        self.max_catch_up_steps = max_catch_up_steps
+        self.max_backlog_steps = (
+            max_backlog_steps if max_backlog_steps is not None else max(1, round(1.0 / tick_interval))
+        )
+        self.backlog = 0
+        self.games = {}
+        self.stats = TickStats()
+        self.task = None
+
+    def register(self, game):
+        """
+        Register a game and start the clock if it is not running yet.
+
+        Args:
+            game: The game to advance on every tick.
+        """
+        self.games[game] = None
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    def unregister(self, game):
+        """
+        Stop advancing a game. The clock stops by itself once no games are left.
+
+        Args:
+            game: The game to remove.
+        """
+        self.games.pop(game, None)
+
+    async def tick(self, steps=1, send=True):
+        """
+        Advance every registered game, then send the resulting frames.
+
+        Args:
+            steps (int): The number of simulation steps to run.
+            send (bool): Whether frames are due on this tick.
+        """
+        for _ in range(steps):
+            offloaded = []
+            for game in list(self.games):
+                if game.offloaded():
+                    offloaded.append(game)
+                else:
+                    await self.simulate(game)
+            if offloaded:
+                # their steps run in the process pool side by side, the loop only waits for them
+                await asyncio.gather(*(self.simulate(game) for game in offloaded))
+        if not send:
+            return
+
+        frames = []
+        for game in list(self.games):
+            try:
+                data = game.frame()
+            except Exception as e:
+                print(f"An error occurred while building a frame, dropping the game: {e}")
+                self.unregister(game)
+                continue
+            if data is not None:
+                frames.append((game, data))
+
+        if frames:
+            results = await asyncio.gather(
+                *(game.publish(data) for game, data in frames), return_exceptions=True
+            )
+            for (game, _), result in zip(frames, results):
+                if isinstance(result, Exception):
+                    print(f"An error occurred while publishing a frame, dropping the game: {result}")
+                    PUBLISH_ERRORS.inc()
+                    self.unregister(game)
+
+    async def simulate(self, game):
+        """
+        Advance one game by one step, dropping it if the step fails.
+
+        Args:
+            game: The game to advance.
+        """
+        started = time.perf_counter()
+        try:
+            await game.simulate()
+        except Exception as e:
+            print(f"An error occurred while simulating a game, dropping it: {e}")
+            self.unregister(game)
+            return
+        TICK_SECONDS.observe(time.perf_counter() - started)
+
+    async def run(self):
+        """
+        Run ticks on a fixed timestep for as long as there are registered games.
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        next_send = next_tick
+        self.backlog = 0
+        while self.games:
+            started = loop.time()
+            due = int((started - next_tick) // self.tick_interval) + 1
+            self.backlog += due
+            steps = min(self.backlog, self.max_catch_up_steps)
+            self.backlog -= steps
+            if self.backlog > self.max_backlog_steps:
+                # too far behind to ever catch up, those steps are dropped and the games slow down
+                self.stats.skipped_ticks += self.backlog - self.max_backlog_steps
+                self.backlog = self.max_backlog_steps
+            # the simulated time of the last step of this tick
+            tick_time = next_tick + (due - 1) * self.tick_interval
+            send = tick_time + self.tick_interval / 2 >= next_send
+
+            await self.tick(steps, send)
+            finished = loop.time()
+            self.stats.record(finished - started, self.tick_interval)
+            SCHEDULER_TICK_SECONDS.observe(finished - started)
+
+            if send:
+                self.adapt_send_interval(finished - started)
+                next_send += self.send_interval
+                if next_send <= tick_time:
+                    next_send = tick_time + self.send_interval
+            next_tick += due * self.tick_interval
+            await asyncio.sleep(max(0.0, next_tick - finished))
+
+    def adapt_send_interval(self, duration):
+        """
+        Lower the send rate while ticks overrun, and raise it back once they are fast again.
+
+        Args:
+            duration (float): How long the last tick took in seconds.
+        """
+        if duration > self.tick_interval:
+            self.send_interval = min(self.send_interval * 2, self.max_send_interval)
+        elif duration < self.tick_interval / 2 and self.send_interval > self.base_send_interval:
+            self.send_interval = max(self.send_interval / 2, self.base_send_interval)
+
+    def status(self):
+        """
+        Get the scheduler's state and tick statistics.
+
+        Returns:
+            dict: The number of registered games and the tick statistics.
+        """
+        return {
+            "games": len(self.games),
+            "tick_interval": self.tick_interval,
+            "send_interval": self.send_interval,
+            "backlog": self.backlog,
+            **self.stats.as_dict(),
+        }
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """
+    Get the process-wide game scheduler, creating it on first use.
+
+    Returns:
+        GameScheduler: The shared scheduler.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = GameScheduler(
+            settings.LOON_TICK_INTERVAL,
+            settings.LOON_SEND_INTERVAL,
+            settings.LOON_MAX_SEND_INTERVAL,
+            settings.LOON_MAX_CATCH_UP_STEPS,
+        )
+    return _scheduler
@@ -1,7 +1,12 @@
 from enum import Enum
-from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
 from django.db.models import F
 from django.core.exceptions import ValidationError
+from .catalog import get_item_catalog
+from .leaderboard import get_leaderboard
+from .metrics import observe_db, run_db
+from .player_cache import get_player_cache
 
 
 class PlayerService:
@@ -17,29 +22,52 @@ class PlayerService:
         Returns:
             Player: The created player instance.
         """
-        from .models import Item, Inventory, Player
+        return self.create_players([id], initial_coins, inventory)[0]
 
-        player = Player(
-            id=id, coins=initial_coins, score=0, status=Game_States.PLAYING.name
-        )
+    @observe_db("create_players")
+    def create_players(self, ids, initial_coins, inventory):
+        """
+        Create new players with the given IDs, all with the same initial coins and inventory.
 
-        # Save the Player instance to the database
-        player.save()
+        The players and their inventories are inserted with one bulk insert
+        each, in a single transaction.
 
-        # Add items to the player's inventory
-        for each_item in inventory:
-            try:
-                item = Item.objects.get(name=each_item["item_name"])
-            except Item.DoesNotExist:
-                raise Item.DoesNotExist(
-                    "Item with name {} does not exist".format(each_item["item_name"])
-                )
+        Args:
+            ids (list): The IDs of the players.
+            initial_coins (int): The initial number of coins for each player.
+            inventory (list): A list of items in each player's inventory.
+
+        Returns:
+            list: The created player instances.
 
-            Inventory.objects.create(
-                player=player, item=item, quantity=each_item["quantity"]
+        Raises:
+            Item.DoesNotExist: If an item of the inventory does not exist.
+        """
+        from .models import Inventory, Player
+
+        # resolving the items first so a bad config does not leave half created players
+        items = [
+            (get_item_catalog().get(each_item["item_name"]), each_item["quantity"])
+            for each_item in inventory
+        ]
+        players = [
+            Player(id=id, coins=initial_coins, score=0, status=Game_States.PLAYING.name)
+            for id in ids
+        ]
+
+        with transaction.atomic():
+            Player.objects.bulk_create(players)
+            # Add items to the players' inventory
+            Inventory.objects.bulk_create(
+                [
+                    Inventory(player=player, item=item, quantity=quantity)
+                    for player in players
+                    for item, quantity in items
+                ]
             )
-        return player
+        return players
 
+    @observe_db("get_inventory")
     def get_inventory(self, player_id):
         from .models import Inventory
 
@@ -67,19 +95,29 @@ class PlayerService:
         from .models import Player
 
         try:
-            # Get the player
-            player = await sync_to_async(Player.objects.get)(id=player_id)
+            # write back the pending score and coins so the final state is persisted
+            await get_player_cache().evict(player_id)
 
-            # Update the player's status and score
-            player.status = Game_States.GAME_OVER.name
-
-            # Save the changes to the database
-            await sync_to_async(player.save)()
+            # mark the game as over in one trip to the database thread
+            player = await run_db("game_over", self._set_game_over, player_id)
         except Player.DoesNotExist:
             raise ValueError("Player with ID {} does not exist".format(player_id))
 
+        get_leaderboard().update(player_id, player.score, player.status)
+
         return player
 
+    def _set_game_over(self, player_id):
+        from .models import Player
+
+        # only the status is written, coins spent meanwhile through buy/use are left alone
+        updated = Player.objects.filter(id=player_id).update(status=Game_States.GAME_OVER.name)
+        if not updated:
+            raise Player.DoesNotExist("Player with id {} does not exist".format(player_id))
+
+        # read after the update, the final score and coins as stored
+        return Player.objects.get(id=player_id)
+
     async def add_coins(self, player_id, coins):
         """
         Add a certain number of coins to the player with the given ID.
@@ -92,19 +130,23 @@ class PlayerService:
             int: The new number of coins for the player.
         """
         from .models import Player
-        from django.db.models import F
 
         try:
-            player = await sync_to_async(Player.objects.get)(id=player_id)
-            player.coins = F("coins") + coins
-            await sync_to_async(player.save)()
-            await sync_to_async(player.refresh_from_db)()
-            coins = await sync_to_async(getattr, thread_sensitive=True)(player, "coins")
-
-            return coins
+            # applied in memory, the player state cache writes it back later
+            return await get_player_cache().add_coins(player_id, coins)
         except Player.DoesNotExist:
             raise ValueError("Player with ID {} does not exist".format(player_id))
 
+    async def flush_player_state(self, player_id):
+        """
+        Persist the pending score and coin changes of a player and drop them from memory.
+
+        Args:
+            player_id (int): The ID of the player.
+        """
+        await get_player_cache().evict(player_id)
+
+    @observe_db("get_coins")
     def get_coins(self, player_id):
         """
         Get the number of coins for the player with the given ID.
@@ -130,90 +172,126 @@ class PlayerService:
         Args:
             player_id (int): The ID of the player.
             amount (int): The amount to increase the score by.
+
+        Returns:
+            int: The new score of the player.
         """
         from .models import Player
 
         try:
-            player = await sync_to_async(Player.objects.get)(id=player_id)
-            player.score += amount
-            await sync_to_async(player.save)()
-            return player.score
+            # applied in memory, the player state cache writes it back later
+            score = await get_player_cache().increase_score(player_id, amount)
         except Player.DoesNotExist:
             raise Player.DoesNotExist(
                 "Player with id {} does not exist".format(player_id)
             )
 
+        get_leaderboard().update(player_id, score, Game_States.PLAYING.name)
+        return score
+
+    @observe_db("buy_item")
     def buy_item(self, player_id, item_name):
         """
         Buy an item with the given name for the player with the specified ID.
 
+        The funds check and the deduction are a single conditional UPDATE, and
+        the inventory row is upserted in the same transaction, so concurrent
+        purchases can never overspend.
+
         Args:
             player_id (int): The ID of the player.
             item_name (str): The name of the item to buy.
 
+        Returns:
+            tuple: The serialized inventory item and the player's new number of coins.
+
         Raises:
             Item.DoesNotExist: If the item with the given name does not exist.
             Player.DoesNotExist: If the player with the specified ID does not exist.
             InsufficientFundsError: If the player does not have enough funds to buy the item.
         """
-        from .models import Item, Inventory, Player
+        from .models import Inventory, Player
 
-        try:
-            item = Item.objects.get(name=item_name)
-        except Item.DoesNotExist:
-            raise Item.DoesNotExist(
-                "Item with name {} does not exist".format(item_name)
-            )
-        try:
-            player = Player.objects.get(id=player_id)
-        except Player.DoesNotExist or ValidationError:
-            raise Player.DoesNotExist(
-                "Player with id {} does not exist".format(player_id)
+        item = get_item_catalog().get(item_name)
+
+        with transaction.atomic():
+            bought = Player.objects.filter(id=player_id, coins__gte=item.cost).update(
+                coins=F("coins") - item.cost
             )
+            if not bought:
+                if not Player.objects.filter(id=player_id).exists():
+                    raise Player.DoesNotExist(
+                        "Player with id {} does not exist".format(player_id)
+                    )
+                raise InsufficientFundsError(
+                    "Player does not have enough funds to buy this item"
+                )
 
-        if player.coins < item.cost:
-            raise InsufficientFundsError(
-                "Player does not have enough funds to buy this item"
+            updated = Inventory.objects.filter(player_id=player_id, item=item).update(
+                quantity=F("quantity") + 1
             )
+            if not updated:
+                Inventory.objects.create(player_id=player_id, item=item, quantity=1)
 
-        try:
-            inventory_item = Inventory.objects.get(player=player, item=item)
-            inventory_item.quantity = F("quantity") + 1
-            inventory_item.save()
-            inventory_item.refresh_from_db()
-        except Inventory.DoesNotExist:
-            player.inventory.create(item=item, quantity=1)
-        player.coins -= item.cost
-        player.save()
-        return self._serialize_inventory_item(inventory_item)
+            quantity, coins = (
+                Inventory.objects.filter(player_id=player_id, item=item)
+                .values_list("quantity", "player__coins")
+                .get()
+            )
+        # the game loop reports the coins from the player state cache
+        get_player_cache().spend_coins(player_id, item.cost)
+        if settings.LOON_SHARDS:
+            # the player's game, and the cache holding it, run in the shard owning the player
+            from .sharding import forward_spend
 
+            forward_spend(player_id, item.cost)
+        return self._serialize_item_quantity(item, quantity), coins
 
+    @observe_db("use_item")
     def use_item(self, player_id, item_name):
-        from .models import Inventory, Item, Player
+        """
+        Use one unit of an item from the inventory of the player with the specified ID.
 
-        try:
-            item = Item.objects.get(name=item_name)
-        except Item.DoesNotExist:
-            raise Item.DoesNotExist(
-                "Item with name {} does not exist".format(item_name)
-            )
+        The quantity check and the decrement are a single conditional UPDATE.
 
-        try:
-            player = Player.objects.get(id=player_id)
-        except Player.DoesNotExist or ValidationError:
-            raise Player.DoesNotExist(
-                "Player with id {} does not exist".format(player_id)
-            )
-        try:
-            inventory_item = Inventory.objects.get(player=player, item=item)
-            if inventory_item.quantity <= 0:
-                raise InsufficientQuantityError("Insufficient quantity of item")
-            inventory_item.quantity -= 1
-            inventory_item.save()
-            inventory_item.refresh_from_db()
-            return self._serialize_inventory_item(inventory_item)
-        except Inventory.DoesNotExist:
-            raise ItemNotFoundError("Item not found in inventory")
+        Args:
+            player_id (int): The ID of the player.
+            item_name (str): The name of the item to use.
+
+        Returns:
+            dict: The serialized inventory item.
+
+        Raises:
+            Item.DoesNotExist: If the item with the given name does not exist.
+            Player.DoesNotExist: If the player with the specified ID does not exist.
+            ItemNotFoundError: If the item is not in the player's inventory.
+            InsufficientQuantityError: If the player has no units of the item left.
+        """
+        from .models import Inventory, Player
+
+        item = get_item_catalog().get(item_name)
+
+        with transaction.atomic():
+            inventory_items = Inventory.objects.filter(player_id=player_id, item=item)
+            used = inventory_items.filter(quantity__gt=0).update(quantity=F("quantity") - 1)
+            if not used:
+                if inventory_items.exists():
+                    raise InsufficientQuantityError("Insufficient quantity of item")
+                if not Player.objects.filter(id=player_id).exists():
+                    raise Player.DoesNotExist(
+                        "Player with id {} does not exist".format(player_id)
+                    )
+                raise ItemNotFoundError("Item not found in inventory")
+
+            quantity = inventory_items.values_list("quantity", flat=True).get()
+        return self._serialize_item_quantity(item, quantity)
+
+    def _serialize_item_quantity(self, item, quantity):
+        return {
+            "item_id": item.id,
+            "item_name": item.name,
+            "quantity": quantity,
+        }
 
 
 class InsufficientFundsError(Exception):
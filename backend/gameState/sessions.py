@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import sys
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    The live game of one connection.
+
+    Attributes:
+        consumer (LoonConsumer): The game.
+        opened (float): When the session opened, in monotonic seconds.
+        last_seen (float): When the client last sent a frame, in monotonic seconds.
+        tasks (set): The game's tasks that are still running.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.opened = time.monotonic()
+        self.last_seen = self.opened
+        self.tasks = set()
+
+    def memory_usage(self):
+        """
+        Estimate the memory held by the game: its wave, the loons shown, pending pops,
+        queued messages and unwritten replay records.
+
+        Returns:
+            int: The estimated size in bytes.
+        """
+        consumer = self.consumer
+        size = sys.getsizeof(consumer.__dict__) + sys.getsizeof(consumer.loon_batch)
+        size += sys.getsizeof(consumer.pending_pops)
+        if consumer.loon_wave is not None:
+            size += consumer.loon_wave.memory_usage()
+        if consumer.outbound is not None:
+            size += sys.getsizeof(consumer.outbound.messages)
+        if consumer.recorder is not None:
+            size += len(consumer.recorder.buffer)
+        return size
+
+    def as_dict(self, now):
+        consumer = self.consumer
+        return {
+            "player_id": str(consumer.player_id),
+            "age": now - self.opened,
+            "idle": now - self.last_seen,
+            "wave": getattr(consumer, "wave", None),
+            "loons": len(consumer.loon_wave.loons) if consumer.loon_wave is not None else 0,
+            "tasks": len(self.tasks),
+            "memory_bytes": self.memory_usage(),
+        }
+
+
+class SessionRegistry:
+    """
+    Process-wide registry of the live games, owning the tasks each game starts.
+
+    A game opens its session once it is set up and closes it when its client
+    disconnects. Closing cancels every task the game still runs (a wave
+    change, a game over, a pending close), so nothing keeps simulating,
+    sending or holding the wave after the client is gone.
+
+    Sessions whose client sent nothing for ``idle_timeout`` seconds are
+    closed by a reaper task. On ASGI shutdown drain() closes every session,
+    letting each game flush its player's state, and then writes back the
+    rest of the player cache.
+
+    Closed games are tracked with weak references until they are garbage
+    collected, and tasks cancelled on close until they finish, so games and
+    tasks that outlive their session show up in status().
+
+    Attributes:
+        idle_timeout (float): Seconds without a frame from the client before a session is closed, 0 to never.
+        drain_timeout (float): Most seconds drain() waits for the games to close.
+        sessions (dict): The open sessions by game.
+        cancelled (set): Tasks cancelled on close that did not finish yet.
+        closed_games (WeakSet): Games whose session closed and that are still in memory.
+        idle_closed (int): The number of sessions closed for being idle.
+        draining (bool): Whether drain() ran.
+    """
+
+    # close code sent to clients that stayed idle for longer than the idle timeout
+    IDLE_CLOSE_CODE = 4009
+    # close code sent to clients when the server shuts down
+    SHUTDOWN_CLOSE_CODE = 1001
+
+    def __init__(self, idle_timeout, drain_timeout):
+        self.idle_timeout = idle_timeout
+        self.drain_timeout = drain_timeout
+        self.sessions = {}
+        self.cancelled = set()
+        self.closed_games = weakref.WeakSet()
+        self.idle_closed = 0
+        self.draining = False
+        self.reaper = None
+
+    def open(self, consumer):
+        """
+        Open the session of a game and start the idle reaper if it is not running yet.
+
+        Args:
+            consumer (LoonConsumer): The game.
+        """
+        self.sessions[consumer] = Session(consumer)
+        if not self.idle_timeout:
+            return
+        loop = asyncio.get_running_loop()
+        if self.reaper is None or self.reaper.done() or self.reaper.get_loop() is not loop:
+            self.reaper = loop.create_task(self.reap())
+
+    def touch(self, consumer):
+        """
+        Record that the client of a game sent a frame.
+        """
+        session = self.sessions.get(consumer)
+        if session is not None:
+            session.last_seen = time.monotonic()
+
+    def spawn(self, consumer, coroutine):
+        """
+        Run a task of a game, owned by its session.
+
+        Games without a session, such as headless ones, own their tasks.
+
+        Args:
+            consumer (LoonConsumer): The game.
+            coroutine: The coroutine to run.
+
+        Returns:
+            asyncio.Task: The task.
+        """
+        task = asyncio.get_running_loop().create_task(coroutine)
+        session = self.sessions.get(consumer)
+        if session is not None:
+            session.tasks.add(task)
+            task.add_done_callback(session.tasks.discard)
+        return task
+
+    def close(self, consumer):
+        """
+        Close the session of a game, cancelling the tasks it still runs.
+
+        Args:
+            consumer (LoonConsumer): The game.
+        """
+        session = self.sessions.pop(consumer, None)
+        if session is None:
+            return
+        current = asyncio.current_task()
+        for task in session.tasks:
+            if task is not current and not task.done():
+                task.cancel()
+                self.cancelled.add(task)
+                task.add_done_callback(self.cancelled.discard)
+        self.closed_games.add(consumer)
+
+    async def reap(self):
+        """
+        Close the sessions that stayed idle for too long, for as long as there are sessions.
+        """
+        interval = max(1.0, self.idle_timeout / 4)
+        while self.sessions:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session in list(self.sessions.values()):
+                if now - session.last_seen > self.idle_timeout and session.consumer in self.sessions:
+                    print(f"Closing idle session {session.consumer.player_id}")
+                    self.idle_closed += 1
+                    await self.expire(session.consumer, self.IDLE_CLOSE_CODE)
+
+    async def expire(self, consumer, code):
+        try:
+            await consumer.expire(code)
+        except Exception as e:
+            print(f"An error occurred while closing the session of {consumer.player_id}: {e}")
+            self.close(consumer)
+
+    async def drain(self):
+        """
+        Close every session and write back the player cache, for a graceful shutdown.
+        """
+        from .player_cache import get_player_cache
+
+        self.draining = True
+        consumers = list(self.sessions)
+        if consumers:
+            print(f"Draining {len(consumers)} sessions")
+            loop = asyncio.get_running_loop()
+            await asyncio.wait(
+                [loop.create_task(self.expire(consumer, self.SHUTDOWN_CLOSE_CODE)) for consumer in consumers],
+                timeout=self.drain_timeout,
+            )
+        for consumer in list(self.sessions):
+            self.close(consumer)
+        try:
+            await get_player_cache().flush()
+        except Exception:
+            # already reported by the cache
+            pass
+
+    async def status(self, limit=100):
+        """
+        Get the live games, the leaked tasks and games, and the memory of the sessions.
+
+        It runs on the event loop, which owns the sessions and whose tasks are searched for orphans.
+
+        Args:
+            limit (int): Most sessions listed, the ones holding the most memory first.
+
+        Returns:
+            dict: Session counts, leaks and per-session details.
+        """
+        now = time.monotonic()
+        sessions = sorted(
+            (session.as_dict(now) for session in list(self.sessions.values())),
+            key=lambda session: session["memory_bytes"],
+            reverse=True,
+        )
+        return {
+            "sessions": len(sessions),
+            "tasks": sum(session["tasks"] for session in sessions),
+            "leaked_tasks": len(self.cancelled) + len(self.orphaned_tasks()),
+            "unreleased_games": len(self.closed_games),
+            "idle_closed": self.idle_closed,
+            "idle_timeout": self.idle_timeout,
+            "draining": self.draining,
+            "memory_bytes": sum(session["memory_bytes"] for session in sessions),
+            "details": sessions[:limit],
+        }
+
+    def orphaned_tasks(self):
+        """
+        Find running tasks of games that have no open session.
+
+        Returns:
+            list: The tasks, cancelled ones still winding down excluded.
+        """
+        from .consumers import LoonConsumer
+
+        orphaned = []
+        for task in asyncio.all_tasks():
+            frame = getattr(task.get_coro(), "cr_frame", None)
+            owner = frame.f_locals.get("self") if frame is not None else None
+            if isinstance(owner, LoonConsumer) and owner not in self.sessions and task not in self.cancelled:
+                orphaned.append(task)
+        return orphaned
+
+
+_session_registry = None
+
+
+def get_session_registry():
+    """
+    Get the process-wide session registry, creating it on first use.
+
+    Returns:
+        SessionRegistry: The shared registry.
+    """
+    global _session_registry
+    if _session_registry is None:
+        _session_registry = SessionRegistry(settings.LOON_IDLE_TIMEOUT, settings.LOON_DRAIN_TIMEOUT)
+    return _session_registry
+
+
+async def warm_caches():
+    """
+    Load the caches the first requests would otherwise load, in a thread since it queries the database.
+
+    A cache that cannot be loaded yet, on a database still being migrated
+    for instance, is loaded on first use instead.
+    """
+    from .catalog import get_item_catalog
+    from .leaderboard import get_leaderboard
+
+    # warming the item catalog so the first purchases and game starts skip the lookup
+    try:
+        await sync_to_async(get_item_catalog().warm)()
+    except DatabaseError as e:
+        logger.warning("Could not warm the item catalog, it will be loaded on first use: %s", e)
+
+    # building the leaderboard up front, it is then kept up to date in memory
+    try:
+        await sync_to_async(get_leaderboard().rebuild)()
+    except DatabaseError as e:
+        logger.warning("Could not build the leaderboard, it will be built on first use: %s", e)
+
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan handler, warms the caches when the server starts and drains the sessions when it shuts down.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await warm_caches()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await get_session_registry().drain()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
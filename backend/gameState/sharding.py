@@ -0,0 +1,510 @@
+import asyncio
+import signal
+import threading
+import time
+import uuid
+import zlib
+
+from asgiref.sync import async_to_sync
+from channels.consumer import AsyncConsumer
+from channels.exceptions import ChannelFull
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.worker import Worker
+from django.conf import settings
+
+from .consumers import LoonConsumer
+from .leaderboard import get_leaderboard
+from .metrics import OPEN_SOCKETS, RATE_LIMITED, STALLED_DISCONNECTS
+from .outbound import OutboundQueue
+from .player_cache import get_player_cache
+from .protocol import PROTOCOLS, JsonProtocol, negotiate_protocol
+from .ratelimit import connection_bucket, get_admission
+from .scheduler import get_scheduler
+from .sessions import get_session_registry
+
+
+def shard_channel(shard):
+    """
+    Get the channel a shard worker listens on.
+
+    Args:
+        shard (int): The number of the shard.
+
+    Returns:
+        str: The channel name, passed to ``manage.py runshard``.
+    """
+    return "loon-shard-{}".format(shard)
+
+
+def shard_for(player_id, shards):
+    """
+    Get the shard owning the game of a player.
+
+    The player ID is hashed with CRC32 rather than hash(), which is salted
+    per process, so every front process routes a player to the same shard.
+
+    Args:
+        player_id (str): The ID of the player.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The number of the shard.
+    """
+    return zlib.crc32(str(player_id).encode()) % shards
+
+
+class ShardGame(LoonConsumer):
+    """
+    A game running in a shard worker, for a client connected to a front process.
+
+    The game plays exactly like a LoonConsumer on the shard's scheduler, but
+    its messages are encoded here and sent over the channel layer to the
+    front consumer holding the client's WebSocket, which queues them.
+
+    Attributes:
+        reply_channel (str): The channel of the front consumer holding the client's WebSocket.
+        games (dict): The games of the shard by player ID, the game leaves it when it ends.
+    """
+
+    def __init__(self, channel_layer, reply_channel, games):
+        super().__init__()
+        self.channel_layer = channel_layer
+        self.reply_channel = reply_channel
+        self.games = games
+
+    async def disconnect(self, close_code):
+        if self.games.get(self.player_id) is self:
+            del self.games[self.player_id]
+        await super().disconnect(close_code)
+
+    async def close(self, code=None):
+        """
+        Asks the front consumer to close the client's WebSocket.
+        """
+        await self.channel_layer.send(self.reply_channel, {"type": "game.close", "code": code})
+
+    async def expire(self, code):
+        """
+        Asks the front consumer to close the client's WebSocket and cleans the game up.
+
+        The WebSocket is held by the front process, so unlike in a
+        LoonConsumer there is no open socket to check first.
+
+        Args:
+            code (int): The WebSocket close code.
+        """
+        try:
+            await self.close(code=code)
+        except Exception as e:
+            print(f"An error occurred while closing the websocket connection of {self.player_id}: {e}")
+        await self.disconnect(code)
+
+    async def publish(self, data, control=False):
+        """
+        Sends data to the front consumer of the client.
+
+        Args:
+            data (dict): The data to send.
+            control (bool): True for messages that must not be dropped, False for position frames.
+
+        Returns:
+            bool: True if the data was sent, False if the front consumer stopped reading.
+        """
+        started = self.profiler.clock()
+        message = self.protocol.encode(data)
+        self.profiler.record("serialize", started, self.player_id)
+        try:
+            await self.channel_layer.send(
+                self.reply_channel, {"type": "game.send", "control": control, **message}
+            )
+            return True
+        except ChannelFull:
+            print(f"The front consumer of {self.player_id} is not reading, leaving the scheduler")
+            get_scheduler().unregister(self)
+            return False
+
+
+class ShardConsumer(AsyncConsumer):
+    """
+    Shard worker consumer, runs the games the front processes route to its shard.
+
+    It listens on ``shard_channel(shard)`` for:
+
+    - ``game.start``: set up the game of a player, sending its messages to ``reply_channel``.
+    - ``game.receive``: a frame the player's client sent, passed on to its game undecoded.
+    - ``game.stop``: the client disconnected, end its game.
+    - ``shard.status``: reply to ``reply_channel`` with the load of the shard.
+    - ``player.spend``: coins the player spent through the REST API of a front process.
+
+    Attributes:
+        shard (int): The number of the shard.
+        games (dict): The shard's games by player ID.
+    """
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.games = {}
+
+    async def game_start(self, event):
+        player_id = event["player_id"]
+        try:
+            previous = self.games.pop(player_id, None)
+            if previous is not None:
+                await previous.disconnect(1000)
+            game = ShardGame(self.channel_layer, event["reply_channel"], self.games)
+            game.protocol = PROTOCOLS.get(event.get("protocol"), JsonProtocol)()
+            self.games[player_id] = game
+            await game.start_game(player_id, event.get("engine"), event.get("sync") == "delta")
+        except Exception as e:
+            print(f"An error occurred while starting the game of {player_id} on shard {self.shard}: {e}")
+
+    async def game_receive(self, event):
+        game = self.games.get(event["player_id"])
+        if game is not None:
+            await game.receive(text_data=event.get("text_data"), bytes_data=event.get("bytes_data"))
+
+    async def game_stop(self, event):
+        game = self.games.pop(event["player_id"], None)
+        if game is None:
+            return
+        try:
+            await game.disconnect(1000)
+        except Exception as e:
+            print(f"An error occurred while stopping the game of {event['player_id']} on shard {self.shard}: {e}")
+
+    async def shard_status(self, event):
+        await self.channel_layer.send(event["reply_channel"], {"type": "shard.load", **self.load()})
+
+    async def player_spend(self, event):
+        # already in the database, only the cached coins the game reports are behind
+        get_player_cache().spend_coins(event["player_id"], event["coins"])
+
+    def load(self):
+        """
+        Get the load of the shard.
+
+        Returns:
+            dict: The shard's games, active games and loons, its scheduler status and leaderboard.
+        """
+        scheduler = get_scheduler()
+        return {
+            "shard": self.shard,
+            "games": len(self.games),
+            "active_games": len(scheduler.games),
+            "loons": sum(len(game.loon_batch) for game in self.games.values()),
+            "scheduler": scheduler.status(),
+            # the front serves the leaderboard, merging the boards of the shards
+            "leaderboard": get_leaderboard().top(),
+        }
+
+
+class ShardWorker(Worker):
+    """
+    Channels worker running shards, started by ``manage.py runshard``.
+
+    On SIGINT or SIGTERM it stops taking messages and drains its sessions
+    like the ASGI lifespan shutdown of a single process: every client's
+    WebSocket is closed through its front consumer and the players' state
+    is written back before the worker exits.
+    """
+
+    async def handle(self):
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+        listening = loop.create_task(super().handle())
+        stopped = loop.create_task(stopping.wait())
+        await asyncio.wait([listening, stopped], return_when=asyncio.FIRST_COMPLETED)
+        listening.cancel()
+        stopped.cancel()
+        await get_session_registry().drain()
+        if listening.done() and not listening.cancelled():
+            # a listener failed, such as on a channel layer error
+            listening.result()
+
+
+class ShardedLoonConsumer(AsyncWebsocketConsumer):
+    """
+    WebSocket consumer of the front process in sharded mode.
+
+    It only holds the client's WebSocket: the game runs in the worker of the
+    shard owning the player, frames from the client are forwarded to it
+    undecoded and its messages come back as ``game.send`` events, which go
+    through the connection's OutboundQueue like in a single process. The
+    shard closes the WebSocket of a game it ends with ``game.close``.
+
+    Attributes:
+        protocol (JsonProtocol): The wire protocol negotiated with the client.
+        shard_channel (str): The channel of the shard owning the game.
+        outbound (OutboundQueue): Encoded messages waiting to be sent to the client.
+        receive_bucket (TokenBucket): Limits the frames the connection may send, None for no limit.
+            The shard limits the player.
+    """
+
+    query_param = LoonConsumer.query_param
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = None
+        self.receive_bucket = connection_bucket()
+        self.rate_limited = False
+
+    async def connect(self):
+        subprotocols = self.scope.get("subprotocols", [])
+        self.protocol = negotiate_protocol(subprotocols, self.query_param("protocol"))
+        if self.protocol.subprotocol in subprotocols:
+            await self.accept(self.protocol.subprotocol)
+        else:
+            await self.accept()
+        self.player_id = self.scope["url_route"]["kwargs"]["player_id"]
+        # the shards' game counts are the cached ones, never fetched on the event loop
+        if not get_admission().admit(self.player_id):
+            RATE_LIMITED.labels("admission").inc()
+            await self.close(code=LoonConsumer.BUSY_CLOSE_CODE)
+            return
+        OPEN_SOCKETS.inc()
+        self.outbound = OutboundQueue(
+            self.send_encoded, settings.LOON_OUTBOUND_QUEUE_SIZE, settings.LOON_STALL_TIMEOUT
+        )
+        self.shard_channel = shard_channel(shard_for(self.player_id, settings.LOON_SHARDS))
+        await self.channel_layer.send(self.shard_channel, {
+            "type": "game.start",
+            "player_id": self.player_id,
+            "reply_channel": self.channel_name,
+            "protocol": self.protocol.name,
+            "engine": self.query_param("engine", settings.LOON_WAVE_ENGINE),
+            "sync": self.query_param("sync"),
+        })
+
+    async def disconnect(self, close_code):
+        if self.outbound is None:
+            return
+        self.outbound.close()
+        self.outbound = None
+        OPEN_SOCKETS.dec()
+        await self.channel_layer.send(self.shard_channel, {"type": "game.stop", "player_id": self.player_id})
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # frames over the connection's rate are dropped here rather than sent on to the shard
+        if self.receive_bucket is not None and not self.receive_bucket.take():
+            RATE_LIMITED.labels("receive").inc()
+            if not self.rate_limited and self.outbound is not None:
+                self.rate_limited = True
+                self.outbound.put(self.protocol.encode({"error": "Rate limit exceeded"}), True)
+            return
+        self.rate_limited = False
+        await self.channel_layer.send(self.shard_channel, {
+            "type": "game.receive",
+            "player_id": self.player_id,
+            "text_data": text_data,
+            "bytes_data": bytes_data,
+        })
+
+    async def game_send(self, event):
+        """
+        Queues a message of the game for the client, disconnecting it if it stopped reading.
+        """
+        if self.outbound is None:
+            return
+        if self.outbound.stalled():
+            print(f"Disconnecting stalled client {self.player_id}: {self.outbound.stats()}")
+            STALLED_DISCONNECTS.inc()
+            await self.disconnect(LoonConsumer.STALLED_CLOSE_CODE)
+            asyncio.get_running_loop().create_task(self.close(code=LoonConsumer.STALLED_CLOSE_CODE))
+            return
+        message = {"text_data": event.get("text_data"), "bytes_data": event.get("bytes_data")}
+        self.outbound.put(message, event["control"])
+
+    async def game_close(self, event):
+        """
+        Closes the client's WebSocket for the game, which the server ended.
+        """
+        await self.close(code=event["code"])
+
+    async def send_encoded(self, message):
+        try:
+            await self.send(**message)
+            return True
+        except RuntimeError as e:
+            print(f"An error occurred while sending data, websocket connection closed {e}")
+            return False
+
+
+class ShardDirectory:
+    """
+    The front's view of the shards, used to place new games.
+
+    Loads are requested from every shard with a ``shard.status`` message and
+    cached for ``stats_ttl`` seconds. New player IDs are drawn until one
+    hashes to the least loaded shard, so new games go where there is room
+    while a player's game always stays on the shard its ID hashes to. IDs
+    handed out since the last refresh are counted on their shard for
+    placing games only, so a burst of starts spreads over the shards, while
+    the reported loads stay what the shards run for the admission cap.
+
+    The loads also carry the leaderboard of every shard, which are merged
+    into the front's leaderboard on every refresh.
+
+    Attributes:
+        shards (int): The number of shards.
+        stats_ttl (float): Seconds the loads are cached.
+        stats_timeout (float): Seconds to wait for the shards to reply.
+        loads (dict): The last load reported by each shard, by shard number.
+        fetched_at (float): When the loads were fetched, None before the first fetch.
+        fetching (bool): Whether a thread is fetching the loads.
+        placed (dict): The games placed on each shard since the loads were fetched, by shard number.
+    """
+
+    # most IDs drawn per shard while looking for one that hashes to the least loaded shard
+    MAX_DRAWS = 64
+
+    def __init__(self, shards, stats_ttl, stats_timeout):
+        self.shards = shards
+        self.stats_ttl = stats_ttl
+        self.stats_timeout = stats_timeout
+        self.loads = {}
+        self.fetched_at = None
+        self.fetching = False
+        self.placed = {}
+        self.lock = threading.Lock()
+
+    async def fetch_loads(self):
+        """
+        Ask every shard for its load, waiting at most ``stats_timeout`` seconds for the replies.
+
+        Returns:
+            dict: The loads of the shards that replied, by shard number.
+        """
+        loop = asyncio.get_running_loop()
+        channel_layer = get_channel_layer()
+        reply_channel = await channel_layer.new_channel()
+        for shard in range(self.shards):
+            await channel_layer.send(shard_channel(shard), {"type": "shard.status", "reply_channel": reply_channel})
+
+        loads = {}
+        deadline = loop.time() + self.stats_timeout
+        while len(loads) < self.shards:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(channel_layer.receive(reply_channel), remaining)
+            except asyncio.TimeoutError:
+                break
+            message.pop("type", None)
+            loads[message["shard"]] = message
+        return loads
+
+    def get_loads(self, refresh=False):
+        """
+        Get the loads of the shards, fetching them when the cached ones are too old.
+
+        Args:
+            refresh (bool): Fetch the loads even if the cached ones are recent.
+
+        Returns:
+            dict: The loads of the shards that replied, by shard number.
+        """
+        with self.lock:
+            stale = self.fetched_at is None or time.monotonic() - self.fetched_at > self.stats_ttl
+            # one thread fetches the stale loads, the others go on with the cached ones meanwhile
+            if not refresh and (not stale or self.fetching):
+                return self.loads
+            self.fetching = True
+        try:
+            # the shards are asked without holding the lock, which every game start takes
+            loads = async_to_sync(self.fetch_loads)()
+        finally:
+            with self.lock:
+                self.fetching = False
+        leaderboard = get_leaderboard()
+        for load in loads.values():
+            for entry in load.pop("leaderboard", []):
+                leaderboard.update(entry["player_id"], entry["score"], entry["status"])
+        with self.lock:
+            self.loads = loads
+            self.fetched_at = time.monotonic()
+            self.placed = {}
+        return loads
+
+    def least_loaded(self):
+        """
+        Get the shard with the fewest games, counting the games placed since the last refresh.
+
+        Returns:
+            int: The number of the shard, None if no shard replied.
+        """
+        loads = self.get_loads()
+        with self.lock:
+            if not loads:
+                return None
+            return min(loads, key=lambda shard: (loads[shard]["games"] + self.placed.get(shard, 0), shard))
+
+    def new_player_id(self):
+        """
+        Draw the ID of a new player, owned by the least loaded shard.
+
+        Returns:
+            uuid.UUID: The player ID, hashing to any shard when no shard replied.
+        """
+        shard = self.least_loaded()
+        player_id = uuid.uuid4()
+        if shard is None:
+            return player_id
+        for _ in range(self.shards * self.MAX_DRAWS):
+            if shard_for(player_id, self.shards) == shard:
+                break
+            player_id = uuid.uuid4()
+        with self.lock:
+            shard = shard_for(player_id, self.shards)
+            self.placed[shard] = self.placed.get(shard, 0) + 1
+        return player_id
+
+
+def forward_spend(player_id, coins):
+    """
+    Tell the shard owning a player about coins spent through the REST API, from a request thread.
+
+    Args:
+        player_id (str): The ID of the player.
+        coins (int): The number of coins spent.
+    """
+    channel = shard_channel(shard_for(player_id, settings.LOON_SHARDS))
+    try:
+        async_to_sync(get_channel_layer().send)(
+            channel, {"type": "player.spend", "player_id": str(player_id), "coins": coins}
+        )
+    except Exception as e:
+        print(f"An error occurred while forwarding the purchase of {player_id} to its shard: {e}")
+
+
+_shard_directory = None
+
+
+def get_shard_directory():
+    """
+    Get the process-wide shard directory, creating it on first use.
+
+    Returns:
+        ShardDirectory: The shared shard directory.
+    """
+    global _shard_directory
+    if _shard_directory is None:
+        _shard_directory = ShardDirectory(
+            settings.LOON_SHARDS, settings.LOON_SHARD_STATS_TTL, settings.LOON_SHARD_STATS_TIMEOUT
+        )
+    return _shard_directory
+
+
+def new_player_id():
+    """
+    Draw the ID of a new player, placing its game on the least loaded shard in sharded mode.
+
+    Returns:
+        uuid.UUID: The player ID.
+    """
+    if settings.LOON_SHARDS:
+        return get_shard_directory().new_player_id()
+    return uuid.uuid4()
@@ -0,0 +1,14 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .catalog import get_item_catalog
+from .models import Item
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_catalog(sender, **kwargs):
+    """
+    Drop the cached item catalog whenever an Item changes.
+    """
+    get_item_catalog().invalidate()
@@ -0,0 +1,376 @@
+import asyncio
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from .consumers import LoonConsumer
+from .loon_logic import get_wave_engine
+from .offload import SharedVectorLoonWave, get_offload_pool
+from .protocol import PROTOCOLS
+from .replay import ReplayRecorder, state_digest
+
+
+class HeadlessPlayerService:
+    """
+    In-memory stand-in for PlayerService, so simulated games never touch the database.
+
+    Attributes:
+        score (int): The player's score.
+        coins (int): The player's coins.
+        status (str): The player's game status.
+    """
+
+    def __init__(self, coins):
+        self.score = 0
+        self.coins = coins
+        self.status = "PLAYING"
+
+    async def increase_score(self, player_id, amount):
+        self.score += amount
+        return self.score
+
+    async def add_coins(self, player_id, coins):
+        self.coins += coins
+        return self.coins
+
+    async def game_over(self, player_id):
+        self.status = "GAME_OVER"
+        return self
+
+    async def flush_player_state(self, player_id):
+        pass
+
+
+class HeadlessGame:
+    """
+    Runs the real LoonConsumer game loop without a socket or the shared scheduler.
+
+    Frames go to a stub send that only counts them, and a simulated popper
+    pops every loon the client can see with probability ``hit_rate`` per tick
+    through the consumer's own receive. A frame is sent every ``send_every``
+    ticks; the popper sees the game state itself, so the game plays out the
+    same at any send rate.
+
+    Attributes:
+        consumer (LoonConsumer): The consumer being driven.
+        hit_rate (float): Probability that a visible loon gets popped on a tick.
+        max_waves (int): Stop the game after this many waves, None to play until game over.
+        send_every (int): The number of ticks between two frames.
+        frames (int): The number of frames sent.
+        bytes_sent (int): The total size of the frames sent.
+        pops (int): The number of pops sent.
+    """
+
+    def __init__(self, player_id, engine, protocol, hit_rate, max_waves, initial_coins=400, send_every=1):
+        self.consumer = LoonConsumer()
+        # headless games run faster than real time, the receive rate limits would drop their pops
+        self.consumer.receive_bucket = self.consumer.receive_limiter = None
+        self.consumer.player_id = player_id
+        self.consumer.wave_engine = get_wave_engine(engine)
+        self.consumer.protocol = PROTOCOLS[protocol]()
+        self.consumer.player_service = HeadlessPlayerService(initial_coins)
+        self.consumer.send = self.send
+        self.hit_rate = hit_rate
+        self.max_waves = max_waves
+        self.send_every = send_every
+        self.ticks = 0
+        self.frames = 0
+        self.bytes_sent = 0
+        self.pops = 0
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        self.frames += 1
+        self.bytes_sent += len(text_data if text_data is not None else bytes_data)
+
+    async def skip_to_wave(self, wave):
+        """
+        Start the game at a later wave, applying the difficulty increase of every skipped wave.
+
+        Args:
+            wave (int): The wave to start at.
+        """
+        consumer = self.consumer
+        skipped = wave - consumer.wave
+        # the same steps LoonConsumer.next_wave takes once per wave
+        consumer.wave = wave
+        consumer.start_point_range += 10 * skipped
+        consumer.num_loons += 5 * skipped
+        await consumer.initialize_wave(
+            consumer.num_loons, consumer.base_start_point, consumer.start_point_range, consumer.end_point
+        )
+
+    @property
+    def running(self):
+        consumer = self.consumer
+        if consumer.is_game_over:
+            return False
+        return self.max_waves is None or consumer.wave <= self.max_waves
+
+    async def tick(self):
+        """
+        Run one tick of the game: simulate, send if a frame is due, then apply this tick's pops.
+        """
+        consumer = self.consumer
+        await consumer.simulate()
+        if consumer.transition is not None:
+            # a wave change or the game over, run it to completion
+            await consumer.transition
+            return
+        if consumer.is_game_over:
+            return
+
+        self.ticks += 1
+        if self.ticks % self.send_every == 0:
+            data = consumer.frame()
+            if data is not None:
+                await consumer.publish(data)
+        for loon_id in self.targets():
+            self.pops += 1
+            await consumer.receive(
+                text_data=json.dumps({"action": "popLoon", "loonId": loon_id})
+            )
+
+    def targets(self):
+        """
+        Pick the loons the popper hits this tick, among those shown to the client.
+        """
+        consumer = self.consumer
+        visible = [loon.loon_id for loon in consumer.loon_wave.active_loons(consumer.batch_size)]
+        return [loon_id for loon_id in visible if random.random() < self.hit_rate]
+
+
+class GCPauseTimer:
+    """
+    Measures how long the garbage collector pauses the process, through gc.callbacks.
+
+    Attributes:
+        pauses (list): The duration of every collection in seconds.
+    """
+
+    def __init__(self):
+        self.pauses = []
+        self.started = None
+
+    def __enter__(self):
+        gc.callbacks.append(self.callback)
+        return self
+
+    def __exit__(self, *exc_info):
+        gc.callbacks.remove(self.callback)
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.started = time.perf_counter()
+        elif self.started is not None:
+            self.pauses.append(time.perf_counter() - self.started)
+            self.started = None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+async def run_simulation(
+    games, engine="python", protocol="json", hit_rate=0.1, max_waves=None, seed=None, trace_malloc=False,
+    start_wave=1, send_every=1, replay_dir=None,
+):
+    """
+    Play games headless, stepping them round-robin like the scheduler does, and
+    measure the game loop.
+
+    Args:
+        games (int): The number of games to play.
+        engine (str): The wave engine to run the games on.
+        protocol (str): The wire protocol used to encode frames.
+        hit_rate (float): Probability that a visible loon gets popped on a tick.
+        max_waves (int, optional): Stop each game after this many waves.
+        seed (int, optional): Seed of the random module, for comparable runs.
+        trace_malloc (bool): Also report the peak memory traced by tracemalloc, slows the run down.
+        start_wave (int): The wave games start at, to measure late waves directly.
+        send_every (int): The number of ticks between two frames.
+        replay_dir (str, optional): Write the replay log of every game to this directory.
+
+    Returns:
+        dict: The benchmark report.
+    """
+    if seed is not None:
+        random.seed(seed)
+
+    if trace_malloc:
+        tracemalloc.start()
+    headless_games = []
+    for game_number in range(games):
+        game = HeadlessGame(
+            "headless-{}".format(game_number), engine, protocol, hit_rate, max_waves, send_every=send_every
+        )
+        if replay_dir:
+            consumer = game.consumer
+            consumer.recorder = ReplayRecorder.open(
+                replay_dir, consumer.player_id, consumer.seed, engine, consumer.time_step
+            )
+        await game.consumer.setup_game()
+        if start_wave > 1:
+            await game.skip_to_wave(start_wave)
+        headless_games.append(game)
+
+    tick_durations = []
+    collections_before = sum(stat["collections"] for stat in gc.get_stats())
+    blocks_before = sys.getallocatedblocks()
+    started = time.perf_counter()
+
+    live = list(headless_games)
+    with GCPauseTimer() as gc_pauses:
+        while live:
+            for game in live:
+                tick_started = time.perf_counter()
+                await game.tick()
+                tick_durations.append(time.perf_counter() - tick_started)
+            live = [game for game in live if game.running]
+
+    elapsed = time.perf_counter() - started
+    for game in headless_games:
+        # games stopped at max_waves end like a client leaving
+        if game.consumer.recorder is not None:
+            game.consumer.recorder.end(
+                game.consumer.steps, game.consumer.wave, "disconnected", state_digest(game.consumer)
+            )
+    blocks_after = sys.getallocatedblocks()
+    collections_after = sum(stat["collections"] for stat in gc.get_stats())
+    peak_traced = None
+    traced_per_game = None
+    if trace_malloc:
+        current_traced, peak_traced = tracemalloc.get_traced_memory()
+        # every game is still referenced here, so this is what the games hold at their last wave
+        traced_per_game = current_traced / games
+        tracemalloc.stop()
+
+    ticks = len(tick_durations)
+    busy = sum(tick_durations)
+    tick_durations.sort()
+    return {
+        "games": games,
+        "engine": engine,
+        "protocol": protocol,
+        "hit_rate": hit_rate,
+        "send_every": send_every,
+        "waves": sum(game.consumer.wave for game in headless_games),
+        "max_wave": max(game.consumer.wave for game in headless_games),
+        "ticks": ticks,
+        "elapsed": elapsed,
+        "ticks_per_second": ticks / busy if busy else 0.0,
+        "tick_p50": percentile(tick_durations, 0.5),
+        "tick_p90": percentile(tick_durations, 0.9),
+        "tick_p99": percentile(tick_durations, 0.99),
+        "tick_max": tick_durations[-1] if tick_durations else 0.0,
+        "frames": sum(game.frames for game in headless_games),
+        "bytes_sent": sum(game.bytes_sent for game in headless_games),
+        "pops": sum(game.pops for game in headless_games),
+        # net memory blocks still allocated per tick, and garbage collections as a proxy for allocation churn
+        "retained_blocks_per_tick": (blocks_after - blocks_before) / ticks if ticks else 0.0,
+        "gc_collections_per_1k_ticks": 1000 * (collections_after - collections_before) / ticks if ticks else 0.0,
+        "peak_traced_bytes": peak_traced,
+        "traced_bytes_per_game": traced_per_game,
+        "gc_pauses": len(gc_pauses.pauses),
+        "gc_pause_total": sum(gc_pauses.pauses),
+        "gc_pause_max": max(gc_pauses.pauses, default=0.0),
+    }
+
+
+def bench_wave_sizes(engine, sizes, batch_size=20, ticks=1000):
+    """
+    Time the per-tick wave work (update plus frame batch) against the size of the wave.
+
+    With the active-loon index the cost should stay flat as the wave grows.
+    The full scan the frame used to be built with is timed next to it for reference.
+
+    Args:
+        engine (str): The wave engine to benchmark.
+        sizes (list): The wave sizes to measure.
+        batch_size (int): The number of loons shown per tick.
+        ticks (int): The number of ticks timed per size.
+
+    Returns:
+        list: One dict per size with the mean seconds per tick of both approaches.
+    """
+    wave_engine = get_wave_engine(engine)
+    results = []
+    for size in sizes:
+        wave = wave_engine()
+        # far from the end point so no loon escapes during the run
+        for _ in range(size):
+            wave.add_loon((1e9, 1e9), (0, 0), 1)
+
+        started = time.perf_counter()
+        for _ in range(ticks):
+            wave.update_loons(batch_size)
+            wave.active_loons(batch_size)
+        indexed = (time.perf_counter() - started) / ticks
+
+        started = time.perf_counter()
+        for _ in range(ticks):
+            [loon for loon in wave.loons.values() if loon.active][:batch_size]
+        full_scan = (time.perf_counter() - started) / ticks
+
+        results.append({"size": size, "indexed_tick": indexed, "full_scan_frame": full_scan})
+    return results
+
+
+async def bench_offload(sizes, games=4, ticks=200):
+    """
+    Time wave steps run in process against steps offloaded to the process pool.
+
+    Every size runs ``games`` waves of that many loons, all stepped each
+    tick, as the scheduler does. In process the event loop does all the
+    work. Offloaded, the steps of all games run in the pool side by side and
+    the loop only sends and receives them, so besides the wall time per tick
+    the CPU time the server process spent is reported. Offloading pays off
+    where that CPU time drops below the in process tick.
+
+    Args:
+        sizes (list): The wave sizes to measure.
+        games (int): The number of waves stepped per tick.
+        ticks (int): The number of ticks timed per size and mode.
+
+    Returns:
+        list: One dict per size with the mean seconds per tick of each mode.
+    """
+    results = []
+    for size in sizes:
+        waves = []
+        for seed in range(games):
+            wave = SharedVectorLoonWave.seeded(seed)
+            # far from the end point so no loon escapes during the run
+            for _ in range(size):
+                wave.add_loon((1e9, 1e9), (0, 0), 1)
+            waves.append(wave)
+        # starting the workers and mapping the buffers in them outside the timing
+        await asyncio.gather(*(wave.update_loons_offloaded(size) for wave in waves))
+
+        started = time.perf_counter()
+        for _ in range(ticks):
+            for wave in waves:
+                wave.update_loons(size)
+        in_process = (time.perf_counter() - started) / ticks
+
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        for _ in range(ticks):
+            await asyncio.gather(*(wave.update_loons_offloaded(size) for wave in waves))
+        offloaded = (time.perf_counter() - started) / ticks
+        offloaded_cpu = (time.process_time() - cpu_started) / ticks
+
+        results.append({
+            "size": size,
+            "games": games,
+            "workers": get_offload_pool()._max_workers,
+            "in_process_tick": in_process,
+            "offloaded_tick": offloaded,
+            "offloaded_loop_cpu": offloaded_cpu,
+        })
+    return results
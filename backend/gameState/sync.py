@@ -0,0 +1,113 @@
+class DeltaSync:
+    """
+    Builds delta-compressed loon state frames for one connection.
+
+    Every frame carries a sequence number. A full keyframe is sent every
+    ``keyframe_interval`` frames, when the client asks for a resync and while
+    the client has not acknowledged any frame yet. Other frames only carry
+    what changed since the last frame the client acknowledged (``base``):
+    spawned loons, removed loon ids and position deltas of moved loons.
+
+    Positions are quantized to integers, 1/POSITION_SCALE of a coordinate
+    unit, so deltas add up exactly on the client.
+
+    Attributes:
+        keyframe_interval (int): Number of frames between two keyframes.
+        sequence (int): The sequence number of the last frame built.
+        acked (int): The sequence number of the last acknowledged frame, if any.
+    """
+
+    POSITION_SCALE = 4
+    # how many unacknowledged frames are kept around as possible delta bases
+    HISTORY_SIZE = 64
+
+    def __init__(self, keyframe_interval):
+        self.keyframe_interval = keyframe_interval
+        self.sequence = 0
+        self.acked = None
+        self.acked_state = None
+        self.sent = {}
+        self.force_keyframe = True
+
+    def reset(self):
+        """
+        Forget all client state, e.g. when a new wave reuses loon ids.
+        """
+        self.acked = None
+        self.acked_state = None
+        self.sent.clear()
+        self.force_keyframe = True
+
+    def resync(self):
+        """
+        Start over from a keyframe, called when the client detects a gap.
+
+        The client dropped its state, so the frame it acknowledged last is
+        no base for deltas anymore: keyframes are sent until it acknowledges
+        a new one.
+        """
+        self.acked = None
+        self.acked_state = None
+        self.force_keyframe = True
+
+    def ack(self, sequence):
+        """
+        Record that the client has applied the frame with the given sequence number.
+
+        Args:
+            sequence (int): The acknowledged sequence number.
+        """
+        state = self.sent.get(sequence)
+        if state is None or (self.acked is not None and sequence <= self.acked):
+            return
+        self.acked = sequence
+        self.acked_state = state
+        self.sent = {seq: sent for seq, sent in self.sent.items() if seq > sequence}
+
+    def frame(self, loons):
+        """
+        Build the next frame for a batch of loons.
+
+        Args:
+            loons (list): The loons currently shown to the client.
+
+        Returns:
+            dict: The loonSync message.
+        """
+        self.sequence += 1
+        state = {
+            loon.loon_id: (
+                loon.loon_level,
+                round(loon.current_pos[0] * self.POSITION_SCALE),
+                round(loon.current_pos[1] * self.POSITION_SCALE),
+            )
+            for loon in loons
+        }
+        self.sent[self.sequence] = state
+        if len(self.sent) > self.HISTORY_SIZE:
+            del self.sent[min(self.sent)]
+
+        frame = {"seq": self.sequence, "scale": self.POSITION_SCALE}
+        if (
+            self.force_keyframe
+            or self.acked_state is None
+            or self.sequence % self.keyframe_interval == 0
+        ):
+            self.force_keyframe = False
+            frame["keyframe"] = True
+            frame["loons"] = [[loon_id, *loon] for loon_id, loon in state.items()]
+            return {"loonSync": frame}
+
+        base = self.acked_state
+        frame["keyframe"] = False
+        frame["base"] = self.acked
+        frame["spawns"] = [
+            [loon_id, *loon] for loon_id, loon in state.items() if loon_id not in base
+        ]
+        frame["removals"] = [loon_id for loon_id in base if loon_id not in state]
+        frame["moves"] = [
+            [loon_id, x - base[loon_id][1], y - base[loon_id][2]]
+            for loon_id, (_, x, y) in state.items()
+            if loon_id in base and (x, y) != base[loon_id][1:]
+        ]
+        return {"loonSync": frame}
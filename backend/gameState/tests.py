@@ -0,0 +1,1380 @@
+import asyncio
+import json
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import IsolatedAsyncioTestCase, mock
+
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import leaderboard, offload, player_cache, ratelimit, sessions, sharding
+from .catalog import ItemCatalog, get_item_catalog
+from .consumers import LoonConsumer
+from .game_config import get_game_config_loader
+from .loon_logic import LoonWave, VectorLoonWave
+from .models import Inventory, Item, Player
+from .offload import SharedVectorLoonWave
+from .outbound import OutboundQueue
+from .profiling import Profiler, ProfilerBusyError
+from .player_cache import PlayerStateCache
+from .ratelimit import Admission, RateLimiter
+from .scheduler import GameScheduler
+from .replay import END, WAVE, state_digest, ReplayLog, ReplayRecorder, find_logs, get_replay_writer, replay_game
+from .services import InsufficientFundsError, InsufficientQuantityError, ItemNotFoundError, PlayerService
+from .sessions import SessionRegistry, lifespan
+from .sharding import ShardConsumer, ShardDirectory, ShardedLoonConsumer, shard_channel, shard_for
+from .simulation import HeadlessGame, run_simulation
+from .sync import DeltaSync
+
+
+def create_player(coins=400):
+    return PlayerService().create_player(uuid.uuid4(), coins, [])
+
+
+class PlayerStateCacheTests(TestCase):
+    """
+    The durability guarantees of the write-behind player state cache.
+    """
+
+    def setUp(self):
+        # a flush interval no test waits for, unless it sets its own
+        self.cache = player_cache._player_cache = PlayerStateCache(60)
+        self.addCleanup(setattr, player_cache, "_player_cache", None)
+        self.player = create_player()
+
+    async def stored(self):
+        return await Player.objects.values_list("score", "coins").aget(id=self.player.id)
+
+    async def test_changes_stay_in_memory_until_flushed(self):
+        await self.cache.increase_score(self.player.id, 3)
+
+        self.assertEqual(await self.stored(), (0, 400))
+        self.assertEqual((await self.cache.get(self.player.id)).score, 3)
+        self.cache.task.cancel()
+
+    async def test_flush_on_interval(self):
+        self.cache.flush_interval = 0.01
+        await self.cache.increase_score(self.player.id, 2)
+        await self.cache.increase_score(self.player.id, 1)
+
+        await asyncio.wait_for(self.cache.task, 1)
+
+        self.assertEqual(await self.stored(), (3, 400))
+        self.assertEqual(self.cache.pending, {})
+        self.assertEqual(self.cache.stats.players_written, 1)
+
+    async def test_flush_on_evict(self):
+        await self.cache.increase_score(self.player.id, 1)
+
+        await PlayerService().flush_player_state(self.player.id)
+
+        self.assertEqual(await self.stored(), (1, 400))
+        self.assertNotIn(str(self.player.id), self.cache.players)
+        self.cache.task.cancel()
+
+    async def test_flush_on_game_over(self):
+        await self.cache.increase_score(self.player.id, 5)
+
+        player = await PlayerService().game_over(self.player.id)
+
+        self.assertEqual(player.score, 5)
+        self.assertEqual(await self.stored(), (5, 400))
+        self.cache.task.cancel()
+
+    async def test_flush_on_shutdown(self):
+        await self.cache.increase_score(self.player.id, 4)
+        sessions._session_registry = SessionRegistry(idle_timeout=0, drain_timeout=1)
+        self.addCleanup(setattr, sessions, "_session_registry", None)
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await messages.put({"type": "lifespan.startup"})
+        await messages.put({"type": "lifespan.shutdown"})
+        await lifespan({"type": "lifespan"}, messages.get, send)
+
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertEqual(await self.stored(), (4, 400))
+        self.cache.task.cancel()
+
+    async def test_failed_flush_is_retried(self):
+        await self.cache.increase_score(self.player.id, 1)
+        write = self.cache._write
+
+        def fail(pending):
+            raise RuntimeError("database is locked")
+
+        self.cache._write = fail
+        with self.assertRaises(RuntimeError):
+            await self.cache.flush()
+        self.cache._write = write
+        await self.cache.flush()
+
+        self.assertEqual(await self.stored(), (1, 400))
+        self.assertEqual(self.cache.stats.failures, 1)
+        self.cache.task.cancel()
+
+    async def test_purchases_update_the_cached_coins(self):
+        await self.cache.get(self.player.id)
+
+        await sync_to_async(PlayerService().buy_item)(self.player.id, "BasicTurret")
+
+        self.assertEqual((await self.cache.get(self.player.id)).coins, 300)
+
+    async def test_awarded_coins_stay_in_memory(self):
+        await self.cache.get(self.player.id)
+
+        coins = await PlayerService().add_coins(self.player.id, 500)
+
+        self.assertEqual(coins, 900)
+        # written back by the next flush, not by the award
+        self.assertEqual(await self.stored(), (0, 400))
+        self.assertEqual(self.cache.pending, {str(self.player.id): (0, 500)})
+        self.cache.task.cancel()
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}, LOON_SHARDS=2)
+    async def test_purchases_reach_the_shard_cache(self):
+        channel = shard_channel(shard_for(self.player.id, 2))
+        await self.cache.get(self.player.id)
+
+        await sync_to_async(PlayerService().buy_item)(self.player.id, "BasicTurret")
+        # what the shard worker owning the player does with the message
+        event = await get_channel_layer().receive(channel)
+        await ShardConsumer(shard_for(self.player.id, 2)).player_spend(event)
+
+        # this process's cache got it once from the purchase itself, once more through the shard message
+        self.assertEqual((await self.cache.get(self.player.id)).coins, 200)
+        self.assertEqual(event, {"type": "player.spend", "player_id": str(self.player.id), "coins": 100})
+
+    def test_game_over_only_writes_the_status(self):
+        with CaptureQueriesContext(connection) as queries:
+            player = async_to_sync(PlayerService().game_over)(self.player.id)
+
+        updates = [query["sql"] for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn("coins", updates[0])
+        self.assertEqual(player.status, "GAME_OVER")
+
+
+class ItemServiceTests(TestCase):
+    """
+    buy_item and use_item check and update in single conditional UPDATEs, in a constant number of queries.
+    """
+
+    def setUp(self):
+        get_item_catalog().warm()
+        self.player = create_player(coins=250)
+        self.player_service = PlayerService()
+
+    def quantity(self, item_name):
+        return Inventory.objects.get(player=self.player, item__name=item_name).quantity
+
+    def test_buy_item_queries(self):
+        self.player_service.buy_item(self.player.id, "BasicTurret")
+
+        # savepoint, coins UPDATE, inventory UPDATE, quantity and coins SELECT, release
+        with self.assertNumQueries(5):
+            inventory_item, coins = self.player_service.buy_item(self.player.id, "BasicTurret")
+
+        self.assertEqual(inventory_item["quantity"], 2)
+        self.assertEqual(coins, 50)
+        self.assertEqual(self.quantity("BasicTurret"), 2)
+
+    def test_buy_item_first_unit_creates_the_inventory_row(self):
+        # the inventory UPDATE matches no row, an INSERT follows
+        with self.assertNumQueries(6):
+            inventory_item, coins = self.player_service.buy_item(self.player.id, "BasicTurret")
+
+        self.assertEqual(inventory_item["quantity"], 1)
+        self.assertEqual(coins, 150)
+
+    def test_buy_item_insufficient_funds(self):
+        self.player_service.buy_item(self.player.id, "AdvancedTurret")
+
+        # savepoint, coins UPDATE matching no row, player EXISTS, rollback, release
+        with self.assertNumQueries(5):
+            with self.assertRaises(InsufficientFundsError):
+                self.player_service.buy_item(self.player.id, "BasicTurret")
+
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.coins, 50)
+        self.assertFalse(Inventory.objects.filter(player=self.player, item__name="BasicTurret").exists())
+
+    def test_buy_item_unknown_player(self):
+        with self.assertRaises(Player.DoesNotExist):
+            self.player_service.buy_item(uuid.uuid4(), "BasicTurret")
+
+    def test_use_item_queries(self):
+        self.player_service.buy_item(self.player.id, "BasicTurret")
+        self.player_service.buy_item(self.player.id, "BasicTurret")
+
+        # savepoint, quantity UPDATE, quantity SELECT, release
+        with self.assertNumQueries(4):
+            inventory_item = self.player_service.use_item(self.player.id, "BasicTurret")
+
+        self.assertEqual(inventory_item["quantity"], 1)
+        self.assertEqual(self.quantity("BasicTurret"), 1)
+
+    def test_use_item_insufficient_quantity(self):
+        self.player_service.buy_item(self.player.id, "BasicTurret")
+        self.player_service.use_item(self.player.id, "BasicTurret")
+
+        # savepoint, quantity UPDATE matching no row, inventory EXISTS, rollback, release
+        with self.assertNumQueries(5):
+            with self.assertRaises(InsufficientQuantityError):
+                self.player_service.use_item(self.player.id, "BasicTurret")
+        self.assertEqual(self.quantity("BasicTurret"), 0)
+
+    def test_use_item_not_in_inventory(self):
+        with self.assertRaises(ItemNotFoundError):
+            self.player_service.use_item(self.player.id, "BasicTurret")
+
+
+class ItemCatalogTests(TestCase):
+    def test_lookup_survives_a_concurrent_invalidation(self):
+        catalog = ItemCatalog()
+        warm = catalog.warm
+
+        def warm_then_invalidate():
+            # an Item saved in another thread right after the catalog loaded
+            items = warm()
+            catalog.invalidate()
+            return items
+
+        with mock.patch.object(catalog, "warm", side_effect=warm_then_invalidate):
+            item = catalog.get("BasicTurret")
+
+        self.assertEqual(item.name, "BasicTurret")
+        self.assertEqual(catalog.stats(), {"hits": 0, "misses": 1})
+        self.assertIsNone(catalog.by_name)
+
+
+class LifespanTests(TestCase):
+    """
+    The ASGI lifespan startup runs the database warm-ups on a thread, never on the event loop.
+    """
+
+    def setUp(self):
+        sessions._session_registry = SessionRegistry(idle_timeout=0, drain_timeout=1)
+        self.addCleanup(setattr, sessions, "_session_registry", None)
+        get_item_catalog().invalidate()
+        self.addCleanup(get_item_catalog().invalidate)
+        leaderboard._leaderboard = None
+        self.addCleanup(setattr, leaderboard, "_leaderboard", None)
+        self.player = create_player()
+        Player.objects.filter(id=self.player.id).update(score=7)
+
+    async def run_lifespan(self):
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await messages.put({"type": "lifespan.startup"})
+        await messages.put({"type": "lifespan.shutdown"})
+        await lifespan({"type": "lifespan"}, messages.get, send)
+        return sent
+
+    async def test_startup_warms_the_caches(self):
+        sent = await self.run_lifespan()
+
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        self.assertIn("BasicTurret", get_item_catalog().by_name)
+        self.assertTrue(leaderboard.get_leaderboard().loaded)
+        self.assertEqual(leaderboard.get_leaderboard().top()[0]["player_id"], str(self.player.id))
+
+
+class CreatePlayerTests(TestCase):
+    """
+    Players and their inventories are inserted in bulk, in as many queries for one player as for many.
+    """
+
+    inventory = [
+        {"item_name": "BasicTurret", "quantity": 2},
+        {"item_name": "AdvancedTurret", "quantity": 1},
+    ]
+
+    def setUp(self):
+        get_item_catalog().warm()
+        self.player_service = PlayerService()
+
+    def test_create_player_queries(self):
+        # savepoint, players INSERT, inventory INSERT, release
+        with self.assertNumQueries(4):
+            player = self.player_service.create_player(uuid.uuid4(), 400, self.inventory)
+
+        self.assertEqual(Inventory.objects.filter(player=player).count(), 2)
+
+    def test_create_players_queries(self):
+        ids = [uuid.uuid4() for _ in range(50)]
+
+        with self.assertNumQueries(4):
+            players = self.player_service.create_players(ids, 400, self.inventory)
+
+        self.assertEqual([player.id for player in players], ids)
+        self.assertEqual(Player.objects.filter(id__in=ids, coins=400, score=0).count(), 50)
+        self.assertEqual(Inventory.objects.filter(player_id__in=ids).count(), 100)
+
+    def test_create_players_unknown_item(self):
+        with self.assertRaises(Item.DoesNotExist):
+            self.player_service.create_players([uuid.uuid4()], 400, [{"item_name": "Cannon", "quantity": 1}])
+
+        self.assertEqual(Player.objects.count(), 0)
+
+    def test_start_batch_queries(self):
+        with self.assertNumQueries(4):
+            response = self.client.post("/game/start/batch/", {"count": 20}, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["player_ids"]), 20)
+        inventory = get_game_config_loader().get().config["game_settings"]["inventory"]
+        self.assertEqual(Inventory.objects.count(), 20 * len(inventory))
+
+
+class PendingPopsTests(SimpleTestCase):
+    """
+    Pops received between two ticks are queued and applied once by the tick, whatever order they arrive in.
+    """
+
+    async def start_game(self, engine):
+        game = HeadlessGame("pops", engine, "json", hit_rate=0, max_waves=None)
+        consumer = game.consumer
+        self.sent = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            self.sent.append(json.loads(text_data))
+
+        consumer.send = send
+        await consumer.setup_game()
+        await consumer.simulate()
+        return consumer
+
+    async def pop(self, consumer, *loon_ids):
+        if len(loon_ids) == 1:
+            message = {"action": "popLoon", "loonId": loon_ids[0]}
+        else:
+            message = {"action": "popLoons", "loonIds": list(loon_ids)}
+        await consumer.receive(text_data=json.dumps(message))
+
+    def removed(self, consumer, loon_ids):
+        wave = consumer.loon_wave
+        return [loon_id for loon_id in loon_ids if not wave.is_loon_present(loon_id)]
+
+    async def test_interleaved_pops_remove_each_loon_once(self):
+        for engine in ("python", "vector"):
+            with self.subTest(engine=engine):
+                consumer = await self.start_game(engine)
+                size = consumer.loon_wave.size()
+
+                await asyncio.gather(
+                    self.pop(consumer, 1),
+                    self.pop(consumer, 1, 2, 2),
+                    self.pop(consumer, 2),
+                    self.pop(consumer, 1),
+                )
+                # nothing is removed before the tick
+                self.assertEqual(consumer.loon_wave.size(), size)
+                self.assertEqual(self.removed(consumer, [1, 2]), [])
+
+                await consumer.simulate()
+
+                self.assertEqual(self.removed(consumer, [0, 1, 2, 3]), [1, 2])
+                self.assertEqual(consumer.loon_wave.size(), size - 2)
+                self.assertEqual(len(consumer.pending_pops), 0)
+                if engine == "python":
+                    # a loon popped several times goes back to the pool once
+                    self.assertEqual(len(consumer.loon_wave.pool), 2)
+
+    async def test_pops_of_removed_loons_are_rejected(self):
+        for engine in ("python", "vector"):
+            with self.subTest(engine=engine):
+                consumer = await self.start_game(engine)
+                await self.pop(consumer, 1)
+                await consumer.simulate()
+                size = consumer.loon_wave.size()
+                self.sent.clear()
+
+                await asyncio.gather(self.pop(consumer, 1), self.pop(consumer, 1, 3), self.pop(consumer, 999))
+                await consumer.simulate()
+
+                self.assertEqual(consumer.loon_wave.size(), size - 1)
+                self.assertEqual(self.removed(consumer, [1, 3]), [1, 3])
+                self.assertEqual(self.sent.count({"error": "Invalid action: No such loon"}), 2)
+
+    async def test_pops_during_a_tick_apply_on_the_next_one(self):
+        consumer = await self.start_game("python")
+        size = consumer.loon_wave.size()
+
+        await asyncio.gather(consumer.simulate(), self.pop(consumer, 4), self.pop(consumer, 4, 5))
+        await consumer.simulate()
+
+        self.assertEqual(self.removed(consumer, [4, 5]), [4, 5])
+        self.assertEqual(consumer.loon_wave.size(), size - 2)
+
+    async def test_pop_loons_validates_ids(self):
+        consumer = await self.start_game("python")
+        self.sent.clear()
+
+        await self.pop(consumer, True, 1, "2", 1.0, 3, 3)
+        await self.pop(consumer, *range(consumer.num_loons + 1))
+        await self.pop(consumer, False)
+        await consumer.simulate()
+
+        self.assertEqual(
+            self.sent,
+            [
+                {"popResult": {"accepted": [1, 3], "rejected": [True, "2", 1.0, 3]}},
+                {"error": "Invalid action: Too many loonIds"},
+                {"error": "Invalid action: No such loon"},
+            ],
+        )
+        self.assertEqual(self.removed(consumer, [0, 1, 2, 3]), [1, 3])
+
+
+@override_settings(LOON_MAX_GAMES=3, LOON_SHARDS=0)
+class AdmissionTests(TestCase):
+    """
+    LOON_MAX_GAMES counts the games started but not connected yet, and turns away clients connecting beyond it.
+    """
+
+    def setUp(self):
+        ratelimit._admission = None
+        self.addCleanup(setattr, ratelimit, "_admission", None)
+
+    def start(self, count=None):
+        if count is None:
+            return self.client.get("/game/start/")
+        return self.client.post("/game/start/batch/", {"count": count}, content_type="application/json")
+
+    def test_starts_reserve_their_place(self):
+        self.assertEqual(self.start(2).status_code, 200)
+        self.assertEqual(self.start(2).status_code, 503)
+        self.assertEqual(self.start().status_code, 200)
+        self.assertEqual(self.start().status_code, 503)
+
+    def test_failed_starts_give_their_places_back(self):
+        with mock.patch.object(PlayerService, "create_players", side_effect=DatabaseError("disk full")):
+            with self.assertRaises(DatabaseError):
+                self.start(3)
+
+        self.assertEqual(ratelimit.get_admission().reserved, {})
+        self.assertEqual(self.start(3).status_code, 200)
+
+    def test_reservations_expire(self):
+        admission = Admission(1, 0)
+
+        self.assertTrue(admission.reserve(["a"]))
+        self.assertTrue(admission.reserve(["b"]))
+        self.assertTrue(admission.admit("c"))
+
+    def test_connect_claims_the_reservation(self):
+        admission = Admission(2, 60)
+
+        self.assertTrue(admission.reserve(["a", "b"]))
+        self.assertFalse(admission.admit("c"))
+        self.assertTrue(admission.admit("a"))
+        self.assertTrue(admission.admit("b"))
+
+    @override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+    async def test_connect_beyond_the_cap_is_closed(self):
+        await sync_to_async(ratelimit.get_admission().reserve)(["a", "b", "c"])
+        communicator = WebsocketCommunicator(LoonConsumer.as_asgi(), "/ws/loonsLocation/d/")
+        communicator.scope["url_route"] = {"kwargs": {"player_id": "d"}}
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 1013})
+        await communicator.wait()
+
+
+class RateLimiterTests(SimpleTestCase):
+    @override_settings(LOON_API_RATE=1, LOON_API_BURST=2)
+    def test_throttle_reads_the_player_from_the_query(self):
+        ratelimit._rate_limiters.clear()
+        self.addCleanup(ratelimit._rate_limiters.clear)
+
+        # the body is never parsed once the player is over its rate
+        responses = [
+            self.client.post("/game/buy/?playerId=flooder", "{not json", content_type="application/json")
+            for _ in range(3)
+        ]
+
+        self.assertEqual([response.status_code for response in responses[:2]], [400, 400])
+        self.assertEqual(responses[2].status_code, 429)
+        self.assertIn("Retry-After", responses[2])
+
+    def test_zero_rate_disables_the_limit(self):
+        limiter = RateLimiter(0, 10)
+
+        self.assertTrue(all(limiter.allow("player") for _ in range(100)))
+        self.assertEqual(limiter.wait("player"), 0.0)
+
+    def test_negative_rate_is_rejected(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(-1, 10)
+
+
+class ReplayTests(SimpleTestCase):
+    """
+    Recorded games replay to the same final state, and every game is logged to its own file.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def written_logs(self):
+        # the writer thread runs the writes in order, so this waits for every one submitted before
+        get_replay_writer().submit(lambda: None).result()
+        return [ReplayLog.read(path) for path in find_logs([self.directory])]
+
+    async def test_replayed_game_matches_the_log(self):
+        for engine in ("python", "vector"):
+            with self.subTest(engine=engine):
+                for path in find_logs([self.directory]):
+                    os.remove(path)
+                await run_simulation(1, engine=engine, hit_rate=0.3, max_waves=3, seed=7, replay_dir=self.directory)
+                [log] = self.written_logs()
+
+                report = await replay_game(log)
+
+                self.assertTrue(report["matched"])
+                self.assertEqual(report["waves"], [tag for tag, values in log.records].count(WAVE))
+                self.assertGreaterEqual(report["waves"], 3)
+                self.assertGreater(report["pops"], 0)
+                self.assertEqual(report["end"]["outcome"], "disconnected")
+
+    def test_a_reconnect_starts_a_new_log(self):
+        for seed in (1, 2):
+            recorder = ReplayRecorder.open(self.directory, "player", seed, "python", 0.05)
+            recorder.end(0, 1, "disconnected", bytes(8))
+
+        logs = self.written_logs()
+
+        self.assertEqual(sorted(log.seed for log in logs), [1, 2])
+        for log in logs:
+            self.assertEqual([tag for tag, values in log.records], [END])
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}, LOON_SHARDS=3, LOON_MAX_GAMES=0
+)
+class ShardingTests(SimpleTestCase):
+    """
+    Players are routed to the shard their ID hashes to, and new games are placed on the least loaded shard.
+    """
+
+    def setUp(self):
+        sharding._shard_directory = None
+        self.addCleanup(setattr, sharding, "_shard_directory", None)
+
+    def test_shard_for_is_stable(self):
+        player_id = uuid.UUID("6f9619ff-8b86-d011-b42d-00c04fc964ff")
+
+        # CRC32 of the ID, the same in every process unlike hash()
+        self.assertEqual(shard_for(player_id, 3), 2)
+        self.assertEqual(shard_for(str(player_id), 3), 2)
+        self.assertEqual(shard_for(player_id, 7), 2)
+        self.assertEqual({shard_for(uuid.uuid4(), 3) for _ in range(100)}, {0, 1, 2})
+
+    async def receive_nothing(self, channel_layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel), 0.05)
+
+    async def test_messages_go_to_the_owning_shard(self):
+        channel_layer = get_channel_layer()
+        player_id = "player-1"
+        shard = shard_for(player_id, 3)
+        communicator = WebsocketCommunicator(ShardedLoonConsumer.as_asgi(), "/ws/loonsLocation/player-1/")
+        communicator.scope["url_route"] = {"kwargs": {"player_id": player_id}}
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        start = await channel_layer.receive(shard_channel(shard))
+        self.assertEqual((start["type"], start["player_id"]), ("game.start", player_id))
+
+        await communicator.send_to(text_data='{"popLoon": {"loonId": 1}}')
+        frame = await channel_layer.receive(shard_channel(shard))
+        self.assertEqual(frame["type"], "game.receive")
+        self.assertEqual(frame["text_data"], '{"popLoon": {"loonId": 1}}')
+
+        await communicator.disconnect()
+        stop = await channel_layer.receive(shard_channel(shard))
+        self.assertEqual(stop, {"type": "game.stop", "player_id": player_id})
+        for other in {0, 1, 2} - {shard}:
+            await self.receive_nothing(channel_layer, shard_channel(other))
+
+    async def serve_loads(self, games):
+        # stands in for the shard workers, replying to the status requests with fixed loads
+        channel_layer = get_channel_layer()
+        while True:
+            for shard, count in enumerate(games):
+                try:
+                    event = await asyncio.wait_for(channel_layer.receive(shard_channel(shard)), 0.01)
+                except asyncio.TimeoutError:
+                    continue
+                await channel_layer.send(event["reply_channel"], {
+                    "type": "shard.load", "shard": shard, "games": count, "leaderboard": [],
+                })
+
+    async def test_new_games_go_to_the_least_loaded_shard(self):
+        directory = ShardDirectory(3, 60, 1)
+        server = asyncio.get_running_loop().create_task(self.serve_loads([5, 1, 3]))
+        self.addCleanup(server.cancel)
+
+        player_ids = [await sync_to_async(directory.new_player_id)() for _ in range(4)]
+
+        # shard 1 fills up to the load of shard 2, wins the tie by being the lowest, then shard 2 has room
+        self.assertEqual([shard_for(player_id, 3) for player_id in player_ids], [1, 1, 1, 2])
+        # the reported loads are left to the admission cap, the placed games only steer placement
+        self.assertEqual({shard: load["games"] for shard, load in directory.loads.items()}, {0: 5, 1: 1, 2: 3})
+        self.assertEqual(directory.placed, {1: 3, 2: 1})
+
+    @override_settings(LOON_MAX_GAMES=4)
+    def test_a_start_counts_once_under_the_cap(self):
+        directory = sharding._shard_directory = ShardDirectory(3, 60, 1)
+        directory.loads = {shard: {"shard": shard, "games": games} for shard, games in enumerate([1, 1, 0])}
+        directory.fetched_at = time.monotonic()
+        admission = Admission(4, 60)
+
+        self.assertTrue(admission.reserve([directory.new_player_id()]))
+        self.assertTrue(admission.reserve([directory.new_player_id()]))
+        self.assertFalse(admission.reserve([directory.new_player_id()]))
+
+    async def test_starts_do_not_wait_for_a_fetch(self):
+        # no shard replies, so the fetch runs until its timeout
+        directory = ShardDirectory(3, 60, 0.5)
+        directory.loads = {shard: {"shard": shard, "games": games} for shard, games in enumerate([2, 0, 1])}
+        directory.fetched_at = time.monotonic() - 120
+        fetch = asyncio.get_running_loop().create_task(
+            sync_to_async(directory.get_loads, thread_sensitive=False)(refresh=True)
+        )
+        await asyncio.sleep(0.05)
+
+        started = time.monotonic()
+        shard = await sync_to_async(directory.least_loaded, thread_sensitive=False)()
+
+        self.assertEqual(shard, 1)
+        self.assertLess(time.monotonic() - started, 0.25)
+        self.assertEqual(await fetch, {})
+        self.assertEqual(directory.loads, {})
+
+
+class OutboundQueueTests(SimpleTestCase):
+    """
+    A slow client skips stale position frames, still gets every control message in order, and is dropped once stalled.
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.reading = asyncio.Event()
+
+    async def send(self, data):
+        # the client reads nothing until the test lets it
+        await self.reading.wait()
+        self.sent.append(data)
+        return True
+
+    async def delivered(self, queue):
+        self.reading.set()
+        while queue.messages or queue.sending_since is not None:
+            await asyncio.sleep(0)
+
+    async def test_frames_coalesce_to_the_latest(self):
+        queue = OutboundQueue(self.send, 100, 60)
+        self.addCleanup(queue.close)
+        queue.put({"frame": 1})
+        # the writer takes the first frame and waits on the client
+        await asyncio.sleep(0)
+
+        for frame in range(2, 6):
+            queue.put({"frame": frame})
+        await self.delivered(queue)
+
+        self.assertEqual(self.sent, [{"frame": 1}, {"frame": 5}])
+        self.assertEqual(queue.coalesced, 3)
+
+    async def test_control_messages_keep_their_order(self):
+        queue = OutboundQueue(self.send, 100, 60)
+        self.addCleanup(queue.close)
+        queue.put({"frame": 1})
+        await asyncio.sleep(0)
+
+        queue.put({"popResult": {"accepted": [3], "rejected": []}}, control=True)
+        queue.put({"frame": 2})
+        queue.put({"wave": 2}, control=True)
+        queue.put({"frame": 3})
+        queue.put({"message": "Game Over"}, control=True)
+        queue.put({"frame": 4})
+        await self.delivered(queue)
+
+        self.assertEqual(self.sent, [
+            {"frame": 1},
+            {"popResult": {"accepted": [3], "rejected": []}},
+            {"wave": 2},
+            {"message": "Game Over"},
+            {"frame": 4},
+        ])
+
+    async def test_stalled_after_the_lag_limit(self):
+        queue = OutboundQueue(self.send, 3, 0.05)
+        self.addCleanup(queue.close)
+        queue.put({"frame": 1})
+        await asyncio.sleep(0)
+
+        self.assertFalse(queue.stalled())
+        await asyncio.sleep(0.06)
+        self.assertTrue(queue.stalled())
+
+    async def test_stalled_after_too_many_messages(self):
+        queue = OutboundQueue(self.send, 3, 60)
+        self.addCleanup(queue.close)
+
+        for score in range(3):
+            queue.put({"score": score}, control=True)
+        self.assertFalse(queue.stalled())
+        queue.put({"score": 3}, control=True)
+
+        self.assertTrue(queue.stalled())
+
+    async def test_stalled_client_is_disconnected(self):
+        consumer = LoonConsumer()
+        consumer.player_id = "stalled"
+        consumer.outbound = OutboundQueue(self.send, 100, 0.05)
+        closed = []
+
+        async def close(code=None):
+            closed.append(code)
+
+        consumer.close = close
+        self.assertTrue(await consumer.publish({"frame": 1}))
+        await asyncio.sleep(0.06)
+
+        self.assertFalse(await consumer.publish({"frame": 2}))
+        await asyncio.sleep(0)
+
+        self.assertEqual(closed, [LoonConsumer.STALLED_CLOSE_CODE])
+        self.assertTrue(consumer.outbound.closed)
+        self.assertFalse(consumer.outbound.put({"frame": 3}))
+
+
+class DeltaClient:
+    """
+    What a delta sync client does: rebuild every frame from a keyframe or from the acknowledged frame it is based on.
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.sequence = 0
+        self.state = None
+
+    def apply(self, message):
+        frame = message["loonSync"]
+        assert frame["seq"] > self.sequence, "frames went backwards"
+        if frame["keyframe"]:
+            state = {loon_id: (level, x, y) for loon_id, level, x, y in frame["loons"]}
+        else:
+            state = dict(self.states[frame["base"]])
+            for loon_id in frame["removals"]:
+                del state[loon_id]
+            for loon_id, dx, dy in frame["moves"]:
+                level, x, y = state[loon_id]
+                state[loon_id] = (level, x + dx, y + dy)
+            for loon_id, level, x, y in frame["spawns"]:
+                state[loon_id] = (level, x, y)
+        self.sequence = frame["seq"]
+        self.states[frame["seq"]] = self.state = state
+        return frame
+
+
+def server_state(loons):
+    scale = DeltaSync.POSITION_SCALE
+    return {loon.loon_id: (loon.loon_level, round(loon.current_pos[0] * scale), round(loon.current_pos[1] * scale))
+            for loon in loons}
+
+
+class DeltaSyncTests(SimpleTestCase):
+    """
+    A client applying the frames of DeltaSync always ends up with the server's state.
+    """
+
+    def setUp(self):
+        self.rng = random.Random(3)
+        self.loons = {}
+        self.next_id = 0
+
+    def step_loons(self):
+        # some loons leave, some spawn, most move
+        for loon_id in list(self.loons):
+            if self.rng.random() < 0.1:
+                del self.loons[loon_id]
+        for _ in range(self.rng.randrange(3)):
+            self.loons[self.next_id] = SimpleNamespace(
+                loon_id=self.next_id, loon_level=self.rng.randrange(4), current_pos=(self.rng.uniform(0, 500), 0.0)
+            )
+            self.next_id += 1
+        for loon in self.loons.values():
+            if self.rng.random() < 0.8:
+                x, y = loon.current_pos
+                loon.current_pos = (x + self.rng.uniform(-3, 3), y + self.rng.uniform(0, 3))
+        return list(self.loons.values())
+
+    def test_keyframes_until_the_first_ack(self):
+        sync = DeltaSync(100)
+
+        frames = [sync.frame(self.step_loons())["loonSync"] for _ in range(3)]
+
+        self.assertEqual([frame["seq"] for frame in frames], [1, 2, 3])
+        self.assertTrue(all(frame["keyframe"] for frame in frames))
+        sync.ack(2)
+        frame = sync.frame(self.step_loons())["loonSync"]
+        self.assertEqual((frame["seq"], frame["keyframe"], frame["base"]), (4, False, 2))
+
+    def test_deltas_against_the_acked_base(self):
+        for ack_every in (1, 4):
+            with self.subTest(ack_every=ack_every):
+                sync = DeltaSync(16)
+                client = DeltaClient()
+                deltas = 0
+                for _ in range(200):
+                    loons = self.step_loons()
+                    frame = client.apply(sync.frame(loons))
+                    self.assertEqual(client.state, server_state(loons))
+                    if not frame["keyframe"]:
+                        deltas += 1
+                        self.assertEqual(frame["base"], sync.acked)
+                    # acks get through now and then only, deltas stay on the last one that did
+                    if frame["seq"] % ack_every == 0:
+                        sync.ack(frame["seq"])
+                self.assertGreater(deltas, 150)
+                self.assertEqual(sum(1 for seq in client.states if seq % 16 == 0), 200 // 16)
+
+    def test_stale_and_unknown_acks_are_ignored(self):
+        sync = DeltaSync(100)
+        for _ in range(3):
+            sync.frame(self.step_loons())
+        sync.ack(3)
+
+        sync.ack(1)
+        sync.ack(99)
+
+        self.assertEqual(sync.acked, 3)
+        self.assertEqual(sync.frame(self.step_loons())["loonSync"]["base"], 3)
+
+    def test_resync_after_a_missed_frame(self):
+        sync = DeltaSync(100)
+        client = DeltaClient()
+        client.apply(sync.frame(self.step_loons()))
+        sync.ack(1)
+        # the client loses its state, say it missed frames and dropped what it had
+        sync.frame(self.step_loons())
+        client = DeltaClient()
+        client.sequence = 2
+
+        sync.resync()
+        loons = self.step_loons()
+        frame = client.apply(sync.frame(loons))
+
+        self.assertTrue(frame["keyframe"])
+        self.assertEqual(client.state, server_state(loons))
+        # the frame acknowledged before is gone from the client, deltas wait for the keyframe's ack
+        self.assertTrue(client.apply(sync.frame(self.step_loons()))["keyframe"])
+        sync.ack(frame["seq"])
+        loons = self.step_loons()
+        frame = client.apply(sync.frame(loons))
+        self.assertEqual((frame["keyframe"], frame["base"]), (False, 3))
+        self.assertEqual(client.state, server_state(loons))
+
+    def test_reset_starts_the_wave_from_a_keyframe(self):
+        sync = DeltaSync(100)
+        client = DeltaClient()
+        client.apply(sync.frame(self.step_loons()))
+        sync.ack(1)
+
+        # the next wave reuses loon ids from 0
+        sync.reset()
+        self.loons.clear()
+        self.next_id = 0
+        loons = self.step_loons()
+        frame = client.apply(sync.frame(loons))
+
+        self.assertTrue(frame["keyframe"])
+        self.assertEqual(client.state, server_state(loons))
+        self.assertTrue(client.apply(sync.frame(self.step_loons()))["keyframe"])
+
+    async def test_game_stays_in_sync_across_waves(self):
+        random.seed(5)
+        game = HeadlessGame("delta", "python", "json", hit_rate=0.3, max_waves=3)
+        consumer = game.consumer
+        consumer.sync = DeltaSync(10)
+        messages = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            messages.append(json.loads(text_data))
+
+        consumer.send = send
+        client = DeltaClient()
+        await consumer.setup_game()
+        waves = set()
+        while game.running:
+            wave = consumer.wave
+            await game.tick()
+            for message in messages:
+                if "loonSync" not in message:
+                    continue
+                frame = client.apply(message)
+                self.assertEqual(client.state, server_state(consumer.loon_batch))
+                if wave not in waves:
+                    waves.add(wave)
+                    self.assertTrue(frame["keyframe"])
+                if frame["seq"] % 3 == 0:
+                    await consumer.receive(text_data=json.dumps({"action": "ack", "seq": frame["seq"]}))
+            messages.clear()
+
+        self.assertEqual(waves, {1, 2, 3})
+
+
+@override_settings(LOON_OFFLOAD_THRESHOLD=1, LOON_OFFLOAD_WORKERS=1)
+class OffloadTests(SimpleTestCase):
+    """
+    Wave steps run in the process pool play out exactly like in process.
+    """
+
+    def setUp(self):
+        self.addCleanup(offload.reset_offload_pool)
+
+    def waves(self, seed):
+        waves = []
+        for engine in (VectorLoonWave, SharedVectorLoonWave):
+            rng = random.Random(seed)
+            wave = engine.seeded(seed)
+            wave.loon_delta = 3
+            # near enough to their end for some loons to escape within the test
+            for _ in range(40):
+                wave.add_loon((rng.uniform(20, 60), rng.uniform(20, 60)), (0.0, 0.0), rng.choice([1, 2]))
+            waves.append(wave)
+        return waves
+
+    def assertSameWave(self, shared, expected):
+        count = expected.count
+        np.testing.assert_array_equal(shared.positions[:count], expected.positions[:count])
+        np.testing.assert_array_equal(shared.active[:count], expected.active[:count])
+        np.testing.assert_array_equal(shared.present[:count], expected.present[:count])
+        self.assertEqual(shared.rng.bit_generator.state, expected.rng.bit_generator.state)
+        self.assertEqual(
+            [loon.loon_id for loon in shared.active_loons(count)],
+            [loon.loon_id for loon in expected.active_loons(count)],
+        )
+
+    async def test_offloaded_steps_match_in_process(self):
+        expected, shared = self.waves(11)
+        results = []
+
+        for step in range(30):
+            if step == 5:
+                # a pop between two steps leaves a hole in the slots
+                expected.remove_loon(2)
+                shared.remove_loon(2)
+            batch_size = 5 + step
+            self.assertTrue(shared.offloads(batch_size))
+            result = expected.update_loons(batch_size)
+            self.assertEqual(await shared.update_loons_offloaded(batch_size), result)
+            self.assertSameWave(shared, expected)
+            results.append(result)
+
+        self.assertIn(False, results)
+
+    def test_rng_state_round_trip(self):
+        expected, _ = self.waves(12)
+        # what the pool worker gets, and what it sends back
+        state = pickle.loads(pickle.dumps(expected.rng.bit_generator.state))
+        rng = np.random.Generator(np.random.PCG64())
+        rng.bit_generator.state = state
+
+        np.testing.assert_array_equal(rng.integers(0, 3, size=(20, 2)), expected.rng.integers(0, 3, size=(20, 2)))
+        self.assertEqual(rng.bit_generator.state, expected.rng.bit_generator.state)
+
+    async def test_broken_pool_steps_in_process(self):
+        class BrokenPool:
+            def submit(self, *args, **kwargs):
+                raise BrokenProcessPool("A worker died")
+
+            def shutdown(self, wait=True):
+                pass
+
+        expected, shared = self.waves(13)
+        offload._pool = BrokenPool()
+
+        self.assertEqual(await shared.update_loons_offloaded(20), expected.update_loons(20))
+
+        self.assertSameWave(shared, expected)
+        self.assertIsNone(offload._pool)
+
+
+class SessionGame(LoonConsumer):
+    """
+    A game without a socket, recording how the registry closed it.
+    """
+
+    def __init__(self, registry, player_id, hangs=False):
+        super().__init__()
+        self.sessions = registry
+        self.player_id = player_id
+        self.hangs = hangs
+        self.expired = []
+
+    async def expire(self, code):
+        self.expired.append(code)
+        if self.hangs:
+            await asyncio.Event().wait()
+        self.sessions.close(self)
+
+    async def play(self):
+        await asyncio.Event().wait()
+
+
+class SessionRegistryTests(IsolatedAsyncioTestCase):
+    """
+    Sessions own the tasks of their game: closing, reaping or draining a session leaves nothing running.
+    """
+
+    def setUp(self):
+        self.registry = SessionRegistry(idle_timeout=0, drain_timeout=0.1)
+        player_cache._player_cache = PlayerStateCache(60)
+        self.addCleanup(setattr, player_cache, "_player_cache", None)
+
+    def open_game(self, player_id, **kwargs):
+        game = SessionGame(self.registry, player_id, **kwargs)
+        self.registry.open(game)
+        return game
+
+    async def test_close_cancels_the_game_tasks(self):
+        game = self.open_game("closed")
+        task = self.registry.spawn(game, game.play())
+        await asyncio.sleep(0)
+
+        self.registry.close(game)
+
+        self.assertIn(task, self.registry.cancelled)
+        await asyncio.wait([task])
+        # done callbacks run on the next loop iteration
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(self.registry.cancelled, set())
+        self.assertEqual((await self.registry.status())["unreleased_games"], 1)
+
+    async def test_disconnect_cancels_the_game_tasks(self):
+        game = self.open_game("disconnected")
+        game.player_id = None
+        task = self.registry.spawn(game, game.play())
+
+        await game.disconnect(1000)
+        await asyncio.sleep(0)
+
+        self.assertTrue(task.cancelled())
+        self.assertNotIn(game, self.registry.sessions)
+
+    async def test_close_spares_the_task_closing(self):
+        game = self.open_game("closing")
+
+        async def game_over():
+            self.registry.close(game)
+            return "done"
+
+        self.assertEqual(await self.registry.spawn(game, game_over()), "done")
+
+    async def test_reaper_closes_idle_sessions(self):
+        self.registry.idle_timeout = 0.2
+        idle = self.open_game("idle")
+        active = self.open_game("active")
+
+        # the reaper checks every second at most
+        for _ in range(12):
+            await asyncio.sleep(0.1)
+            self.registry.touch(active)
+
+        self.assertEqual(idle.expired, [SessionRegistry.IDLE_CLOSE_CODE])
+        self.assertEqual(active.expired, [])
+        self.assertEqual(list(self.registry.sessions), [active])
+        self.assertEqual(self.registry.idle_closed, 1)
+        self.registry.close(active)
+        await asyncio.wait_for(self.registry.reaper, 2)
+
+    async def test_drain_closes_every_session(self):
+        games = [self.open_game("drained"), self.open_game("stuck", hangs=True)]
+        tasks = [self.registry.spawn(game, game.play()) for game in games]
+
+        await self.registry.drain()
+
+        self.assertEqual([game.expired for game in games], [[SessionRegistry.SHUTDOWN_CLOSE_CODE]] * 2)
+        # the game that did not close within the drain timeout is closed anyway
+        self.assertEqual(self.registry.sessions, {})
+        await asyncio.sleep(0)
+        self.assertTrue(all(task.cancelled() for task in tasks))
+        self.assertTrue((await self.registry.status())["draining"])
+
+    async def test_orphaned_tasks_are_reported(self):
+        game = self.open_game("leaky")
+        owned = self.registry.spawn(game, game.play())
+        self.registry.close(game)
+        await asyncio.sleep(0)
+        # started behind the registry's back, after the session closed
+        leaked = asyncio.get_running_loop().create_task(game.play())
+        self.addCleanup(leaked.cancel)
+        await asyncio.sleep(0)
+
+        self.assertTrue(owned.cancelled())
+        self.assertEqual(self.registry.orphaned_tasks(), [leaked])
+        self.assertEqual((await self.registry.status())["leaked_tasks"], 1)
+
+        other = self.open_game("live")
+        live = self.registry.spawn(other, other.play())
+        self.addCleanup(live.cancel)
+        await asyncio.sleep(0)
+        self.assertEqual(self.registry.orphaned_tasks(), [leaked])
+
+
+class CountingGame:
+    """
+    A scheduler game counting its steps, with a first step that blocks the loop like an overloaded tick.
+    """
+
+    def __init__(self, stall):
+        self.steps = 0
+        self.stall = stall
+
+    async def simulate(self):
+        if self.steps == 0:
+            time.sleep(self.stall)
+        self.steps += 1
+
+    def offloaded(self):
+        return False
+
+    def frame(self):
+        return None
+
+
+class GameSchedulerTests(SimpleTestCase):
+    """
+    Games play out step for step the same whatever the send rate, and steps missed under load are run late.
+    """
+
+    async def play(self, send_every, steps_per_tick, pops=True):
+        random.seed(9)
+        game = HeadlessGame("scheduled", "python", "json", hit_rate=0, max_waves=None)
+        consumer = game.consumer
+        frames = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            frames.append(text_data)
+
+        consumer.send = send
+        await consumer.setup_game()
+        scheduler = GameScheduler(0.05)
+        scheduler.games[consumer] = None
+        ticks = 0
+        while consumer.steps < 400 and not consumer.is_game_over:
+            ticks += 1
+            await scheduler.tick(min(steps_per_tick, 400 - consumer.steps), send=ticks % send_every == 0)
+            if consumer.transition is not None:
+                await consumer.transition
+            # the same pops after the same steps, decided from the game state only
+            if pops and consumer.steps % 7 == 0 and consumer.loon_batch:
+                await consumer.receive(text_data=json.dumps(
+                    {"action": "popLoon", "loonId": consumer.loon_batch[0].loon_id}
+                ))
+        return (consumer.steps, consumer.wave, state_digest(consumer)), len(frames)
+
+    async def test_same_game_at_any_send_rate(self):
+        expected, every_tick = await self.play(send_every=1, steps_per_tick=1)
+
+        for send_every in (2, 4):
+            with self.subTest(send_every=send_every):
+                played, frames = await self.play(send_every, steps_per_tick=1)
+                self.assertEqual(played, expected)
+                self.assertLess(frames, every_tick)
+
+    async def test_same_game_when_catching_up(self):
+        # pops arrive between ticks, so only a game without pops sees the same inputs at every step
+        expected, _ = await self.play(send_every=1, steps_per_tick=1, pops=False)
+
+        for steps_per_tick in (3, 5):
+            with self.subTest(steps_per_tick=steps_per_tick):
+                played, _ = await self.play(send_every=1, steps_per_tick=steps_per_tick, pops=False)
+                self.assertEqual(played, expected)
+
+    async def test_missed_steps_run_on_later_ticks(self):
+        scheduler = GameScheduler(0.01, max_catch_up_steps=2)
+        game = CountingGame(stall=0.1)
+        started = time.monotonic()
+
+        scheduler.register(game)
+        await asyncio.sleep(0.4)
+        elapsed = time.monotonic() - started
+        scheduler.unregister(game)
+        await scheduler.task
+
+        # the ten steps missed while the first one blocked are made up two at a time
+        self.assertGreaterEqual(game.steps, int(0.8 * elapsed / 0.01))
+        self.assertEqual(scheduler.stats.skipped_ticks, 0)
+
+    async def test_steps_beyond_the_backlog_are_dropped(self):
+        scheduler = GameScheduler(0.01, max_catch_up_steps=2, max_backlog_steps=3)
+        game = CountingGame(stall=0.1)
+
+        scheduler.register(game)
+        await asyncio.sleep(0.2)
+        scheduler.unregister(game)
+        await scheduler.task
+
+        self.assertGreater(scheduler.stats.skipped_ticks, 0)
+        self.assertLessEqual(scheduler.backlog, 3)
+
+
+class ScriptedRandom:
+    """
+    Hands both wave engines the same movement draws, in the order each engine asks for them.
+    """
+
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+
+    def randint(self, low, high):
+        return self.rng.randint(low, high)
+
+    def integers(self, low, high, size, endpoint):
+        rows, columns = size
+        return np.array([[self.randint(low, high) for _ in range(columns)] for _ in range(rows)])
+
+
+class WaveEngineTests(SimpleTestCase):
+    """
+    VectorLoonWave is a drop-in for LoonWave: for the same draws, the same loons move, escape and show.
+    """
+
+    def waves(self, seed):
+        waves = [LoonWave(ScriptedRandom(seed)), VectorLoonWave(ScriptedRandom(seed))]
+        for wave in waves:
+            wave.loon_delta = 3
+        return waves
+
+    def fill(self, waves, seed, count):
+        rng = random.Random(seed)
+        for _ in range(count):
+            start = (rng.uniform(30, 90), rng.uniform(30, 90))
+            level = rng.choice([1, 2])
+            for wave in waves:
+                wave.add_loon(start, (0.0, 0.0), level)
+
+    def state(self, wave, batch_size):
+        return (
+            wave.size(),
+            [(loon.loon_id, loon.loon_level, tuple(loon.current_pos), bool(loon.active))
+             for loon in wave.batch(wave.size())],
+            [loon.loon_id for loon in wave.active_loons(batch_size)],
+        )
+
+    def play_wave(self, waves, pops):
+        """
+        Step both engines in lock-step until a loon escapes, comparing them after every step.
+
+        Returns:
+            int: The step a loon escaped at.
+        """
+        python_wave, vector_wave = waves
+        batch_size = 3
+        for step in range(1, 500):
+            for loon_id in pops.get(step, []):
+                for wave in waves:
+                    wave.remove_loon(loon_id)
+                self.assertFalse(vector_wave.is_loon_present(loon_id))
+            result = python_wave.update_loons(batch_size)
+            self.assertEqual(vector_wave.update_loons(batch_size), result)
+            if not result:
+                # the Python engine stops at the first loon out of bounds, the vector one moves the whole batch
+                escaped = next(loon for loon in python_wave.batch(batch_size) if not loon.active)
+                self.assertFalse(vector_wave.loons[escaped.loon_id].active)
+                return step
+            self.assertEqual(self.state(vector_wave, batch_size), self.state(python_wave, batch_size))
+            batch_size += step % 3
+        self.fail("No loon escaped")
+
+    def test_engines_step_in_lock_step(self):
+        waves = self.waves(21)
+        self.fill(waves, 21, 30)
+
+        escaped_at = self.play_wave(waves, {4: [0], 9: [2, 5], 15: [29]})
+
+        self.assertGreater(escaped_at, 15)
+
+    def test_engines_match_after_a_reset(self):
+        waves = self.waves(22)
+        self.fill(waves, 22, 10)
+        self.play_wave(waves, {})
+
+        for wave in waves:
+            wave.reset()
+            # the escape step took a different number of draws on each engine
+            wave.rng = ScriptedRandom(23)
+        self.assertEqual(self.state(waves[1], 10), self.state(waves[0], 10))
+        # the next wave reuses the loon ids, and the pooled loons and slots
+        self.fill(waves, 23, 40)
+        self.play_wave(waves, {3: [1]})
+
+
+class ProfilerTests(SimpleTestCase):
+    """
+    The stack samples can be read while the sampler runs, and a window never runs two samplers.
+    """
+
+    def setUp(self):
+        self.profiler = Profiler()
+        self.addCleanup(self.profiler.stop)
+
+    def test_collapsed_while_sampling(self):
+        # new threads keep adding stacks while the samples are read
+        stop = threading.Event()
+        workers = [threading.Thread(target=stop.wait, args=(5,)) for _ in range(3)]
+        self.profiler.start(5, interval=0.0001)
+        for worker in workers:
+            worker.start()
+
+        for _ in range(200):
+            self.profiler.collapsed()
+
+        stop.set()
+        for worker in workers:
+            worker.join()
+        self.profiler.stop()
+        counts = [int(line.rsplit(" ", 1)[1]) for line in self.profiler.collapsed().splitlines()]
+        self.assertGreater(sum(counts), 0)
+
+    def test_restart_runs_one_sampler(self):
+        self.profiler.start(5, interval=1)
+        with self.assertRaises(ProfilerBusyError):
+            self.profiler.start(5)
+        first = self.profiler.thread
+
+        self.profiler.stop()
+        self.profiler.start(5, interval=1)
+
+        self.assertFalse(first.is_alive())
+        samplers = [thread for thread in threading.enumerate() if thread.name == "loons-profiler"]
+        self.assertEqual(samplers, [self.profiler.thread])
@@ -5,6 +5,13 @@ from . import consumers
 urlpatterns = [
     # Define your HTTP routes here
     path('start/', views.StartGameView.as_view(), name='start'),
+    path('start/batch/', views.StartGamesView.as_view(), name='startBatch'),
+    path('config/', views.GameConfigView.as_view(), name='config'),
+    path('leaderboard/', views.LeaderboardView.as_view(), name='leaderboard'),
+    path('shards/', views.ShardsView.as_view(), name='shards'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
+    path('sessions/', views.SessionsView.as_view(), name='sessions'),
+    path('profile/', views.ProfileView.as_view(), name='profile'),
     path('buy/', views.BuyItemView.as_view(), name='buy'),
     path('use/', views.UseItemView.as_view(), name='useItem')
 ]
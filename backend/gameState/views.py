@@ -1,37 +1,282 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 import json
+from asgiref.sync import async_to_sync
 from .services import ItemNotFoundError, InsufficientQuantityError, InsufficientFundsError, PlayerService
 from django.conf import settings
-import uuid
+from django.http import HttpResponse, HttpResponseNotModified
+from .game_config import get_game_config_loader
+from .leaderboard import get_leaderboard
+from .metrics import RATE_LIMITED, registry
+from .profiling import ProfilerBusyError, get_profiler
+from .ratelimit import PlayerRateThrottle, get_admission, request_player_id
+from .sessions import get_session_registry
+from .sharding import get_shard_directory, new_player_id
+
+def server_busy(player_ids):
+    """
+    Reserve places under the admission cap for games about to start, so a full server turns new
+    games away instead of slowing down the running ones.
+
+    Args:
+        player_ids (list): The IDs of the players whose games start.
+
+    Returns:
+        Response: A 503 "Server busy" response if the games would go over LOON_MAX_GAMES, else None.
+    """
+    if get_admission().reserve(player_ids):
+        return None
+    RATE_LIMITED.labels("admission").inc()
+    return Response({'message': 'Server busy, try again later'}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    headers={'Retry-After': '5'})
 
 class StartGameView(APIView):
     def get(self, request, format=None):
         """
         Get method to start a new game.
 
+        Clients that already have the game configuration can send its ETag in
+        If-None-Match, the configuration is then left out of the response.
+
         Args:
             request (HttpRequest): The HTTP request object.
             format (str, optional): The format of the response. Defaults to None.
 
         Returns:
-            Response: The HTTP response containing the player ID and game configuration.
+            HttpResponse: The HTTP response containing the player ID and game configuration, or 503
+            if the server is running LOON_MAX_GAMES games already.
+        """
+        player_id = new_player_id()
+        busy = server_busy([player_id])
+        if busy is not None:
+            return busy
+        player_service = PlayerService()
+        game_config = get_game_config_loader().get()
+        game_settings = game_config.config['game_settings']
+
+        try:
+            player_service.create_player(player_id, game_settings['initial_coins'], game_settings['inventory'])
+        except Exception:
+            # the game never starts, its place goes back to the next start
+            get_admission().release([player_id])
+            raise
+
+        # Return the game configuration in the response, using the pre-serialized config
+        if request.headers.get('If-None-Match') == game_config.etag:
+            body = '{{"player_id":"{}","game_config_etag":{}}}'.format(
+                player_id, json.dumps(game_config.etag))
+        else:
+            body = '{{"player_id":"{}","game_config":{},"game_config_etag":{}}}'.format(
+                player_id, game_config.serialized, json.dumps(game_config.etag))
+        return HttpResponse(body, content_type='application/json')
+
+class StartGamesView(APIView):
+    def post(self, request, format=None):
+        """
+        Post method to start several games at once, for lobbies and load tests.
+
+        Args:
+            request (HttpRequest): The HTTP request object, with the number of games in count.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The HTTP response containing the player IDs and game configuration.
         """
-        player_id = uuid.uuid4()
+        try:
+            count = int(request.data.get('count', 1))
+        except (TypeError, ValueError):
+            return Response({'message': 'count must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= count <= settings.LOON_MAX_BATCH_START:
+            return Response({'message': 'count must be between 1 and {}'.format(settings.LOON_MAX_BATCH_START)},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        player_ids = [new_player_id() for _ in range(count)]
+        busy = server_busy(player_ids)
+        if busy is not None:
+            return busy
         player_service = PlayerService()
-        with open(settings.BASE_DIR / 'gameState/config/game_config.json') as f:
-            game_config = json.load(f)
-            game_settings = game_config['game_settings']
+        game_config = get_game_config_loader().get()
+        game_settings = game_config.config['game_settings']
 
-        player_service.create_player(player_id, game_settings['initial_coins'], game_settings['inventory'])
+        try:
+            player_service.create_players(player_ids, game_settings['initial_coins'], game_settings['inventory'])
+        except Exception:
+            get_admission().release(player_ids)
+            raise
 
-        # Return the game configuration in the response
         return Response({
-            'player_id': str(player_id),
-            'game_config': game_config})
+            'player_ids': [str(player_id) for player_id in player_ids],
+            'game_config': game_config.config,
+            'game_config_etag': game_config.etag})
+
+class GameConfigView(APIView):
+    def get(self, request, format=None):
+        """
+        Get method to fetch the game configuration, answering 304 if the client's copy is current.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            HttpResponse: The game configuration with its ETag.
+        """
+        game_config = get_game_config_loader().get()
+        if request.headers.get('If-None-Match') == game_config.etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(game_config.serialized, content_type='application/json')
+        response['ETag'] = game_config.etag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+class LeaderboardView(APIView):
+    def get(self, request, format=None):
+        """
+        Get method to fetch the top scores, answering 304 if the client's copy is current.
+
+        The leaderboard is served from memory and only re-serialized when it changed. In sharded
+        mode the boards of the shards are merged into it at most every LOON_SHARD_STATS_TTL seconds.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            HttpResponse: The leaderboard with its version and ETag.
+        """
+        if settings.LOON_SHARDS:
+            get_shard_directory().get_loads()
+        body, etag = get_leaderboard().serialized()
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+class MetricsView(APIView):
+    def get(self, request, format=None):
+        """
+        Get method to scrape the game server's metrics.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            HttpResponse: The metrics in the Prometheus text exposition format.
+        """
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class ShardsView(APIView):
+    def get(self, request, format=None):
+        """
+        Get method to fetch the load of every shard in sharded mode.
+
+        Args:
+            request (HttpRequest): The HTTP request object, with refresh=1 to skip the cached loads.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The number of shards and the load reported by each, missing shards listed apart.
+        """
+        if not settings.LOON_SHARDS:
+            return Response({'shards': 0, 'loads': [], 'missing': []})
+        loads = get_shard_directory().get_loads(refresh=request.query_params.get('refresh') == '1')
+        return Response({
+            'shards': settings.LOON_SHARDS,
+            'loads': [loads[shard] for shard in sorted(loads)],
+            'missing': [shard for shard in range(settings.LOON_SHARDS) if shard not in loads]})
+
+class SessionsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        """
+        Get method to fetch the live games of this process, the tasks and games that outlived
+        their session, and the memory held by each session.
+
+        Args:
+            request (HttpRequest): The HTTP request object, with the most sessions to list in limit.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The session report, the sessions holding the most memory listed first.
+        """
+        try:
+            limit = int(request.query_params.get('limit', 100))
+        except ValueError:
+            return Response({'message': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(async_to_sync(get_session_registry().status)(limit))
+
+class ProfileView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        """
+        Get method to fetch the results of the current or last profiling window.
+
+        Args:
+            request (HttpRequest): The HTTP request object, with output=collapsed for the flamegraph stacks.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The per-phase timings and trace, or the collapsed stacks as text.
+        """
+        profiler = get_profiler()
+        if request.query_params.get('output') == 'collapsed':
+            return HttpResponse(profiler.collapsed(), content_type='text/plain; charset=utf-8')
+        return Response(profiler.report())
+
+    def post(self, request, format=None):
+        """
+        Post method to start a profiling window.
+
+        Args:
+            request (HttpRequest): The HTTP request object, with the window length in seconds, the
+                sampling interval in interval and optionally the player_id of a game to trace.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The state of the profiler, or an error if a window is already running.
+        """
+        try:
+            seconds = float(request.data.get('seconds', 10))
+            interval = float(request.data.get('interval', 0.005))
+        except (TypeError, ValueError):
+            return Response({'message': 'seconds and interval must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+        if seconds <= 0 or interval <= 0:
+            return Response({'message': 'seconds and interval must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        profiler = get_profiler()
+        try:
+            profiler.start(seconds, interval, request.data.get('player_id'))
+        except ProfilerBusyError:
+            return Response({'message': 'A profiling window is already running'}, status=status.HTTP_409_CONFLICT)
+        return Response(profiler.report(), status=status.HTTP_202_ACCEPTED)
+
+    def delete(self, request, format=None):
+        """
+        Delete method to end the running profiling window early.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            format (str, optional): The format of the response. Defaults to None.
+
+        Returns:
+            Response: The results of the window.
+        """
+        profiler = get_profiler()
+        profiler.stop()
+        return Response(profiler.report())
 
 class BuyItemView(APIView):
+    throttle_classes = [PlayerRateThrottle]
+
     def post(self, request):
         """
         Post method to buy a turret.
@@ -44,7 +289,7 @@ class BuyItemView(APIView):
             Response: The HTTP response indicating the success or failure of the item purchase. Also the updated coins
             and new inventory.
         """
-        player_id = request.data.get('playerId')
+        player_id = request_player_id(request)
         item_id = request.data.get('itemId')
 
         if not player_id or not item_id:
@@ -52,14 +297,14 @@ class BuyItemView(APIView):
 
         player_service = PlayerService()
         try:
-            inventory_item = player_service.buy_item(player_id, item_id)
-            # inventory = player_service.get_inventory_item(player_id, item_id)
-            coins = player_service.get_coins(player_id)
+            inventory_item, coins = player_service.buy_item(player_id, item_id)
             return Response({'message': 'Item bought successfully', 'inventory_item': inventory_item, 'coins': coins}, status=status.HTTP_200_OK)
         except InsufficientFundsError:
             return Response({'message': 'Insufficient funds to buy item'}, status=status.HTTP_400_BAD_REQUEST)
 
 class UseItemView(APIView):
+    throttle_classes = [PlayerRateThrottle]
+
     def post(self, request):
         """
         Post method to use an item.
@@ -70,7 +315,7 @@ class UseItemView(APIView):
         Returns:
             Response: The HTTP response indicating the success or failure of using the item.
         """
-        player_id = request.data.get('playerId')
+        player_id = request_player_id(request)
         item_id = request.data.get('itemId')
 
         if not player_id or not item_id:
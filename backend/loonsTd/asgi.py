@@ -1,15 +1,32 @@
 # asgi.py
 import os
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from django.urls import path, re_path
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'loonsTd.settings')
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
+django_asgi_app = get_asgi_application()
+
 from gameState import consumers
+from gameState.sessions import lifespan
+from gameState.sharding import ShardConsumer, ShardedLoonConsumer, shard_channel
+
+# in sharded mode this process only holds the sockets, the games run in the shard workers
+if settings.LOON_SHARDS:
+    loon_consumer = ShardedLoonConsumer
+else:
+    loon_consumer = consumers.LoonConsumer
 
 application = ProtocolTypeRouter({
-  "http": get_asgi_application(),
+  "http": django_asgi_app,
+  # warms the caches when the server starts and drains the game sessions when it shuts down
+  "lifespan": lifespan,
   "websocket": URLRouter(
-    [re_path(r'ws/loonsLocation/(?P<player_id>[\w-]+)/$', consumers.LoonConsumer.as_asgi())]
+    [re_path(r'ws/loonsLocation/(?P<player_id>[\w-]+)/$', loon_consumer.as_asgi())]
   ),
+  # shard workers, started with: python manage.py runshard loon-shard-<n>
+  "channel": ChannelNameRouter({
+    shard_channel(shard): ShardConsumer.as_asgi(shard=shard) for shard in range(settings.LOON_SHARDS)
+  }),
 })
\ No newline at end of file
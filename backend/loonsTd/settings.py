@@ -81,7 +81,7 @@ TEMPLATES = [
 WSGI_APPLICATION = 'loonsTd.wsgi.application'
 
 # Use channels for handling asynchronous requests
-ASGI_APPLICATION = 'loonsTd.routing.application'
+ASGI_APPLICATION = 'loonsTd.asgi.application'
 
 # Configure channel layer (using Redis in this example)
 # keeping the redis server on the same host
@@ -94,6 +94,68 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Loon game settings
+# engine used to simulate loon waves, "python" or "vector" (NumPy); games can override it with ?engine=
+LOON_WAVE_ENGINE = 'python'
+# seconds between two ticks of the shared game scheduler
+# it is crucial to keep this low otherwise state data gets shared. Should be lower than shooting freq
+# this is the fixed simulation step, loon speeds are scaled to it
+LOON_TICK_INTERVAL = 0.05
+# seconds between two frames sent to a client, clients interpolate in between
+LOON_SEND_INTERVAL = 0.05
+# the send interval is raised up to this while the scheduler overruns its ticks
+LOON_MAX_SEND_INTERVAL = 0.2
+# most simulation steps run in one tick to catch up after a slow one, the rest run on the next ticks
+# steps more than a second behind are dropped
+LOON_MAX_CATCH_UP_STEPS = 5
+# frames between two keyframes for clients using ?sync=delta
+LOON_KEYFRAME_INTERVAL = 20
+# seconds between two write-behind flushes of the in-memory player scores and coins
+LOON_PLAYER_FLUSH_INTERVAL = 1.0
+# most games a single game/start/batch/ request may provision
+LOON_MAX_BATCH_START = 500
+# most messages that may wait in a connection's outbound queue, position frames are coalesced to one
+LOON_OUTBOUND_QUEUE_SIZE = 32
+# seconds a client may leave a message unread before it gets disconnected
+LOON_STALL_TIMEOUT = 10.0
+# directory the replay log of every game is written to, such as BASE_DIR / 'replays', None to not record games
+LOON_REPLAY_DIR = None
+# number of players kept on the in-memory leaderboard served by game/leaderboard/
+LOON_LEADERBOARD_SIZE = 100
+# longest profiling window the admin-only game/profile/ endpoint may run, in seconds
+LOON_PROFILE_MAX_SECONDS = 60
+# fewest loons stepped in one tick for a vector engine game to run its steps in the process pool, 0 to never offload
+# see python manage.py benchoffload for where offloading starts to pay off on a given machine
+LOON_OFFLOAD_THRESHOLD = 0
+# number of processes in the offload pool
+LOON_OFFLOAD_WORKERS = 2
+# seconds a client may send nothing before its session is closed, 0 to keep idle sessions open
+LOON_IDLE_TIMEOUT = 120.0
+# most seconds the server waits for the games to close when it shuts down
+LOON_DRAIN_TIMEOUT = 5.0
+# frames per second a connection may send on average, 0 for no limit
+LOON_RECEIVE_RATE = 50.0
+# most frames a connection may send at once before the receive rate applies
+LOON_RECEIVE_BURST = 100
+# frames per second all connections of a player may send together on average, and at most at once, 0 for no limit
+# above the connection's rate, so it only bites on players with several connections
+LOON_PLAYER_RECEIVE_RATE = 75.0
+LOON_PLAYER_RECEIVE_BURST = 150
+# buy and use calls per second a player may make on average, and at most at once, 0 for no limit
+LOON_API_RATE = 5.0
+LOON_API_BURST = 10
+# most games running at once in this process (in all shards in sharded mode), 0 for no limit
+# game/start/ answers 503 "Server busy" beyond it, and clients connecting beyond it are closed with code 1013
+LOON_MAX_GAMES = 2000
+# seconds a game started by game/start/ holds its place under LOON_MAX_GAMES until its client connects
+LOON_ADMISSION_TTL = 10.0
+# number of shard worker processes games are spread over, 0 runs every game in the process holding its socket
+LOON_SHARDS = 0
+# seconds the front caches the loads reported by the shards
+LOON_SHARD_STATS_TTL = 2.0
+# seconds the front waits for the shards to report their loads
+LOON_SHARD_STATS_TIMEOUT = 0.25
+
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
@@ -134,7 +134,7 @@ class GamePanel extends Phaser.Scene {
      * @param {string} itemId - The ID of the item to use.
      */
     useItem(itemId, item) {
-        const useUrl = `http://${serverAddr}/game/use/`
+        const useUrl = `http://${serverAddr}/game/use/?playerId=${this.playerId}`
         fetch(useUrl, {
             method: 'POST',
             body: JSON.stringify({
@@ -69,7 +69,7 @@ class Turret extends Phaser.GameObjects.Sprite {
      * Makes a server call to buy the item and updates the game inventory.
      */
     buyItem() {
-        const buyUrl = `http://${serverAddr}/game/buy/`
+        const buyUrl = `http://${serverAddr}/game/buy/?playerId=${this.playerId}`
         // Replace with your actual server call
         fetch(buyUrl, {
             method: 'POST',